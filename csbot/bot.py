@@ -1,50 +1,216 @@
 import os
+import sys
+import gzip
+import time
+import queue
+import shutil
+import json
+import asyncio
+import hashlib
 import logging
+import logging.handlers
+import resource
 import discord
-import json
+from pathlib import Path
 from dotenv import load_dotenv
 from discord.ext import commands
 
+import metrics
+from tracing import TraceRecorder
+from guildstate import PlayerStore
+from scheduler import Scheduler
+from distances import get_metric
+
+_log_listener = None
+
+
+def _gzip_namer(name: str) -> str:
+    return name + ".gz"
 
-class CSBot(commands.Bot):
+
+def _gzip_rotator(source: str, dest: str):
+    with open(source, "rb") as f_in, gzip.open(dest, "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
+class CSBot(commands.AutoShardedBot):
     """
     The main bot class
+    One bot serves every guild listed in config.json, split over shards
     """
 
     def __init__(self):
-        intents = discord.Intents.all()
-        super().__init__(command_prefix="!", intents=intents)
-        self.setup_logging()
         with open("config.json", "r") as f:
             self.config = json.load(f)
+        self.check_map_metrics()
+        super().__init__(
+            command_prefix="!",
+            shard_count=self.config.get("shard_count"),
+            intents=self.configured_intents(),
+            member_cache_flags=self.configured_member_cache(),
+            max_messages=self.config.get("max_messages", 1000),
+            chunk_guilds_at_startup=self.config.get("chunk_guilds_at_startup", True),
+        )
+        self.setup_logging()
         self.handlers = [
             "cogs." + cog.removesuffix(".py")
             for cog in os.listdir("cogs")
             if cog.endswith(".py")
         ]
+        self.sync_file = f"{Path.home()}/.csbot/command_tree.json"
+        self.players = PlayerStore(legacy_guild_id=int(self.config["server_ID"]))
+        self.broadcast_channels = {}
+        self.scheduler = Scheduler(f"{Path.home()}/.csbot/schedule.jsonl")
+        self.startup_report = {}
+        self.recorder = None
+        if self.config.get("trace_file"):
+            self.recorder = TraceRecorder(os.path.expanduser(self.config["trace_file"]))
+
+    def check_map_metrics(self):
+        """
+        Raise ValueError on an unknown "map_metric" of any guild at startup,
+        rather than when the teams of that guild are rolled
+        """
+        for guild_id in self.guild_ids():
+            metric = self.guild_config(guild_id).get("map_metric")
+            if metric is None:
+                continue
+            try:
+                get_metric(metric)
+            except ValueError as e:
+                raise ValueError(f"map_metric of guild {guild_id}: {e}") from None
+
+    def configured_intents(self) -> discord.Intents:
+        """
+        Build the gateway intents from the "intents" list in config.json,
+        all intents are requested if the list is missing.
+        """
+        names = self.config.get("intents")
+        if names is None:
+            return discord.Intents.all()
+        return discord.Intents(**{name: True for name in names})
+
+    def configured_member_cache(self) -> discord.MemberCacheFlags:
+        """
+        Build the member cache policy from the "member_cache" mapping in config.json,
+        falls back to what the configured intents allow.
+        """
+        flags = self.config.get("member_cache")
+        if flags is None:
+            return discord.MemberCacheFlags.from_intents(self.configured_intents())
+        return discord.MemberCacheFlags(**flags)
+
+    def memory_report(self) -> dict:
+        """
+        Sizes of the discord.py caches and the resident memory of the process
+
+        RETURNS
+        -------
+        dict
+            name -> (number of cached objects, shallow size in bytes)
+        """
+        caches = {
+            "guilds": list(self.guilds),
+            "members": list(self.get_all_members()),
+            "users": list(self.users),
+            "channels": list(self.get_all_channels()),
+            "roles": [role for guild in self.guilds for role in guild.roles],
+            "emojis": list(self.emojis),
+            "messages": list(self.cached_messages),
+        }
+        report = {
+            name: (len(objects), sum(sys.getsizeof(o) for o in objects))
+            for name, objects in caches.items()
+        }
+        try:
+            with open("/proc/self/statm", "r") as f:
+                report["resident"] = (
+                    1,
+                    int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE"),
+                )
+        except (FileNotFoundError, ValueError):
+            report["resident"] = (
+                1,
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            )
+        return report
 
     def setup_logging(self):
+        """
+        Log through a queue, the file handlers write from a background thread
+        so logging never blocks the event loop.
+        Safe to call more than once, the handlers are only attached the first time.
+        """
+        global _log_listener
+        self.log = logging.getLogger(self.__class__.__qualname__)
+        if _log_listener is not None:
+            return
         log_format = "%(levelname)s %(name)s %(asctime)s - %(message)s"
         formatter = logging.Formatter(log_format)
-        normal_handler = logging.FileHandler(
-            f"{self.__class__.__name__}.log", mode="a", encoding="utf-8"
+        normal_handler = logging.handlers.RotatingFileHandler(
+            f"{self.__class__.__name__}.log",
+            mode="a",
+            maxBytes=self.config.get("log_max_bytes", 5 * 1024 * 1024),
+            backupCount=self.config.get("log_backups", 5),
+            encoding="utf-8",
         )
         normal_handler.setFormatter(formatter)
         normal_handler.setLevel(logging.WARNING)
 
-        debug_handler = logging.FileHandler(
-            f"{self.__class__.__name__}.debug.log", mode="a", encoding="utf-8"
+        debug_handler = logging.handlers.TimedRotatingFileHandler(
+            f"{self.__class__.__name__}.debug.log",
+            when=self.config.get("debug_log_rotation", "midnight"),
+            backupCount=self.config.get("log_backups", 5),
+            encoding="utf-8",
         )
+        debug_handler.namer = _gzip_namer
+        debug_handler.rotator = _gzip_rotator
         debug_handler.setFormatter(formatter)
         debug_handler.setLevel(logging.DEBUG)
 
-        self.log = logging.getLogger(self.__class__.__qualname__)
+        log_queue = queue.SimpleQueue()
         self.log.setLevel(logging.DEBUG)
         self.log.propagate = False
-        self.log.addHandler(normal_handler)
-        self.log.addHandler(debug_handler)
+        self.log.addHandler(logging.handlers.QueueHandler(log_queue))
+        _log_listener = logging.handlers.QueueListener(
+            log_queue, normal_handler, debug_handler, respect_handler_level=True
+        )
+        _log_listener.start()
+
+    async def close(self):
+        await self.scheduler.stop()
+        await super().close()
+        if self.recorder is not None:
+            self.recorder.close()
+        global _log_listener
+        if _log_listener is not None:
+            _log_listener.stop()
+            _log_listener = None
+            for handler in self.log.handlers[:]:
+                self.log.removeHandler(handler)
+
+    def guild_ids(self) -> list:
+        """
+        Ids of the guilds the bot serves, the keys of "guilds" in config.json
+        or only "server_ID" for a single guild setup
+        """
+        return [int(id) for id in self.config.get("guilds", {})] or [
+            int(self.config["server_ID"])
+        ]
+
+    def guild_objects(self) -> list:
+        return [discord.Object(id=id) for id in self.guild_ids()]
+
+    def guild_config(self, guild_id: int) -> dict:
+        """
+        The config of a guild, its entry in "guilds" on top of the top level config
+        """
+        config = dict(self.config)
+        config.update(self.config.get("guilds", {}).get(str(guild_id), {}))
+        return config
 
-    def get_member(self, id: int) -> discord.member.Member:
+    def get_member(self, id: int, guild_id: int = None) -> discord.member.Member:
         """
         Given a member id, return the member object
 
@@ -52,12 +218,17 @@ class CSBot(commands.Bot):
         ----------
         id : int
             The id of the member to return
+        guild_id : int
+            The guild to look in, all guilds are searched if not given
 
         RETURNS
         -------
         discord.member.Member
             The member object
         """
+        if guild_id is not None:
+            guild = self.get_guild(guild_id)
+            return guild.get_member(id) if guild else None
         member = None
         for m in self.get_all_members():
             if m.id == id:
@@ -69,30 +240,208 @@ class CSBot(commands.Bot):
     async def setup_hook(self) -> None:
         """
         Setup the extension for the bot
-        Sync without specifying a guild to get all guilds
-        this might take a while!
+        Commands are only synced if the command tree changed since the last sync,
+        syncing is heavily rate limited and might take a while!
         """
+        metrics.instrument_http(self.http)
+        if self.config.get("metrics_port"):
+            self.metrics_server = await metrics.start_http_server(
+                self.config["metrics_port"],
+                self.config.get("metrics_host", "127.0.0.1"),
+            )
+        await self.load_extensions()
+        start = time.perf_counter()
+        await self.sync_commands(force=self.config.get("force_sync", False))
+        self.startup_report["command sync"] = {
+            "status": "done",
+            "seconds": time.perf_counter() - start,
+        }
+        self.log.info("Startup report:\n%s", self.format_startup_report())
+
+    async def add_cog(self, cog: commands.Cog, /, **kwargs):
+        metrics.instrument_cog(cog)
+        await super().add_cog(cog, **kwargs)
+
+    async def _load_timed(self, handler: str):
+        start = time.perf_counter()
         try:
-            for handler in self.handlers:
-                await self.load_extension(handler)
+            await self.load_extension(handler)
         except Exception as e:
             self.log.error("Error loading %s: %s", handler, e)
-        await self.tree.sync(guild=discord.Object(id=int(self.config["server_ID"])))
+            self.startup_report[handler] = {"status": "failed", "error": str(e)}
+        else:
+            self.startup_report[handler] = {"status": "loaded"}
+        self.startup_report[handler]["seconds"] = time.perf_counter() - start
+
+    async def load_extensions(self):
+        """
+        Load all handlers, one failing extension does not stop the others from loading.
+        Extensions are loaded in waves, every extension whose dependencies are loaded
+        is loaded concurrently so their async setup (cog_load) overlaps.
+        Dependencies are optional and set in config.json as
+        "extension_dependencies": {"cogs.match": ["cogs.member"]}
+        """
+        self.startup_report = {}
+        dependencies = {
+            handler: [
+                dep
+                for dep in self.config.get("extension_dependencies", {}).get(
+                    handler, []
+                )
+                if dep in self.handlers
+            ]
+            for handler in self.handlers
+        }
+        pending = list(self.handlers)
+        while pending:
+            done = set(self.startup_report)
+            ready = [h for h in pending if all(d in done for d in dependencies[h])]
+            if not ready:
+                self.log.warning("Circular extension dependencies: %s", pending)
+                ready = list(pending)
+            wave = []
+            for handler in ready:
+                pending.remove(handler)
+                missing = [
+                    dep
+                    for dep in dependencies[handler]
+                    if dep in done and self.startup_report[dep]["status"] != "loaded"
+                ]
+                if missing:
+                    self.startup_report[handler] = {
+                        "status": "skipped",
+                        "error": f"dependency {', '.join(missing)} not loaded",
+                        "seconds": 0,
+                    }
+                else:
+                    wave.append(handler)
+            await asyncio.gather(*(self._load_timed(handler) for handler in wave))
+
+    def format_startup_report(self) -> str:
+        """
+        Format the startup report, slowest step first
+        """
+        lines = []
+        for name, step in sorted(
+            self.startup_report.items(),
+            key=lambda item: item[1]["seconds"],
+            reverse=True,
+        ):
+            line = f"{name:<24} {step['status']:<8} {step['seconds']:>7.3f}s"
+            if "error" in step:
+                line += f"  {step['error']}"
+            lines.append(line)
+        return "\n".join(lines)
+
+    def command_tree_hash(self, guild: discord.abc.Snowflake) -> str:
+        """
+        Return a stable hash of the commands registered for a guild
+
+        PARAMETERS
+        ----------
+        guild : discord.abc.Snowflake
+            The guild the commands are registered to
+
+        RETURNS
+        -------
+        str
+            sha256 hexdigest of the command payload discord would receive
+        """
+        payload = sorted(
+            (
+                command.to_dict(self.tree)
+                for command in self.tree.get_commands(guild=guild)
+            ),
+            key=lambda command: (command.get("type", 1), command["name"]),
+        )
+        blob = json.dumps(
+            {"guild": guild.id, "commands": payload}, sort_keys=True, default=str
+        )
+        return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+    def _read_sync_record(self) -> dict:
+        try:
+            with open(self.sync_file, "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _write_sync_record(self, record: dict):
+        os.makedirs(os.path.dirname(self.sync_file), exist_ok=True)
+        with open(self.sync_file, "w") as f:
+            json.dump(record, f)
+
+    async def sync_commands(self, force: bool = False) -> bool:
+        """
+        Sync the command tree of every guild with discord,
+        but only for guilds whose tree changed since the last sync
+
+        PARAMETERS
+        ----------
+        force : bool
+            Sync even if the command tree is unchanged
+
+        RETURNS
+        -------
+        bool
+            True if any guild was synced, False if every sync was skipped
+        """
+        record = self._read_sync_record()
+        synced = await asyncio.gather(
+            *(self._sync_guild(guild, record, force) for guild in self.guild_objects())
+        )
+        self._write_sync_record(record)
+        return any(synced)
+
+    async def _sync_guild(self, guild: discord.Object, record: dict, force: bool):
+        tree_hash = self.command_tree_hash(guild)
+        previous = record.get(str(guild.id), {})
+        if not force and previous.get("hash") == tree_hash:
+            self.log.info(
+                "Command tree of %s unchanged, skipped sync (saved ~%.2fs)",
+                guild.id,
+                previous.get("duration", 0),
+            )
+            return False
+        start = time.perf_counter()
+        await self.tree.sync(guild=guild)
+        duration = time.perf_counter() - start
+        record[str(guild.id)] = {"hash": tree_hash, "duration": duration}
+        self.log.info("Synced command tree of %s in %.2fs", guild.id, duration)
+        return True
 
     async def on_ready(self):
-        self.setup_logging()
+        self.setup_logging()  # no-op once logging is set up
         for channel in self.get_all_channels():
-            if channel.name == self.config["broadcast_channel"]:
-                self.broadcast_channel = channel
+            if channel.name == self.guild_config(channel.guild.id)["broadcast_channel"]:
+                self.broadcast_channels[channel.guild.id] = channel
+        # Jobs need the channel and member caches, which are filled once ready.
+        # Overdue jobs run right away, later on_ready calls after reconnects do nothing
+        self.scheduler.start()
+
+    async def on_interaction(self, interaction: discord.Interaction):
+        if self.recorder is not None:
+            self.recorder.record_interaction(interaction)
+
+    async def on_raw_reaction_add(self, payload: discord.RawReactionActionEvent):
+        if self.recorder is not None:
+            self.recorder.record_reaction("ra", payload, self.cogs.values())
+
+    async def on_raw_reaction_remove(self, payload: discord.RawReactionActionEvent):
+        if self.recorder is not None:
+            self.recorder.record_reaction("rr", payload, self.cogs.values())
 
-    def is_member(self, id: int):
+    def is_member(self, id: discord.Member):
         """
         Check if the id is a member of the server
         """
         if id:
-            if self.broadcast_channel.permissions_for(id).administrator:
+            channel = self.broadcast_channels.get(id.guild.id)
+            if channel is None:
+                return False
+            if channel.permissions_for(id).administrator:
                 return True
-            elif self.broadcast_channel.permissions_for(id).manage_roles:
+            elif channel.permissions_for(id).manage_roles:
                 return True
         return False
 
@@ -1,14 +1,27 @@
 import os
 import discord
 import asyncio
+from datetime import datetime, timedelta
 from discord import app_commands
 from discord.ext import commands
-from discord.ext.commands import has_permissions
+
+import metrics
+from profiler import Profiler, MAX_PROFILE_SECONDS
 
 
 class AdminHandler(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        self.profiler = Profiler()
+        bot.scheduler.register("admin.timer", self.timer_expired)
+
+    async def cog_app_command_error(
+        self, interaction: discord.Interaction, error: app_commands.AppCommandError
+    ):
+        if isinstance(error, app_commands.MissingPermissions):
+            await interaction.response.send_message(
+                "Only administrators can use this command.", ephemeral=True
+            )
 
     async def get_all_extensions(
         self, interaction: discord.Interaction, module: str
@@ -24,7 +37,7 @@ class AdminHandler(commands.Cog):
         description="Load a module.",
     )
     @app_commands.autocomplete(module=get_all_extensions)
-    @has_permissions(administrator=True)
+    @app_commands.checks.has_permissions(administrator=True)
     async def load(self, interaction: discord.Interaction, module: str):
         try:
             await self.bot.load_extension(f"cogs.{module}")
@@ -40,7 +53,7 @@ class AdminHandler(commands.Cog):
         description="Unload a module.",
     )
     @app_commands.autocomplete(module=get_all_extensions)
-    @has_permissions(administrator=True)
+    @app_commands.checks.has_permissions(administrator=True)
     async def unload(self, interaction: discord.Interaction, module: str):
         try:
             await self.bot.unload_extension(f"cogs.{module}")
@@ -58,7 +71,7 @@ class AdminHandler(commands.Cog):
         description="Reload an extension.",
     )
     @app_commands.autocomplete(module=get_all_extensions)
-    @has_permissions(administrator=True)
+    @app_commands.checks.has_permissions(administrator=True)
     async def reload(self, interaction: discord.Interaction, module: str):
         try:
             await self.bot.reload_extension(f"cogs.{module}")
@@ -73,34 +86,177 @@ class AdminHandler(commands.Cog):
         name="sync",
         description="Sync commands.",
     )
-    @has_permissions(administrator=True)
-    async def sync_commands(self, interaction: discord.Interaction):
-        await self.bot.tree.sync(guild=discord.Object(id=self.bot.config["server_ID"]))
-        await interaction.response.send_message("Commands synced.", ephemeral=True)
+    @app_commands.checks.has_permissions(administrator=True)
+    async def sync_commands(
+        self, interaction: discord.Interaction, force: bool = False
+    ):
+        await interaction.response.defer(ephemeral=True)
+        if await self.bot.sync_commands(force=force):
+            await interaction.followup.send("Commands synced.", ephemeral=True)
+        else:
+            await interaction.followup.send(
+                "Commands unchanged, sync skipped.", ephemeral=True
+            )
+
+    @app_commands.command(
+        name="startup_report",
+        description="Show how long each extension took to load.",
+    )
+    @app_commands.checks.has_permissions(administrator=True)
+    async def startup_report(self, interaction: discord.Interaction):
+        await interaction.response.send_message(
+            f"```\n{self.bot.format_startup_report()}```", ephemeral=True
+        )
+
+    @app_commands.command(
+        name="memory",
+        description="Show the size of the bot caches.",
+    )
+    @app_commands.checks.has_permissions(administrator=True)
+    async def memory(self, interaction: discord.Interaction):
+        lines = [
+            f"{name:<10} {count:>8} {size / 1024:>10.1f} KiB"
+            for name, (count, size) in self.bot.memory_report().items()
+        ]
+        await interaction.response.send_message(
+            "```\n" + "\n".join(lines) + "```", ephemeral=True
+        )
+
+    @app_commands.command(
+        name="metrics",
+        description="Show command and operation latencies.",
+    )
+    @app_commands.checks.has_permissions(administrator=True)
+    async def metrics_summary(self, interaction: discord.Interaction):
+        await interaction.response.send_message(
+            f"```\n{metrics.summary()}```", ephemeral=True
+        )
+
+    @app_commands.command(
+        name="profile_start",
+        description="Start a cpu profile of the bot.",
+    )
+    @app_commands.choices(
+        mode=[
+            app_commands.Choice(name="sample", value="sample"),
+            app_commands.Choice(name="cprofile", value="cprofile"),
+        ]
+    )
+    @app_commands.checks.has_permissions(administrator=True)
+    async def profile_start(
+        self, interaction: discord.Interaction, mode: str = "sample"
+    ):
+        try:
+            self.profiler.start(mode)
+        except (RuntimeError, ValueError) as e:
+            await interaction.response.send_message(str(e), ephemeral=True)
+        else:
+            await interaction.response.send_message(
+                f"Started {mode} profile.", ephemeral=True
+            )
+
+    @app_commands.command(
+        name="profile_stop",
+        description="Stop the cpu profile and show the hottest functions.",
+    )
+    @app_commands.checks.has_permissions(administrator=True)
+    async def profile_stop(self, interaction: discord.Interaction, top: int = 15):
+        try:
+            path, summary = self.profiler.stop(top)
+        except RuntimeError as e:
+            await interaction.response.send_message(str(e), ephemeral=True)
+        else:
+            await interaction.response.send_message(
+                _profile_message(path, summary), ephemeral=True
+            )
+
+    @app_commands.command(
+        name="profile",
+        description="Profile the bot for a number of seconds.",
+    )
+    @app_commands.choices(
+        mode=[
+            app_commands.Choice(name="sample", value="sample"),
+            app_commands.Choice(name="cprofile", value="cprofile"),
+        ]
+    )
+    @app_commands.checks.has_permissions(administrator=True)
+    async def profile(
+        self,
+        interaction: discord.Interaction,
+        seconds: app_commands.Range[int, 1, MAX_PROFILE_SECONDS],
+        mode: str = "sample",
+        top: int = 15,
+    ):
+        await interaction.response.defer(ephemeral=True)
+        try:
+            path, summary = await self.profiler.profile_for(seconds, mode, top)
+        except (RuntimeError, ValueError) as e:
+            await interaction.followup.send(str(e), ephemeral=True)
+        else:
+            await interaction.followup.send(
+                _profile_message(path, summary), ephemeral=True
+            )
+
+    @app_commands.command(
+        name="memory_snapshot",
+        description="Take a tracemalloc snapshot, optionally diffed against the last one.",
+    )
+    @app_commands.checks.has_permissions(administrator=True)
+    async def memory_snapshot(
+        self, interaction: discord.Interaction, diff: bool = False, top: int = 15
+    ):
+        await interaction.response.defer(ephemeral=True)
+        path, summary = await asyncio.to_thread(self.profiler.take_snapshot, top, diff)
+        await interaction.followup.send(_profile_message(path, summary), ephemeral=True)
+
+    @app_commands.command(
+        name="memory_snapshot_stop",
+        description="Stop tracing memory allocations.",
+    )
+    @app_commands.checks.has_permissions(administrator=True)
+    async def memory_snapshot_stop(self, interaction: discord.Interaction):
+        self.profiler.stop_tracing()
+        await interaction.response.send_message(
+            "Stopped tracing memory.", ephemeral=True
+        )
 
     @app_commands.command(
         name="timer",
         description="Set a timer.",
     )
-    @has_permissions(administrator=True)
+    @app_commands.checks.has_permissions(administrator=True)
     async def timer(self, interaction: discord.Interaction, time: int):
+        self.bot.scheduler.schedule(
+            datetime.now() + timedelta(seconds=time),
+            "admin.timer",
+            channel_id=interaction.channel_id,
+            user_id=interaction.user.id,
+        )
         await interaction.response.send_message(
             f"Timer set for {time} seconds.", ephemeral=True
         )
-        await asyncio.sleep(time)
-        await interaction.followup.send("Timer expired.", ephemeral=True)
+
+    async def timer_expired(self, job):
+        channel = self.bot.get_channel(job.data["channel_id"])
+        if channel is not None:
+            await channel.send(f"<@{job.data['user_id']}> Timer expired.")
 
     @app_commands.command(
         name="reboot",
         description="Reboots the bot",
     )
-    @has_permissions(administrator=True)
+    @app_commands.checks.has_permissions(administrator=True)
     async def reboot(self, interaction: discord.Interaction):
         await interaction.response.send_message("Rebooting", ephemeral=True)
         await self.bot.close()
 
 
+def _profile_message(path: str, summary: str) -> str:
+    # Discord messages are limited to 2000 characters
+    header = f"Saved to `{path}`\n"
+    return header + "```\n" + summary[: 1990 - len(header) - 8] + "```"
+
+
 async def setup(bot):
-    await bot.add_cog(
-        AdminHandler(bot), guild=discord.Object(id=bot.config["server_ID"])
-    )
+    await bot.add_cog(AdminHandler(bot), guilds=bot.guild_objects())
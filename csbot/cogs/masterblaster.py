@@ -6,6 +6,7 @@ from discord.ext import commands
 from discord import app_commands, Embed
 from datetime import timedelta
 from dateutil import parser
+from metrics import timed
 
 MASTERBLASTER_URL = "https://app.masterblaster.gg/"
 PUBLIC_API = "api/external/v1/"
@@ -21,8 +22,12 @@ PLAYERS = "players/"
 class MasterblasterHandler(commands.Cog):
     def __init__(self, bot) -> None:
         self.bot = bot
-        loop = asyncio.get_event_loop()
-        asyncio.ensure_future(self.setup(), loop=loop)
+
+    async def cog_load(self):
+        """
+        Awaited by add_cog, runs concurrently with the other extensions' setup
+        """
+        await self.setup()
 
     async def setup(self):
         self.mb = MasterBlaster(os.getenv("MB_TOKEN"))
@@ -33,7 +38,7 @@ class MasterblasterHandler(commands.Cog):
     )
     async def get_members(self, interaction: discord.Interaction, org: str):
         await interaction.response.send_message("Getting members", ephemeral=False)
-        async with self.mb:
+        async with self.mb, timed("masterblaster.get_members"):
             organisation = await self.mb.get_org_by_name(org)
             members = await organisation.get_members()
             embed = Embed(title="Members", color=0x00FF00)
@@ -47,21 +52,21 @@ class MasterblasterHandler(commands.Cog):
     async def get_members_autocomplete(
         self, interaction: discord.Interaction, org: str
     ) -> list[app_commands.Choice[str]]:
-        async with self.mb:
+        async with self.mb, timed("masterblaster.get_members_autocomplete"):
             orgs = await self.mb.get_all_orgs()
             return [app_commands.Choice(name=org.name, value=org.name) for org in orgs]
 
     async def next_match_autocomplete_org(
         self, interaction: discord.Interaction, org: str
     ) -> list[app_commands.Choice[str]]:
-        async with self.mb:
+        async with self.mb, timed("masterblaster.next_match_autocomplete_org"):
             orgs = await self.mb.get_all_orgs()
             return [app_commands.Choice(name=org.name, value=org.name) for org in orgs]
 
     async def next_match_autocomplete_team(
         self, interaction: discord.Interaction, team: str
     ) -> list[app_commands.Choice[str]]:
-        async with self.mb:
+        async with self.mb, timed("masterblaster.next_match_autocomplete_team"):
             org = None
             try:
                 org = interaction.namespace["org"]
@@ -83,7 +88,7 @@ class MasterblasterHandler(commands.Cog):
         org=next_match_autocomplete_org, team=next_match_autocomplete_team
     )
     async def next_match(self, interaction: discord.Interaction, org: str, team: str):
-        async with self.mb:
+        async with self.mb, timed("masterblaster.next_match"):
             org = await self.mb.get_org_by_name(org)
             await asyncio.sleep(1)
             teams = await org.get_teams()
@@ -114,7 +119,7 @@ class MasterblasterHandler(commands.Cog):
         org=next_match_autocomplete_org, team=next_match_autocomplete_team
     )
     async def get_schedule(self, interaction: discord.Interaction, org: str, team: str):
-        async with self.mb:
+        async with self.mb, timed("masterblaster.get_schedule"):
             org = await self.mb.get_org_by_name(org)
             await asyncio.sleep(1)
             teams = await org.get_teams()
@@ -136,6 +141,4 @@ class MasterblasterHandler(commands.Cog):
 async def setup(bot: commands.Bot):
     if not os.getenv("MB_TOKEN"):
         raise LookupError("No Masterblaster token found")
-    await bot.add_cog(
-        MasterblasterHandler(bot), guild=discord.Object(id=bot.config["server_ID"])
-    )
+    await bot.add_cog(MasterblasterHandler(bot), guilds=bot.guild_objects())
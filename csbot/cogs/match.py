@@ -1,11 +1,21 @@
+import asyncio
 import discord
 from datetime import datetime, timedelta
 from discord import app_commands
 from discord.ext import commands
-from helperfunctions import DiscordString, load_state
+from helperfunctions import DiscordString
+from guildstate import GuildStates
 from csgo import get_active_duty
-from team import roll_teams
-from mapdict import MapDict
+import constants
+from team import roll_teams, map_fit
+from metrics import timed
+from veto import VetoState
+from vetopredict import MODELS, predict
+from render import MessageSections
+from matchhistory import MatchHistory, RESULTS
+from substitute import PlayerIndex, find_substitutes, repair_teams
+from constraints import Constraints, ConstraintError
+from league import partition_teams
 
 
 class Match:
@@ -21,38 +31,77 @@ class Match:
         self.status = "inactive"
 
 
-class MatchHandler(commands.Cog):
-    @load_state
-    def __init__(self, bot) -> None:
+class MatchState:
+    """
+    Match day state of one guild
+    """
+
+    weekdays = {
+        "Monday": 0,
+        "Tuesday": 1,
+        "Wednesday": 2,
+        "Thursday": 3,
+        "Friday": 4,
+        "Saturday": 5,
+        "Sunday": 6,
+    }
+
+    def __init__(self, bot, guild_id: int) -> None:
         self.bot = bot
-        self.players = {}
+        self.guild_id = guild_id
         self.participating_players = {}
         self.playday = "Wednesday"
-        self.weekdays = {
-            "Monday": 0,
-            "Tuesday": 1,
-            "Wednesday": 2,
-            "Thursday": 3,
-            "Friday": 4,
-            "Saturday": 5,
-            "Sunday": 6,
-        }
         self.set_next_playdate()
+        self.number_of_matches = 0
+        self.teams = None
         self.banned_maps = []
         self.picked_maps = []
         self.shared_banorder = []
-        self.available_maps = get_active_duty()
+        self.available_maps = list(get_active_duty())
+        self.veto_state = None
+        self.fit_lines = {}
+        self.fit_text = None
+        self.predictions = {}
+        self.recorded = set()
+        self.index = None
+        self.constraints = Constraints()
+        self.sections = MessageSections()
+        self.sections.section("teamlist", self._render_teamlist)
+        self.sections.section("private_banorders", self._render_private_banorders)
+        self.sections.section("shared_banorder", self._render_shared_banorder)
+        self.sections.section(
+            "banned_maps", lambda: f"Banned maps -> `{self.banned_maps}`\n"
+        )
+        self.sections.section(
+            "picked_maps", lambda: f"Picked maps -> `{self.picked_maps}`\n"
+        )
+        self.sections.section("team_fit", lambda: f"`{self.team_to_map_fit()}`")
         self.registration_message = None
         self.banorder_msg = None
+        self.league = False
         self.status = "ready"
         self.veto = "inactive"
 
+    @property
+    def players(self) -> dict:
+        return self.bot.players[self.guild_id]
+
     async def reset_state(self):
         self.veto = "inactive"
         self.teams = None
         self.banned_maps = []
         self.picked_maps = []
-        self.available_maps = get_active_duty()
+        self.available_maps = list(get_active_duty())
+        self.veto_state = None
+        self.fit_lines = {}
+        self.fit_text = None
+        self.predictions = {}
+        self.recorded = set()
+        self.index = None
+        # Availability is per match day, the other constraints stay
+        self.constraints.available = {}
+        self.sections.invalidate()
+        self.league = False
         self.status = "ready"
         self.participating_players = {}
         if self.registration_message:
@@ -70,6 +119,207 @@ class MatchHandler(commands.Cog):
             finally:
                 self.banorder_msg = None
 
+    def set_next_playdate(self):
+        days_in_week = len(self.weekdays.keys())
+        today = datetime.today()
+        days_to = self.weekdays[self.playday] - datetime.weekday(today)
+        if days_to < 0:  # we are past playday this week
+            days_to += days_in_week
+        self.date = today + timedelta(days_to)
+
+    def add_player(self, player):
+        if player.id in self.players:
+            self.participating_players[player.id] = self.players[player.id]
+            self.index = None
+
+    def remove_player(self, player):
+        try:
+            del self.participating_players[player.id]
+        except KeyError:
+            pass
+        else:
+            self.index = None
+
+    def player_index(self) -> PlayerIndex:
+        """
+        Index of the registered players, built again after registrations changed
+        """
+        if self.index is None:
+            self.index = PlayerIndex(
+                list(self.participating_players.values()), get_active_duty()
+            )
+        return self.index
+
+    def get_teamlist(self) -> str:
+        return self.sections["teamlist"]
+
+    def _render_teamlist(self) -> str:
+        teams = DiscordString("".join(team.get_info() for team in self.teams.values()))
+        return teams.to_code_block("arm")
+
+    def _render_private_banorders(self) -> dict:
+        return {
+            team_num: DiscordString(
+                f"Team {team_num}: {[player.display_name for player in team.players]}\nbanorder -> {team.get_banorder()}"
+            )
+            for team_num, team in self.teams.items()
+        }
+
+    def _render_shared_banorder(self) -> str:
+        self.shared_banorder = self.get_shared_banorder()
+        return f"Shared banorder: {DiscordString(f'{self.shared_banorder}').to_code_block('ml')}"
+
+    def start_veto(self):
+        """
+        Set up the shared banorder of the rolled teams over the available maps,
+        and the fit of every team to every map in the veto. Maps already banned or
+        picked are part of the veto state too, so they can still be restored.
+        """
+        maps = self.picked_maps + self.banned_maps + self.available_maps
+        self.veto_state = VetoState(
+            {team_id: team.map_preference for team_id, team in self.teams.items()},
+            maps,
+        )
+        for map in self.picked_maps + self.banned_maps:
+            self.veto_state.remove(map)
+        self.fit_lines = {}
+        for map, teams in map_fit(self.teams, maps).items():
+            line = f"{map}: "
+            for team, score in teams.items():
+                line += f"Team{team}[{score}] "
+            self.fit_lines[map] = line + "\n"
+        self.fit_text = None
+        self.predictions = {}
+        self.sections.invalidate()
+
+    def ban_map(self, map: str):
+        self.veto_state.remove(map)
+        self.available_maps.remove(map)
+        self.banned_maps.append(map)
+        self.sections.invalidate("shared_banorder", "banned_maps", "team_fit")
+
+    def pick_map(self, map: str):
+        self.veto_state.remove(map)
+        self.available_maps.remove(map)
+        self.picked_maps.append(map)
+        self.sections.invalidate("shared_banorder", "picked_maps", "team_fit")
+
+    def unban_map(self, map: str):
+        self.veto_state.restore(map)
+        self.banned_maps.remove(map)
+        self.available_maps.append(map)
+        self.sections.invalidate("shared_banorder", "banned_maps", "team_fit")
+
+    def unpick_map(self, map: str):
+        self.veto_state.restore(map)
+        self.picked_maps.remove(map)
+        self.available_maps.append(map)
+        self.sections.invalidate("shared_banorder", "picked_maps", "team_fit")
+
+    @timed("get_shared_banorder")
+    def get_shared_banorder(self):
+        if self.veto_state is None:
+            self.start_veto()
+        return self.veto_state.banorder()
+
+    async def predict_veto(self, our_turn: bool, model: str) -> tuple:
+        """
+        Probability of every available map being the one played, cached per veto state.
+        Runs in a thread so large map pools do not block the event loop.
+        """
+        key = (tuple(self.available_maps), our_turn, model)
+        if key not in self.predictions:
+            preferences = {
+                team_id: team.map_preference for team_id, team in self.teams.items()
+            }
+            self.predictions[key] = await asyncio.to_thread(
+                predict, preferences, list(self.available_maps), our_turn, model
+            )
+        return self.predictions[key]
+
+    def team_to_map_fit(self):
+        """
+        Fit of every team to the picked and available maps, one line per map.
+        The lines are formatted when the teams are rolled, a veto only reorders them.
+        """
+        if self.veto_state is None:
+            self.start_veto()
+        maps = (tuple(self.picked_maps), tuple(self.available_maps))
+        if self.fit_text is None or self.fit_text[0] != maps:
+            lines = [self.fit_lines[map] for map in self.picked_maps]
+            lines.extend(self.fit_lines[map] for map in self.available_maps)
+            self.fit_text = (maps, "".join(lines))
+        return self.fit_text[1]
+
+    def _get_banorder_info(self) -> dict:
+        """
+        Returns  dictionary with formatting:
+        'private_banorders': dict{teamID<int> : Banorder<DiscordString>),..} empty or more messages with teamID and their private banorder
+        'shared_banorder': <str> the shared banorder for all teams in the current veto
+        'banned_maps': <str> the currently banned maps in this veto
+        'picked_maps': <str> the currently picked maps in this veto
+        'team_fit': <str> the team score for each map picked or available in the veto
+        Sections are rendered again only after they were invalidated.
+        """
+        return {
+            name: self.sections[name]
+            for name in (
+                "private_banorders",
+                "shared_banorder",
+                "banned_maps",
+                "picked_maps",
+                "team_fit",
+            )
+        }
+
+    def update_banmsg(self):
+        if self.league:
+            # The teams of a league are posted on their own, and their fit to
+            # every map does not fit in one message
+            return DiscordString(
+                self.sections.join("shared_banorder", "banned_maps", "picked_maps")
+            )
+        return DiscordString(self.get_teamlist() + self.banorder())
+
+    def banorder(self) -> DiscordString:
+        match self.status:
+            case "open":
+                raise AttributeError("open")
+            case "closed":
+                if not self.teams:
+                    raise AttributeError("teams not rolled")
+                reply = DiscordString(
+                    self.sections.join(
+                        "shared_banorder", "banned_maps", "picked_maps", "team_fit"
+                    )
+                )
+            case "ready":
+                raise AttributeError("ready")
+            case _:
+                raise NameError()
+        return reply
+
+
+class MatchHandler(commands.Cog):
+    def __init__(self, bot) -> None:
+        self.bot = bot
+        self.states = GuildStates(lambda guild_id: MatchState(bot, guild_id))
+        self.histories = GuildStates(MatchHistory)
+        self.weekdays = MatchState.weekdays
+        bot.scheduler.register("match.close_registration", self.auto_close)
+        bot.scheduler.register("match.reminder", self.remind)
+
+    def state(self, guild_id: int) -> MatchState:
+        """
+        The match day state of a guild, created on the first event from the guild
+        """
+        return self.states[guild_id]
+
+    def get_registration_message(self, guild_id: int):
+        if guild_id not in self.states:
+            return None
+        return self.states[guild_id].registration_message
+
     @app_commands.command(
         name="start_registration_match",
         description="Send a message to start the registration process for a new match day.",
@@ -79,15 +329,123 @@ class MatchHandler(commands.Cog):
     ):
         if not self.bot.is_member(interaction.user):
             return
-        load_state(self)
-        await self.reset_state()
-        self.number_of_matches = int(number_of_matches)
+        state = self.state(interaction.guild_id)
+        await state.reset_state()
+        state.number_of_matches = int(number_of_matches)
+        config = self.bot.guild_config(interaction.guild_id)
+        team_role = config["team_role_ID"]
+        roll_at = state.date - timedelta(minutes=config.get("roll_minutes_before", 30))
         await interaction.response.send_message(
-            f"<@&{self.bot.config['team_role_ID']}> Please react to this message to sign up for the [{number_of_matches}] matches on {self.date.strftime('%A %d.%m.%Y at %H:%M')}. We roll teams at {(self.date-timedelta(hours=0, minutes=30)).strftime('%H:%M')}"
+            f"<@&{team_role}> Please react to this message to sign up for the [{number_of_matches}] matches on {state.date.strftime('%A %d.%m.%Y at %H:%M')}. We roll teams at {roll_at.strftime('%H:%M')}"
+        )
+        state.registration_message = await interaction.original_response()
+        await state.registration_message.add_reaction("✅")
+        state.status = "open"
+        self.schedule_match_day(interaction.guild_id, state)
+
+    def schedule_match_day(self, guild_id: int, state: MatchState):
+        """
+        Schedule rolling the teams and the reminder of the match day,
+        times that already passed are left out
+        """
+        config = self.bot.guild_config(guild_id)
+        roll_before = timedelta(minutes=config.get("roll_minutes_before", 30))
+        remind_before = timedelta(minutes=config.get("reminder_minutes_before", 10))
+        now = datetime.now()
+        scheduler = self.bot.scheduler
+        self.cancel_match_day(guild_id)
+        if state.date - roll_before > now:
+            message = state.registration_message
+            scheduler.schedule(
+                state.date - roll_before,
+                "match.close_registration",
+                key=guild_id,
+                grace=roll_before.total_seconds(),
+                guild_id=guild_id,
+                channel_id=message.channel.id,
+                message_id=message.id,
+                number_of_matches=state.number_of_matches,
+                date=state.date.isoformat(),
+            )
+        if state.date - remind_before > now:
+            scheduler.schedule(
+                state.date - remind_before,
+                "match.reminder",
+                key=guild_id,
+                grace=remind_before.total_seconds(),
+                guild_id=guild_id,
+            )
+
+    def cancel_match_day(self, guild_id: int, reminder: bool = True):
+        self.bot.scheduler.cancel_key("match.close_registration", guild_id)
+        if reminder:
+            self.bot.scheduler.cancel_key("match.reminder", guild_id)
+
+    async def restore_registration(self, state: MatchState, data: dict) -> bool:
+        """
+        Rebuild an open registration from its message, after a restart
+
+        RETURNS
+        -------
+        bool
+            True if the registration was restored
+        """
+        channel = self.bot.get_channel(data["channel_id"])
+        if channel is None:
+            return False
+        try:
+            message = await channel.fetch_message(data["message_id"])
+        except discord.errors.HTTPException as he:
+            self.bot.log.warning(he)
+            return False
+        state.registration_message = message
+        state.number_of_matches = data["number_of_matches"]
+        state.date = datetime.fromisoformat(data["date"])
+        for reaction in message.reactions:
+            if str(reaction.emoji) != "✅":
+                continue
+            async for user in reaction.users():
+                member = self.bot.get_member(user.id, state.guild_id)
+                if member and member.id != self.bot.user.id:
+                    state.add_player(member)
+        state.status = "open"
+        return True
+
+    async def auto_close(self, job):
+        guild_id = job.data["guild_id"]
+        state = self.state(guild_id)
+        if state.status == "ready" and state.registration_message is None:
+            if not await self.restore_registration(state, job.data):
+                return
+        channel = self.bot.broadcast_channels.get(guild_id)
+        try:
+            msg = self.roll(guild_id)
+        except ConstraintError as e:
+            msg = f"Could not roll the teams:\n{e}"
+        if msg is None or channel is None:
+            return
+        message = await channel.send(msg)
+        if state.status == "closed":
+            state.banorder_msg = message
+
+    async def remind(self, job):
+        guild_id = job.data["guild_id"]
+        state = self.state(guild_id)
+        channel = self.bot.broadcast_channels.get(guild_id)
+        if state.status == "ready" or channel is None:
+            return
+        if state.teams:
+            player_ids = [
+                player.id for team in state.teams.values() for player in team.players
+            ]
+        else:
+            player_ids = list(state.participating_players)
+        if not player_ids:
+            return
+        mentions = " ".join(f"<@{id}>" for id in dict.fromkeys(player_ids))
+        await channel.send(
+            f"{mentions} The match starts at {state.date.strftime('%H:%M')}."
         )
-        self.registration_message = await interaction.original_response()
-        await self.registration_message.add_reaction("✅")
-        self.status = "open"
 
     @app_commands.command(
         name="set_playday",
@@ -96,9 +454,12 @@ class MatchHandler(commands.Cog):
     async def playday(self, interaction: discord.Interaction, day: str):
         if not self.bot.is_member(interaction.user):
             return
+        state = self.state(interaction.guild_id)
         await interaction.response.send_message(f"Playday set to {day}")
-        self.playday = day
-        self.set_next_playdate()
+        state.playday = day
+        state.set_next_playdate()
+        if state.status == "open":
+            self.schedule_match_day(interaction.guild_id, state)
 
     @playday.autocomplete("day")
     async def playday_autocomplete(
@@ -115,9 +476,12 @@ class MatchHandler(commands.Cog):
     async def playtime(self, interaction: discord.Interaction, hour: int, minute: int):
         if not self.bot.is_member(interaction.user):
             return
-        self.date = self.date.replace(hour=hour, minute=minute)
+        state = self.state(interaction.guild_id)
+        state.date = state.date.replace(hour=hour, minute=minute)
+        if state.status == "open":
+            self.schedule_match_day(interaction.guild_id, state)
         await interaction.response.send_message(
-            f"Playtime set to {self.date.strftime('%H:%M')}"
+            f"Playtime set to {state.date.strftime('%H:%M')}"
         )
 
     @playtime.autocomplete("hour")
@@ -132,14 +496,6 @@ class MatchHandler(commands.Cog):
     ) -> list[app_commands.Choice[str]]:
         return [app_commands.Choice(name=str(i), value=str(i)) for i in range(0, 60, 5)]
 
-    def set_next_playdate(self):
-        days_in_week = len(self.weekdays.keys())
-        today = datetime.today()
-        days_to = self.weekdays[self.playday] - datetime.weekday(today)
-        if days_to < 0:  # we are past playday this week
-            days_to += days_in_week
-        self.date = today + timedelta(days_to)
-
     @app_commands.command(
         name="next_match",
         description="Get the date and time for the next match.",
@@ -147,50 +503,38 @@ class MatchHandler(commands.Cog):
     async def next_match(self, interaction: discord.Interaction):
         if not self.bot.is_member(interaction.user):
             return
+        state = self.state(interaction.guild_id)
         await interaction.response.send_message(
-            f"The next match is on {self.date.strftime('%A %d/%m/%Y at %H:%M')}"
+            f"The next match is on {state.date.strftime('%A %d/%m/%Y at %H:%M')}"
         )
 
-    def add_player(self, player):
-        self.participating_players[player.id] = self.players[player.id]
-
     @commands.Cog.listener()
     async def on_raw_reaction_add(self, reaction: discord.RawReactionActionEvent):
         if reaction.member.id == self.bot.user.id:
             return
-        if (
-            not self.registration_message
-            or reaction.message_id != self.registration_message.id
-        ):
+        message = self.get_registration_message(reaction.guild_id)
+        if not message or reaction.message_id != message.id:
             return
         self.bot.log.debug(
             f"{__class__.__qualname__} Raw reaction add from {reaction.user_id}"
         )
-        reaction.member = self.bot.get_member(reaction.user_id)
+        reaction.member = self.bot.get_member(reaction.user_id, reaction.guild_id)
         if not reaction.member:
             return
-        self.add_player(reaction.member)
-
-    def remove_player(self, player):
-        try:
-            del self.participating_players[player.id]
-        except KeyError:
-            pass
+        self.state(reaction.guild_id).add_player(reaction.member)
 
     @commands.Cog.listener()
     async def on_raw_reaction_remove(self, reaction: discord.RawReactionActionEvent):
         if reaction.user_id == self.bot.user.id:
             return
-        if (
-            not self.registration_message
-            or reaction.message_id != self.registration_message.id
-        ):
+        message = self.get_registration_message(reaction.guild_id)
+        if not message or reaction.message_id != message.id:
             return
         self.bot.log.debug(f"Raw reaction remove from: {reaction.user_id}")
-        reaction.member = self.bot.get_member(reaction.user_id)
+        reaction.member = self.bot.get_member(reaction.user_id, reaction.guild_id)
         if not reaction.member:
             return
-        self.remove_player(reaction.member)
+        self.state(reaction.guild_id).remove_player(reaction.member)
 
     @app_commands.command(
         name="end_registration_match",
@@ -199,154 +543,470 @@ class MatchHandler(commands.Cog):
     async def close_registration(self, interaction: discord.Interaction):
         if not self.bot.is_member(interaction.user):
             return
-        match self.status:
-            case "open":
-                self.status = "closed"
-                self.teams = roll_teams(
-                    self.participating_players, self.number_of_matches
+        try:
+            msg = self.roll(interaction.guild_id)
+        except ConstraintError as e:
+            await interaction.response.send_message(f"Could not roll the teams:\n{e}")
+            return
+        if msg is None:
+            await interaction.response.send_message(f"No open registration.")
+            return
+        await interaction.response.send_message(msg)
+        self.state(interaction.guild_id).banorder_msg = (
+            await interaction.original_response()
+        )
+
+    @app_commands.command(
+        name="roll_league",
+        description="End the registration and split everyone signed up into teams.",
+    )
+    async def roll_league(self, interaction: discord.Interaction, teams: int = None):
+        """
+        Teams is as many as the players signed up fill by default,
+        the players who have played the most sit out
+        """
+        if not self.bot.is_member(interaction.user):
+            return
+        state = self.state(interaction.guild_id)
+        if state.status != "open":
+            await interaction.response.send_message("No open registration.")
+            return
+        if not state.constraints.is_empty():
+            await interaction.response.send_message(
+                "League rolls do not follow the constraints, clear them with /clear_constraints first.",
+                ephemeral=True,
+            )
+            return
+        # The swaps run for up to constants.league_time_limit, off the event loop
+        await interaction.response.defer()
+        try:
+            rolled = await asyncio.to_thread(
+                partition_teams,
+                state.participating_players.copy(),
+                teams,
+                self.histories[interaction.guild_id].appearances.copy(),
+                self.bot.guild_config(interaction.guild_id).get("map_metric"),
+            )
+        except ValueError as e:
+            await interaction.followup.send(str(e))
+            return
+        # Another command may have closed the registration meanwhile
+        if state.status != "open":
+            await interaction.followup.send("No open registration.")
+            return
+        self.cancel_match_day(interaction.guild_id, reminder=False)
+        state.status = "closed"
+        state.league = True
+        state.teams = rolled
+        state.matches = [Match(state.date, team) for team in state.teams]
+        state.start_veto()
+        # Every team on its own line, in as few messages as fit the message limit
+        chunks = [""]
+        for team in rolled.values():
+            info = team.get_info()
+            if len(chunks[-1]) + len(info) > 1900:
+                chunks.append("")
+            chunks[-1] += info
+        reply = DiscordString(f"Registration closed, {len(rolled)} teams.")
+        await interaction.followup.send(
+            reply + DiscordString(chunks[0]).to_code_block("arm")
+        )
+        for chunk in chunks[1:]:
+            await interaction.followup.send(DiscordString(chunk).to_code_block("arm"))
+        state.banorder_msg = await interaction.followup.send(state.update_banmsg())
+
+    def roll(self, guild_id: int) -> str:
+        """
+        Close the open registration of a guild and roll the teams
+
+        RETURNS
+        -------
+        str
+            The team and banorder message, None if no registration is open
+
+        Raises ConstraintError if the constraints can not be met,
+        the registration stays open then.
+        """
+        state = self.state(guild_id)
+        if state.status != "open":
+            return None
+        teams = roll_teams(
+            state.participating_players,
+            state.number_of_matches,
+            self.histories[guild_id].appearances,
+            state.constraints,
+            self.bot.guild_config(guild_id).get("map_metric"),
+        )
+        self.cancel_match_day(guild_id, reminder=False)
+        state.status = "closed"
+        state.teams = teams
+        state.matches = [Match(state.date, team) for team in state.teams]
+        state.start_veto()
+        return "Registration closed." + state.update_banmsg()
+
+    @app_commands.command(
+        name="match_result",
+        description="Record the result of a rolled team's match.",
+    )
+    async def match_result(
+        self,
+        interaction: discord.Interaction,
+        team: int,
+        result: str,
+        maps: str = None,
+    ):
+        """
+        Maps are the picked maps of the veto unless given, separated by spaces
+        """
+        if not self.bot.is_member(interaction.user):
+            return
+        state = self.state(interaction.guild_id)
+        if not state.teams or team not in state.teams:
+            await interaction.response.send_message(
+                f"No rolled team {team}.", ephemeral=True
+            )
+            return
+        if result not in RESULTS:
+            await interaction.response.send_message(
+                f"Result must be one of {', '.join(RESULTS)}.", ephemeral=True
+            )
+            return
+        if team in state.recorded:
+            await interaction.response.send_message(
+                f"The match of team {team} is already recorded.", ephemeral=True
+            )
+            return
+        played = maps.split() if maps else list(state.picked_maps)
+        self.histories[interaction.guild_id].record(
+            state.date,
+            [player.id for player in state.teams[team].players],
+            played,
+            result,
+        )
+        state.recorded.add(team)
+        await interaction.response.send_message(
+            f"Recorded a {result} for team {team} on {', '.join(played) or 'no maps'}."
+        )
+
+    @app_commands.command(
+        name="substitute",
+        description="Find substitutes for a player who dropped out of a rolled team.",
+    )
+    async def substitute(
+        self,
+        interaction: discord.Interaction,
+        team: int,
+        dropped: discord.Member,
+        include_playing: bool = False,
+    ):
+        """
+        Players who play in another team are only candidates with include_playing
+        """
+        if not self.bot.is_member(interaction.user):
+            return
+        state = self.state(interaction.guild_id)
+        if not state.teams or team not in state.teams:
+            await interaction.response.send_message(
+                f"No rolled team {team}.", ephemeral=True
+            )
+            return
+        rolled = state.teams[team]
+        player = next((p for p in rolled.players if p.id == dropped.id), None)
+        if player is None:
+            await interaction.response.send_message(
+                f"{dropped.display_name} is not in team {team}.", ephemeral=True
+            )
+            return
+        teams_of = {}
+        for id, other in state.teams.items():
+            for p in other.players:
+                teams_of.setdefault(p.id, []).append(str(id))
+        candidates = find_substitutes(
+            rolled,
+            player,
+            list(state.participating_players.values()),
+            state.player_index(),
+            playing=() if include_playing else set(teams_of),
+        )
+        if not candidates:
+            reply = "No registered player can substitute."
+            if not include_playing:
+                reply = "No registered player who is not playing can substitute."
+            await interaction.response.send_message(reply, ephemeral=True)
+            return
+        reply = DiscordString(
+            f"Substitutes for {player.display_name} in team {team} "
+            f"[{rolled.overallcompatability}]:\n"
+        )
+        lines = []
+        for candidate, substituted, delta in candidates:
+            line = f"{candidate.display_name}: {delta:+.3f} [{substituted.overallcompatability}]"
+            if candidate.id in teams_of:
+                line += f" (team {', '.join(teams_of[candidate.id])})"
+            lines.append(line)
+        reply += DiscordString("\n".join(lines)).to_code_block()
+        await interaction.response.send_message(reply)
+
+    @app_commands.command(
+        name="repair_teams",
+        description="Update the rolled teams to the changed signups without rolling again.",
+    )
+    async def repair(self, interaction: discord.Interaction):
+        if not self.bot.is_member(interaction.user):
+            return
+        state = self.state(interaction.guild_id)
+        if state.status != "closed" or not state.teams:
+            await interaction.response.send_message("No rolled teams.", ephemeral=True)
+            return
+        state.teams, changes = repair_teams(
+            state.teams,
+            state.participating_players,
+            self.histories[interaction.guild_id].appearances,
+            self.bot.guild_config(interaction.guild_id).get("map_metric"),
+        )
+        if not changes:
+            await interaction.response.send_message(
+                "The teams are up to date.", ephemeral=True
+            )
+            return
+        state.matches = [Match(state.date, team) for team in state.teams]
+        state.start_veto()
+        lines = []
+        for team, out, substitute in changes:
+            if out and substitute:
+                lines.append(
+                    f"Team {team}: {out.display_name} -> {substitute.display_name}"
                 )
-                self.matches = [Match(self.date, team) for team in self.teams]
-                msg = "Registration closed."
-                msg += self.get_teamlist()
-                msg += self.banorder()
-                await interaction.response.send_message(msg)
-                self.banorder_msg = await interaction.original_response()
-            case _:
-                await interaction.response.send_message(f"No open registration.")
+            elif out:
+                lines.append(f"Team {team}: {out.display_name} left")
+            else:
+                lines.append(f"Team {team}: {substitute.display_name} joined")
+        await interaction.response.send_message(
+            "Teams repaired:" + DiscordString("\n".join(lines)).to_code_block()
+        )
+        if state.banorder_msg:
+            await state.banorder_msg.edit(content=state.update_banmsg())
 
     @app_commands.command(
-        name="cancel_registration_match",
-        description="Cancel the registration for the upcoming match.",
+        name="alternatives",
+        description="Show the other teams rolled for a match, or swap in one of them.",
     )
-    async def cancel_registration(self, interaction: discord.Interaction):
+    async def alternatives(
+        self, interaction: discord.Interaction, team: int, choice: int = None
+    ):
         if not self.bot.is_member(interaction.user):
             return
-        match self.status:
-            case "open":
-                await self.reset_state()
-        await interaction.response.send_message(f"Registration cancelled.")
+        state = self.state(interaction.guild_id)
+        if not state.teams or team not in state.teams:
+            await interaction.response.send_message(
+                f"No rolled team {team}.", ephemeral=True
+            )
+            return
+        current = state.teams[team]
+        if not current.alternatives:
+            await interaction.response.send_message(
+                f"No alternatives for team {team}.", ephemeral=True
+            )
+            return
+        if choice is None:
+            ids = {player.id for player in current.players}
+            lines = []
+            for number, alternative in enumerate(current.alternatives):
+                names = [
+                    player.display_name
+                    for player in alternative.players
+                    if player.id not in ids
+                ]
+                lines.append(
+                    f"{number}: [{alternative.overallcompatability}] with {', '.join(names)}"
+                )
+            reply = DiscordString(
+                f"Alternatives for team {team} [{current.overallcompatability}]:\n"
+            )
+            reply += DiscordString("\n".join(lines)).to_code_block()
+            await interaction.response.send_message(reply)
+            return
+        if not 0 <= choice < len(current.alternatives) or team in state.recorded:
+            await interaction.response.send_message(
+                f"No alternative {choice} for team {team}.", ephemeral=True
+            )
+            return
+        # The replaced team becomes an alternative, so the swap can be undone
+        chosen = current.alternatives[choice]
+        others = list(current.alternatives)
+        others[choice] = current
+        chosen.alternatives = sorted(
+            others, key=lambda alternative: alternative.overallcompatability
+        )
+        current.alternatives = []
+        state.teams[team] = chosen
+        state.matches = [Match(state.date, id) for id in state.teams]
+        state.start_veto()
+        await interaction.response.send_message(
+            f"Team {team} is now {', '.join(p.display_name for p in chosen.players)}."
+        )
+        if state.banorder_msg:
+            await state.banorder_msg.edit(content=state.update_banmsg())
 
-    def get_teamlist(self) -> str:
-        teams = DiscordString("")
-        for i, team in self.teams.items():
-            teams += team.get_info()
-        teams = teams.to_code_block("arm")
-        return teams
+    def check_constraints(self, state: MatchState) -> str:
+        """
+        The constraints, and whether they can be met by the players signed up
+        """
+        constraints = state.constraints
+        players = state.players
+        text = constraints.describe(
+            lambda id: players[id].display_name if id in players else str(id)
+        )
+        if state.participating_players:
+            try:
+                constraints.prepare(
+                    list(state.participating_players.values()),
+                    max(state.number_of_matches, 1),
+                    min(constants.team_size, len(state.participating_players)),
+                )
+            except ConstraintError as e:
+                text += f"\n\nNot possible with the players signed up:\n{e}"
+        return DiscordString(text).to_code_block()
 
-    def teams_private_banorder_copy(self):
-        preferences = MapDict()
-        for teamID, team in self.teams.items():
-            prefs = team.map_preference.copy()
-            preferences[teamID] = prefs
+    async def _pair_constraint(self, interaction, pairs: list, player, other):
+        if not self.bot.is_member(interaction.user):
+            return
+        state = self.state(interaction.guild_id)
+        if player.id == other.id:
+            await interaction.response.send_message(
+                "Pick two different players.", ephemeral=True
+            )
+            return
+        pairs.append((player.id, other.id))
+        await interaction.response.send_message(self.check_constraints(state))
 
-        return preferences
+    @app_commands.command(
+        name="constraint_together",
+        description="Roll two players into the same teams.",
+    )
+    async def constraint_together(
+        self,
+        interaction: discord.Interaction,
+        player: discord.Member,
+        other: discord.Member,
+    ):
+        state = self.state(interaction.guild_id)
+        await self._pair_constraint(
+            interaction, state.constraints.together, player, other
+        )
 
-    def shared_weighted_preference(self, private_preferences):
-        shared_preference = MapDict()
-        for map in get_active_duty():
-            shared_preference[map] = 0
-            for preference in private_preferences.values():
-                shared_preference[map] += preference[map]
+    @app_commands.command(
+        name="constraint_apart",
+        description="Never roll two players into the same team.",
+    )
+    async def constraint_apart(
+        self,
+        interaction: discord.Interaction,
+        player: discord.Member,
+        other: discord.Member,
+    ):
+        state = self.state(interaction.guild_id)
+        await self._pair_constraint(interaction, state.constraints.apart, player, other)
 
-        return shared_preference
+    @app_commands.command(
+        name="constraint_available",
+        description="Only roll a player into some teams, team numbers separated by spaces.",
+    )
+    async def constraint_available(
+        self, interaction: discord.Interaction, player: discord.Member, teams: str
+    ):
+        if not self.bot.is_member(interaction.user):
+            return
+        state = self.state(interaction.guild_id)
+        try:
+            numbers = {int(team) for team in teams.split()}
+        except ValueError:
+            await interaction.response.send_message(
+                "Teams must be numbers separated by spaces.", ephemeral=True
+            )
+            return
+        state.constraints.available[player.id] = numbers
+        await interaction.response.send_message(self.check_constraints(state))
 
-    def get_shared_banorder(self):
-        private_banorders = self.teams_private_banorder_copy()
-        for banorder in private_banorders.values():
-            banorder.remove_banned_maps(self.banned_maps)
-            banorder.remove_picked_maps(self.picked_maps)
-            banorder.amplify_most_wanted()
+    @app_commands.command(
+        name="constraint_limits",
+        description="Limit the IGLs per team and the rank spread of a team, leave out to remove.",
+    )
+    async def constraint_limits(
+        self,
+        interaction: discord.Interaction,
+        max_igls: int = None,
+        max_rank_spread: int = None,
+    ):
+        if not self.bot.is_member(interaction.user):
+            return
+        state = self.state(interaction.guild_id)
+        state.constraints.max_igls = max_igls
+        state.constraints.max_rank_spread = max_rank_spread
+        await interaction.response.send_message(self.check_constraints(state))
 
-        shared_banorder = self.shared_weighted_preference(
-            private_banorders
-        ).to_list_sorted()
+    @app_commands.command(
+        name="constraints",
+        description="Show the constraints on rolled teams.",
+    )
+    async def show_constraints(self, interaction: discord.Interaction):
+        if not self.bot.is_member(interaction.user):
+            return
+        state = self.state(interaction.guild_id)
+        await interaction.response.send_message(
+            self.check_constraints(state), ephemeral=True
+        )
 
-        return shared_banorder
+    @app_commands.command(
+        name="clear_constraints",
+        description="Remove every constraint on rolled teams.",
+    )
+    async def clear_constraints(self, interaction: discord.Interaction):
+        if not self.bot.is_member(interaction.user):
+            return
+        self.state(interaction.guild_id).constraints = Constraints()
+        await interaction.response.send_message("Constraints cleared.")
 
-    def team_to_map_fit(self):
-        scores = {}
-        for map in self.picked_maps:
-            scores[map] = {}
-            for id, team in self.teams.items():
-                scores[map][id] = 0
-                for player in team.players:
-                    scores[map][id] += player.maps[map]
-                try:
-                    scores[map][id] /= len(team.players)
-                except ZeroDivisionError:
-                    pass
-        for map in self.available_maps:
-            scores[map] = {}
-            for id, team in self.teams.items():
-                scores[map][id] = 0
-                for player in team.players:
-                    scores[map][id] += player.maps[map]
-                try:
-                    scores[map][id] /= len(team.players)
-                except ZeroDivisionError:
-                    pass
-        pprint = ""
-        for map, teams in scores.items():
-            pprint += f"{map}: "
-            for team, score in teams.items():
-                pprint += f"Team{team}[{score}] "
-            pprint += "\n"
-        return pprint
+    @match_result.autocomplete("result")
+    async def match_result_autocomplete(
+        self, interaction: discord.Interaction, result: str
+    ) -> list[app_commands.Choice[str]]:
+        return [app_commands.Choice(name=result, value=result) for result in RESULTS]
 
-    def _get_banorder_info(self) -> dict:
+    def start_season(self, guild_id: int):
         """
-        Returns  dictionary with formatting:
-        'private_banorders': dict{teamID<int> : Banorder<DiscordString>),..} empty or more messages with teamID and their private banorder
-        'shared_banorder': <DiscordString> empty or one message with shared banorder for  all teams in  current  veto
-        'banned_maps': <DiscordString> empty or one  message with currently banned maps  in this veto
-        'picked_maps': <DiscordString> empty or one  message with currently picked   in this veto
-        'team_fit':  <DiscordString> empty or one message with team score for each map picked in veto
+        Count the matches played from now on, rolls go by the matches of the season
         """
-        messages = {
-            "private_banorders": {},
-            "shared_banorder": "",
-            "banned_maps": "",
-            "picket_maps": "",
-        }
-        for team_num, team in self.teams.items():
-            messages["private_banorders"][team_num] = DiscordString(
-                f"Team {team_num}: {[player.display_name for player in team.players]}\nbanorder -> {team.get_banorder()}"
-            )
-        self.shared_banorder = self.get_shared_banorder()
-        messages["shared_banorder"] = DiscordString(f"{self.shared_banorder}")
-        messages["banned_maps"] = DiscordString(f"{[map for map in self.banned_maps]}")
-        messages["picked_maps"] = DiscordString(f"{[map for map in self.picked_maps]}")
-        messages["team_fit"] = DiscordString(f"{self.team_to_map_fit()}")
-        return messages
+        self.histories[guild_id].start_season(datetime.now())
 
-    def update_banmsg(self):
-        msg = DiscordString("")
-        msg += self.get_teamlist()
-        msg += self.banorder()
-        return msg
+    @app_commands.command(
+        name="match_history",
+        description="Show how much a player has played this season.",
+    )
+    async def match_history(
+        self, interaction: discord.Interaction, member: discord.Member = None
+    ):
+        if not self.bot.is_member(interaction.user):
+            return
+        member = member or interaction.user
+        history = self.histories[interaction.guild_id]
+        await interaction.response.send_message(
+            f"{member.display_name}: {history.summary(member.id)}", ephemeral=True
+        )
 
-    def banorder(self) -> DiscordString:
-        reply = DiscordString("")
-        match self.status:
+    @app_commands.command(
+        name="cancel_registration_match",
+        description="Cancel the registration for the upcoming match.",
+    )
+    async def cancel_registration(self, interaction: discord.Interaction):
+        if not self.bot.is_member(interaction.user):
+            return
+        state = self.state(interaction.guild_id)
+        match state.status:
             case "open":
-                raise AttributeError("open")
-            case "closed":
-                if not self.teams:
-                    raise AttributeError("teams not rolled")
-                banorder_info = self._get_banorder_info()
-                reply += f"Shared banorder: {banorder_info['shared_banorder'].to_code_block('ml')}"
-                reply += DiscordString(
-                    f"Banned maps -> {banorder_info['banned_maps'].to_code_inline()}\n"
-                )
-                reply += DiscordString(
-                    f"Picked maps -> {banorder_info['picked_maps'].to_code_inline()}\n"
-                )
-                reply += DiscordString(f"{banorder_info['team_fit'].to_code_inline()}")
-            case "ready":
-                raise AttributeError("ready")
-            case _:
-                raise NameError()
-        return reply
+                await state.reset_state()
+                self.cancel_match_day(interaction.guild_id)
+        await interaction.response.send_message(f"Registration cancelled.")
 
     @app_commands.command(
         name="pick",
@@ -355,17 +1015,20 @@ class MatchHandler(commands.Cog):
     async def pick(self, interaction: discord.Interaction, map: str):
         if not self.bot.is_member(interaction.user):
             return
-        if self.banorder_msg:
-            self.available_maps.remove(map)
-            self.picked_maps.append(map)
-            await self.banorder_msg.edit(content=self.update_banmsg())
+        state = self.state(interaction.guild_id)
+        if state.banorder_msg:
+            state.pick_map(map)
+            await state.banorder_msg.edit(content=state.update_banmsg())
             await interaction.response.send_message(f"Picked {map}", ephemeral=True)
         else:
             pass
 
     @pick.autocomplete("map")
     async def pick_autocomplete(self, interaction: discord.Interaction, map: str):
-        return [app_commands.Choice(name=map, value=map) for map in self.available_maps]
+        state = self.state(interaction.guild_id)
+        return [
+            app_commands.Choice(name=map, value=map) for map in state.available_maps
+        ]
 
     @app_commands.command(
         name="unpick",
@@ -374,17 +1037,18 @@ class MatchHandler(commands.Cog):
     async def unpick(self, interaction: discord.Interaction, map: str):
         if not self.bot.is_member(interaction.user):
             return
-        if self.banorder_msg:
-            self.picked_maps.remove(map)
-            self.available_maps.append(map)
-            await self.banorder_msg.edit(content=self.update_banmsg())
+        state = self.state(interaction.guild_id)
+        if state.banorder_msg:
+            state.unpick_map(map)
+            await state.banorder_msg.edit(content=state.update_banmsg())
             await interaction.response.send_message(f"Unpicked {map}", ephemeral=True)
         else:
             pass
 
     @unpick.autocomplete("map")
     async def unpick_autocomplete(self, interaction: discord.Interaction, map: str):
-        return [app_commands.Choice(name=map, value=map) for map in self.picked_maps]
+        state = self.state(interaction.guild_id)
+        return [app_commands.Choice(name=map, value=map) for map in state.picked_maps]
 
     @app_commands.command(
         name="ban",
@@ -393,10 +1057,10 @@ class MatchHandler(commands.Cog):
     async def ban(self, interaction: discord.Interaction, map: str):
         if not self.bot.is_member(interaction.user):
             return
-        if self.banorder_msg:
-            self.available_maps.remove(map)
-            self.banned_maps.append(map)
-            await self.banorder_msg.edit(content=self.update_banmsg())
+        state = self.state(interaction.guild_id)
+        if state.banorder_msg:
+            state.ban_map(map)
+            await state.banorder_msg.edit(content=state.update_banmsg())
             await interaction.response.send_message(f"Banned {map}", ephemeral=True)
         else:
             # TODO: log
@@ -406,7 +1070,67 @@ class MatchHandler(commands.Cog):
     async def ban_autocomplete(
         self, interaction: discord.Interaction, map: str
     ) -> list[app_commands.Choice[str]]:
-        return [app_commands.Choice(name=map, value=map) for map in self.available_maps]
+        state = self.state(interaction.guild_id)
+        return [
+            app_commands.Choice(name=map, value=map) for map in state.available_maps
+        ]
+
+    @app_commands.command(
+        name="veto_predict",
+        description="Predict which map the veto ends on.",
+    )
+    async def veto_predict(
+        self, interaction: discord.Interaction, model: str = None, first: str = None
+    ):
+        if not self.bot.is_member(interaction.user):
+            return
+        state = self.state(interaction.guild_id)
+        if state.veto_state is None:
+            await interaction.response.send_message("No veto running.", ephemeral=True)
+            return
+        if not state.available_maps:
+            await interaction.response.send_message(
+                "No maps left in the veto.", ephemeral=True
+            )
+            return
+        config = self.bot.guild_config(interaction.guild_id)
+        model = model or config.get("veto_model", "uniform")
+        first = first or config.get("veto_first", "us")
+        # Bans and picks alternate between the teams
+        actions = len(state.banned_maps) + len(state.picked_maps)
+        our_turn = (first == "us") == (actions % 2 == 0)
+        # Large map pools can take longer than discord waits for a response
+        await interaction.response.defer(ephemeral=True, thinking=True)
+        try:
+            outcome, method = await state.predict_veto(our_turn, model)
+        except ValueError as e:
+            await interaction.followup.send(str(e), ephemeral=True)
+            return
+        prediction = DiscordString(
+            "\n".join(
+                f"{map}: {probability:.1%}"
+                for map, probability in sorted(
+                    outcome.items(), key=lambda item: item[1], reverse=True
+                )
+            )
+        )
+        turn = "We" if our_turn else "They"
+        await interaction.followup.send(
+            f"{turn} ban next, {model} opponent ({method}):\n{prediction.to_code_block('ml')}",
+            ephemeral=True,
+        )
+
+    @veto_predict.autocomplete("model")
+    async def veto_predict_model_autocomplete(
+        self, interaction: discord.Interaction, model: str
+    ) -> list[app_commands.Choice[str]]:
+        return [app_commands.Choice(name=model, value=model) for model in MODELS]
+
+    @veto_predict.autocomplete("first")
+    async def veto_predict_first_autocomplete(
+        self, interaction: discord.Interaction, first: str
+    ) -> list[app_commands.Choice[str]]:
+        return [app_commands.Choice(name=side, value=side) for side in ("us", "them")]
 
     @app_commands.command(
         name="unban",
@@ -415,20 +1139,152 @@ class MatchHandler(commands.Cog):
     async def unban(self, interaction: discord.Interaction, map: str):
         if not self.bot.is_member(interaction.user):
             return
-        if self.banorder_msg:
-            self.banned_maps.remove(map)
-            self.available_maps.append(map)
-            await self.banorder_msg.edit(content=self.update_banmsg())
+        state = self.state(interaction.guild_id)
+        if state.banorder_msg:
+            state.unban_map(map)
+            await state.banorder_msg.edit(content=state.update_banmsg())
             await interaction.response.send_message(f"Unbanned {map}", ephemeral=True)
         else:
             pass
 
     @unban.autocomplete("map")
     async def unban_autocomplete(self, interaction: discord.Interaction, map: str):
-        return [app_commands.Choice(name=map, value=map) for map in self.banned_maps]
+        state = self.state(interaction.guild_id)
+        return [app_commands.Choice(name=map, value=map) for map in state.banned_maps]
 
 
 async def setup(bot):
-    await bot.add_cog(
-        MatchHandler(bot), guild=discord.Object(id=bot.config["server_ID"])
+    await bot.add_cog(MatchHandler(bot), guilds=bot.guild_objects())
+
+
+### TESTS
+
+
+def _rolled_match_day(tmp_path, monkeypatch, players=14):
+    """
+    A guild with players signed up for a match day, for the tests below
+    """
+    import os
+    import random
+    import cachetools.keys
+    import csgo
+    import fakediscord
+    from loadtest import MAP_POOL
+    from player import Player
+
+    monkeypatch.setenv("HOME", str(tmp_path))
+    monkeypatch.setitem(csgo.get_active_duty.cache, cachetools.keys.hashkey(), MAP_POOL)
+    random.seed(5)
+    guild = fakediscord.FakeGuild()
+    config = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "..", "config.json"
     )
+    bot = fakediscord.FakeBot(guild, config)
+    admin = guild.add_member("admin", admin=True)
+    for i in range(players):
+        member = guild.add_member(f"p{i}")
+        player = Player(member.id, member.name, member.name)
+        player.rank = random.randint(1000, 20000)
+        player.update_maps(random.sample(MAP_POOL, k=len(MAP_POOL)))
+        bot.players[guild.id][member.id] = player
+    return bot, admin
+
+
+async def _veto_then(bot, admin, change: str, signups=None, **options):
+    """
+    Roll the teams, ban a map, change the teams with a command and unban the map,
+    signups(state) changes the signups before the command
+    """
+    from fakediscord import FakeInteraction, invoke
+
+    await setup(bot)
+    cog = bot.get_cog("MatchHandler")
+    guild = bot.guild
+    await invoke(cog, "start_registration_match", FakeInteraction(guild, admin))
+    state = cog.state(guild.id)
+    for member in list(guild.members.values()):
+        state.add_player(member)
+    await invoke(cog, "end_registration_match", FakeInteraction(guild, admin))
+    banned = state.available_maps[0]
+    await invoke(cog, "ban", FakeInteraction(guild, admin), map=banned)
+    if signups is not None:
+        signups(state)
+    await invoke(cog, change, FakeInteraction(guild, admin), **options)
+    await invoke(cog, "unban", FakeInteraction(guild, admin), map=banned)
+    await bot.close()
+    return state, banned
+
+
+def test_unban_after_swapping_an_alternative(tmp_path, monkeypatch):
+    bot, admin = _rolled_match_day(tmp_path, monkeypatch)
+    state, banned = asyncio.run(
+        _veto_then(bot, admin, "alternatives", team=0, choice=0)
+    )
+    assert banned in state.available_maps and not state.banned_maps
+    assert sorted(state.veto_state.banorder()) == sorted(state.available_maps)
+    assert "Banned maps -> `[]`" in state.banorder_msg.content
+
+
+def test_unban_after_repairing_the_teams(tmp_path, monkeypatch):
+    def drop(state):
+        state.remove_player(state.teams[0].players[0])
+
+    bot, admin = _rolled_match_day(tmp_path, monkeypatch)
+    state, banned = asyncio.run(_veto_then(bot, admin, "repair_teams", signups=drop))
+    assert banned in state.available_maps and not state.banned_maps
+    assert sorted(state.veto_state.banorder()) == sorted(state.available_maps)
+
+
+def test_playday_and_playtime_move_the_scheduled_roll(tmp_path, monkeypatch):
+    from datetime import timedelta
+    from fakediscord import FakeInteraction, invoke
+
+    bot, admin = _rolled_match_day(tmp_path, monkeypatch)
+    tomorrow = (datetime.now() + timedelta(days=1)).strftime("%A")
+
+    async def run():
+        await setup(bot)
+        cog = bot.get_cog("MatchHandler")
+        guild = bot.guild
+        await invoke(cog, "start_registration_match", FakeInteraction(guild, admin))
+        await invoke(cog, "set_playday", FakeInteraction(guild, admin), day=tomorrow)
+        await invoke(
+            cog, "set_playtime", FakeInteraction(guild, admin), hour=20, minute=0
+        )
+        jobs = bot.scheduler.pending()
+        await bot.close()
+        return cog.state(guild.id), jobs
+
+    state, jobs = asyncio.run(run())
+    assert state.date.strftime("%A %H:%M") == f"{tomorrow} 20:00"
+    roll, remind = (datetime.fromtimestamp(job.when) for job in jobs)
+    assert roll == state.date - timedelta(minutes=30)
+    assert remind == state.date - timedelta(minutes=10)
+
+
+def test_roll_league_refuses_constraints(tmp_path, monkeypatch):
+    from fakediscord import FakeInteraction, invoke
+
+    bot, admin = _rolled_match_day(tmp_path, monkeypatch, players=20)
+
+    async def run():
+        await setup(bot)
+        cog = bot.get_cog("MatchHandler")
+        guild = bot.guild
+        await invoke(cog, "start_registration_match", FakeInteraction(guild, admin))
+        state = cog.state(guild.id)
+        for member in list(guild.members.values()):
+            state.add_player(member)
+        state.constraints.max_igls = 1
+        refused = FakeInteraction(guild, admin)
+        await invoke(cog, "roll_league", refused)
+        await invoke(cog, "clear_constraints", FakeInteraction(guild, admin))
+        rolled = FakeInteraction(guild, admin)
+        await invoke(cog, "roll_league", rolled, teams=4)
+        await bot.close()
+        return state, refused, rolled
+
+    state, refused, rolled = asyncio.run(run())
+    assert refused.message.ephemeral and "/clear_constraints" in refused.message.content
+    assert state.league and len(state.teams) == 4
+    assert rolled.followup.messages[0].content.startswith("Registration closed, 4")
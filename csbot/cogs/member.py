@@ -1,27 +1,29 @@
+import io
 import discord
-import pickle
+from datetime import datetime
 from discord import app_commands
 from discord.ext import commands
 from constants import ranks
 from player import Player
-from helperfunctions import load_state, persist_state
+from roster import import_ranks, MAX_IMPORT_BYTES
 from csgo import get_active_duty
-from pathlib import Path
 
 __all__ = ["MemberHandler"]
 
 
 class MemberHandler(commands.Cog):
-    @load_state
     def __init__(self, bot):
         self.bot = bot
-        self.players = {}
-        self.registration_message = None
+        self.registration_messages = {}
 
-    def store_state(self):
-        # TODO: set this up in config, not hardcoded
-        with open(f"{Path.home()}/.csbot/state", "wb") as f:
-            pickle.dump(self.players, f)
+    def get_registration_message(self, guild_id: int):
+        return self.registration_messages.get(guild_id)
+
+    def team_role(self, guild_id: int) -> discord.Object:
+        return discord.Object(id=self.bot.guild_config(guild_id)["team_role_ID"])
+
+    def store_state(self, guild_id: int):
+        self.bot.players.save(guild_id)
 
     @app_commands.command(
         name="start_registration_season",
@@ -30,28 +32,32 @@ class MemberHandler(commands.Cog):
     async def start_registration(self, interaction: discord.Interaction):
         if not self.bot.is_member(interaction.user):
             return
-        if self.registration_message:
+        if self.get_registration_message(interaction.guild_id):
             return
-        await self.reset_state()
+        await self.reset_state(interaction.guild_id)
+        matches = self.bot.get_cog("MatchHandler")
+        if matches is not None:
+            matches.start_season(interaction.guild_id)
         await interaction.response.send_message(
             "@everyone Welcome to a new season of bedriftsligaen! Please react to this message to sign up."
         )
-        self.registration_message = await interaction.original_response()
-        await self.registration_message.add_reaction("✅")
+        message = await interaction.original_response()
+        self.registration_messages[interaction.guild_id] = message
+        await message.add_reaction("✅")
 
-    async def reset_state(self):
-        if self.registration_message:
-            await self.registration_message.delete()
-            self.registration_message = None
-        for player_id in self.players:
-            member = self.bot.get_member(player_id)
+    async def reset_state(self, guild_id: int):
+        message = self.registration_messages.pop(guild_id, None)
+        if message:
+            await message.delete()
+        for player_id in self.bot.players[guild_id]:
+            member = self.bot.get_member(player_id, guild_id)
             if member:
                 await member.remove_roles(
-                    discord.Object(id=self.bot.config["team_role_ID"]),
+                    self.team_role(guild_id),
                     reason="Registration",
                 )
-        self.players = {}
-        self.store_state()
+        self.bot.players[guild_id] = {}
+        self.store_state(guild_id)
 
     @app_commands.command(
         name="cancel_registration_season",
@@ -60,9 +66,9 @@ class MemberHandler(commands.Cog):
     async def cancel_registration(self, interaction: discord.Interaction):
         if not self.bot.is_member(interaction.user):
             return
-        if not self.registration_message:
+        if not self.get_registration_message(interaction.guild_id):
             return
-        await self.reset_state()
+        await self.reset_state(interaction.guild_id)
         await interaction.response.send_message(
             "Registration cancelled.", ephemeral=True
         )
@@ -74,45 +80,45 @@ class MemberHandler(commands.Cog):
     async def end_registration(self, interaction: discord.Interaction):
         if not self.bot.is_member(interaction.user):
             return
-        if not self.registration_message:
+        message = self.registration_messages.pop(interaction.guild_id, None)
+        if not message:
             return
-        await self.registration_message.edit(content="Registration is now closed.")
-        self.registration_message = None
+        await message.edit(content="Registration is now closed.")
         await interaction.response.send_message("Registration closed.", ephemeral=True)
 
-    @persist_state
     async def add_member(self, member):
         await member.add_roles(
-            discord.Object(id=self.bot.config["team_role_ID"]),
+            self.team_role(member.guild.id),
             reason="Registration",
         )
-        self.players[member.id] = Player(member.id, member.name, member.display_name)
+        self.bot.players[member.guild.id][member.id] = Player(
+            member.id, member.name, member.display_name
+        )
         await member.send(f"You are now registered as a member of the team.")
+        self.store_state(member.guild.id)
 
-    @persist_state
     async def remove_member(self, member):
         await member.remove_roles(
-            discord.Object(id=self.bot.config["team_role_ID"]),
+            self.team_role(member.guild.id),
             reason="Registration",
         )
         try:
-            del self.players[member.id]
+            del self.bot.players[member.guild.id][member.id]
         except KeyError:
             pass
         await member.send(
             "You have been removed from the member list. Please react to the registration message to rejoin."
         )
+        self.store_state(member.guild.id)
 
     @commands.Cog.listener()
     async def on_raw_reaction_add(self, reaction: discord.RawReactionActionEvent):
         if reaction.member.id == self.bot.user.id:
             return
-        if (
-            not self.registration_message
-            or reaction.message_id != self.registration_message.id
-        ):
+        message = self.get_registration_message(reaction.guild_id)
+        if not message or reaction.message_id != message.id:
             return
-        member = self.bot.get_member(reaction.user_id)
+        member = self.bot.get_member(reaction.user_id, reaction.guild_id)
         self.bot.log.debug(f"{__class__.__qualname__}: Raw reaction from {member.name}")
         if not reaction.member:
             return
@@ -122,12 +128,10 @@ class MemberHandler(commands.Cog):
     async def on_raw_reaction_remove(self, reaction: discord.RawReactionActionEvent):
         if reaction.user_id == self.bot.user.id:
             return
-        if (
-            not self.registration_message
-            or reaction.message_id != self.registration_message.id
-        ):
+        message = self.get_registration_message(reaction.guild_id)
+        if not message or reaction.message_id != message.id:
             return
-        member = self.bot.get_member(reaction.user_id)
+        member = self.bot.get_member(reaction.user_id, reaction.guild_id)
         self.bot.log.debug("Raw reaction remove from: %s", member.name)
         if not reaction.member:
             return
@@ -142,7 +146,7 @@ class MemberHandler(commands.Cog):
     ):
         if not self.bot.is_member(interaction.user):
             return
-        member = self.bot.get_member(int(member_id))
+        member = self.bot.get_member(int(member_id), interaction.guild_id)
         await self.add_member(member)
         await interaction.response.send_message(
             f"Added {member.name} to the member list."
@@ -157,7 +161,7 @@ class MemberHandler(commands.Cog):
     ):
         if not self.bot.is_member(interaction.user):
             return
-        member = self.bot.get_member(int(member_id))
+        member = self.bot.get_member(int(member_id), interaction.guild_id)
         await self.remove_member(member)
         await interaction.response.send_message(
             f"Removed {member.name} from the member list."
@@ -171,7 +175,7 @@ class MemberHandler(commands.Cog):
         if not self.bot.is_member(interaction.user):
             return
         embed = discord.Embed(title="Players", color=0x00FF00)
-        for player in self.players.values():
+        for player in self.bot.players[interaction.guild_id].values():
             embed.add_field(
                 name=f"{player.title}({player.rank}) `{player.name}`",
                 value=player.map_order(),
@@ -196,7 +200,8 @@ class MemberHandler(commands.Cog):
     ):
         if not self.bot.is_member(interaction.user):
             return
-        if interaction.user.id not in self.players:
+        players = self.bot.players[interaction.guild_id]
+        if interaction.user.id not in players:
             await interaction.response.send_message(
                 "You need to be a team member to set your map preferences."
             )
@@ -217,8 +222,8 @@ class MemberHandler(commands.Cog):
                     content="Please select maps from the active duty pool."
                 )
                 return
-        self.players[interaction.user.id].update_maps(choices.content.split(" ")[1:])
-        self.store_state()
+        players[interaction.user.id].update_maps(choices.content.split(" ")[1:])
+        self.store_state(interaction.guild_id)
 
     @add_maps.autocomplete("m1")
     @add_maps.autocomplete("m2")
@@ -255,14 +260,15 @@ class MemberHandler(commands.Cog):
         """
         if not self.bot.is_member(interaction.user):
             return
-        if interaction.user.id not in self.players:
+        players = self.bot.players[interaction.guild_id]
+        if interaction.user.id not in players:
             await interaction.response.send_message(
                 "You need to be a member to set your rank."
             )
             return
-        self.players[interaction.user.id].set_rank(int(rank))
+        players[interaction.user.id].set_rank(int(rank))
         await interaction.response.send_message(f"Rank set to {rank}")
-        self.store_state()
+        self.store_state(interaction.guild_id)
 
     @set_rank.autocomplete("rank")
     async def set_rank_autocomplete(
@@ -279,6 +285,89 @@ class MemberHandler(commands.Cog):
             if str(rank_value).startswith(rank)
         ]
 
+    @app_commands.command(
+        name="rank_history",
+        description="Show how a player's rank has changed.",
+    )
+    async def rank_history(
+        self, interaction: discord.Interaction, member: discord.Member = None
+    ):
+        if not self.bot.is_member(interaction.user):
+            return
+        member = member or interaction.user
+        player = self.bot.players[interaction.guild_id].get(member.id)
+        if player is None:
+            await interaction.response.send_message(
+                f"{member.display_name} is not a team member.", ephemeral=True
+            )
+            return
+        history = player.rank_history
+        if not history:
+            await interaction.response.send_message(
+                f"{player.name} is rank {player.rank} ({player.title}), no rank changes recorded.",
+                ephemeral=True,
+            )
+            return
+        first = datetime.fromtimestamp(history.timestamps[0]).strftime("%d.%m.%Y")
+        await interaction.response.send_message(
+            f"{player.name} is rank {player.rank} ({player.title})\n"
+            f"Recent average {history.recent_average():.0f}, volatility {history.volatility():.0f}, "
+            f"trend {history.trend() * 30:+.0f} per 30 days\n"
+            f"`{history.sparkline()}` {len(history)} changes since {first}",
+            ephemeral=True,
+        )
+
+    @app_commands.command(
+        name="import_ranks",
+        description="Set the ranks of many players from a csv of player,rank.",
+    )
+    async def import_ranks_command(
+        self,
+        interaction: discord.Interaction,
+        file: discord.Attachment = None,
+        path: str = None,
+    ):
+        """
+        Import ranks from an uploaded csv file, or a file on the bot's host for the owner.
+        All rows are applied, or none if a row is invalid, and the players are stored once.
+        """
+        if not self.bot.is_member(interaction.user):
+            return
+        players = self.bot.players[interaction.guild_id]
+        if file is not None:
+            if file.size > MAX_IMPORT_BYTES:
+                await interaction.response.send_message(
+                    f"The csv can be at most {MAX_IMPORT_BYTES // 1024} KiB.",
+                    ephemeral=True,
+                )
+                return
+            await interaction.response.defer(ephemeral=True)
+            content = (await file.read()).decode("utf-8-sig")
+            result = import_ranks(players, io.StringIO(content, newline=""))
+        elif path is not None:
+            if str(interaction.user.id) != str(self.bot.config["owner_ID"]):
+                await interaction.response.send_message(
+                    "Only the owner can import from a local file.", ephemeral=True
+                )
+                return
+            await interaction.response.defer(ephemeral=True)
+            try:
+                with open(path, "r", newline="", encoding="utf-8-sig") as f:
+                    result = import_ranks(players, f)
+            except OSError as e:
+                await interaction.followup.send(
+                    f"Could not read {path}: {e.strerror}", ephemeral=True
+                )
+                return
+        else:
+            await interaction.response.send_message(
+                "Attach a csv file or give a path.", ephemeral=True
+            )
+            return
+        if result.updated:
+            self.store_state(interaction.guild_id)
+        await interaction.followup.send(result.summary()[:2000], ephemeral=True)
+
     @app_commands.command(
         name="link-steam",
         description="Link your steam account.",
@@ -289,20 +378,23 @@ class MemberHandler(commands.Cog):
         """
         if not self.bot.is_member(interaction.user):
             return
-        if interaction.user.id not in self.players:
+        players = self.bot.players[interaction.guild_id]
+        if interaction.user.id not in players:
             await interaction.response.send_message(
                 "You need to be a team member to link your steam account."
             )
             return
-        self.players[interaction.user.id].set_steam_id(steam_id)
+        try:
+            players[interaction.user.id].set_steam_id(steam_id)
+        except ValueError as e:
+            await interaction.response.send_message(str(e), ephemeral=True)
+            return
         await interaction.response.send_message(f"Steam account linked to {steam_id}")
-        self.store_state()
+        self.store_state(interaction.guild_id)
 
 
 async def setup(bot):
     """
     :meta private:
     """
-    await bot.add_cog(
-        MemberHandler(bot), guild=discord.Object(id=bot.config["server_ID"])
-    )
+    await bot.add_cog(MemberHandler(bot), guilds=bot.guild_objects())
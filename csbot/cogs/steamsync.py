@@ -0,0 +1,91 @@
+import os
+import asyncio
+import aiohttp
+import discord
+from discord import app_commands
+from discord.ext import commands, tasks
+from steam import SteamClient, SteamError
+
+
+class SteamSync(commands.Cog):
+    """
+    Keeps the steam profiles of linked players up to date.
+    Needs STEAM_API_KEYS in the environment, a comma separated list of api keys.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.client = None
+        keys = [key.strip() for key in os.getenv("STEAM_API_KEYS", "").split(",")]
+        if any(keys):
+            self.client = SteamClient(
+                [key for key in keys if key],
+                rate=bot.config.get("steam_rate", 1.0),
+            )
+
+    async def cog_load(self):
+        if self.client is None:
+            self.bot.log.warning("STEAM_API_KEYS is not set, steam sync is disabled")
+            return
+        self.refresh.change_interval(
+            hours=self.bot.config.get("steam_refresh_hours", 6)
+        )
+        self.refresh.start()
+
+    async def cog_unload(self):
+        self.refresh.cancel()
+        if self.client is not None:
+            await self.client.close()
+
+    async def sync_guild(self, guild_id: int) -> int:
+        """
+        Refresh the linked players of a guild and store them once
+        """
+        updated = await self.client.sync_players(self.bot.players[guild_id])
+        if updated:
+            self.bot.players.save(guild_id)
+        return updated
+
+    @tasks.loop(hours=6)
+    async def refresh(self):
+        for guild_id in self.bot.guild_ids():
+            try:
+                updated = await self.sync_guild(guild_id)
+            except (SteamError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self.bot.log.warning("Steam sync of %s failed: %s", guild_id, e)
+            else:
+                self.bot.log.info(
+                    "Steam sync updated %s players of %s", updated, guild_id
+                )
+
+    @refresh.before_loop
+    async def before_refresh(self):
+        await self.bot.wait_until_ready()
+
+    @app_commands.command(
+        name="steam_sync",
+        description="Refresh the linked steam accounts now.",
+    )
+    async def steam_sync(self, interaction: discord.Interaction):
+        if not self.bot.is_member(interaction.user):
+            return
+        if self.client is None:
+            await interaction.response.send_message(
+                "No steam api key configured.", ephemeral=True
+            )
+            return
+        await interaction.response.defer(ephemeral=True)
+        requests = self.client.requests
+        try:
+            updated = await self.sync_guild(interaction.guild_id)
+        except (SteamError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            await interaction.followup.send(f"Steam sync failed: {e}", ephemeral=True)
+            return
+        await interaction.followup.send(
+            f"Updated {updated} players with {self.client.requests - requests} requests.",
+            ephemeral=True,
+        )
+
+
+async def setup(bot):
+    await bot.add_cog(SteamSync(bot), guilds=bot.guild_objects())
@@ -24,8 +24,24 @@ ranks = {
     15500: "Supreme Master First Class",
     18000: "Global Elite",
 }
+# Rank thresholds and their titles in ascending order, for binary search
+rank_thresholds = sorted(ranks)
+rank_titles = [ranks[rank] for rank in rank_thresholds]
 
 # Default team size for competitive cs2 is 5
 team_size = 5
 # Set limit for amount of times rolling for an optimal team
 team_roll_limit = 100
+# How much a player's recent average rating counts against the current rating
+# when balancing teams, 0 uses the current rating only and 1 the recent average only
+rank_form_weight = 0
+# Distance between map preferences teams are scored by, see distances.py,
+# overridden by "map_metric" in config.json
+map_metric = "footrule"
+# Alternative teams kept per match, and how many players they must differ in
+alternatives = 5
+alternative_min_changes = 2
+# Seconds a league partition spends swapping players between teams
+league_time_limit = 2
+# Average rank a league team may move away from the others to even out map scores
+league_rank_slack = 50
@@ -0,0 +1,255 @@
+"""
+Constraints on rolled teams.
+
+Players who must play together are merged into groups with a union-find, and every
+constraint is checked on the groups before any team is rolled, so contradicting
+constraints are reported right away. Teams are then built from groups by a depth
+first search that only tries groups that fit the team so far, and only continues
+while the remaining groups can still fill the team.
+"""
+
+import random
+
+
+class ConstraintError(Exception):
+    pass
+
+
+# Search steps per team before giving up on finding one that satisfies the constraints
+SEARCH_LIMIT = 10_000
+
+
+class _Group:
+    def __init__(self, members: list, matches: set):
+        self.members = members
+        self.size = len(members)
+        self.igls = sum(1 for player in members if player.igl)
+        self.low = min(player.rank for player in members)
+        self.high = max(player.rank for player in members)
+        self.matches = matches
+        self.apart = set()
+
+    def played(self) -> float:
+        return sum(player.matches for player in self.members) / self.size
+
+    def names(self) -> str:
+        return ", ".join(player.display_name for player in self.members)
+
+
+def _reachable(sizes) -> int:
+    """
+    Bitset of the team sizes that some of the groups add up to
+    """
+    reachable = 1
+    for size in sizes:
+        reachable |= reachable << size
+    return reachable
+
+
+class Constraints:
+    """
+    Constraints on the teams of a match day, players are given by id and
+    matches by team number
+    """
+
+    def __init__(self):
+        self.together = []
+        self.apart = []
+        self.available = {}
+        self.max_igls = None
+        self.max_rank_spread = None
+
+    def is_empty(self) -> bool:
+        if self.together or self.apart or self.available:
+            return False
+        return self.max_igls is None and self.max_rank_spread is None
+
+    def describe(self, name=str) -> str:
+        """
+        The constraints, one per line, players are named by name(player id)
+        """
+        lines = [f"together: {name(a)}, {name(b)}" for a, b in self.together]
+        lines += [f"apart: {name(a)}, {name(b)}" for a, b in self.apart]
+        lines += [
+            f"{name(id)} only plays team {', '.join(map(str, sorted(matches)))}"
+            for id, matches in self.available.items()
+        ]
+        if self.max_igls is not None:
+            lines.append(f"at most {self.max_igls} IGLs per team")
+        if self.max_rank_spread is not None:
+            lines.append(f"rank spread at most {self.max_rank_spread}")
+        return "\n".join(lines) or "No constraints."
+
+    def prepare(self, players: list, num_matches: int, team_size: int) -> "Plan":
+        """
+        Merge the players into groups and check the constraints on them
+
+        Raises ConstraintError listing every contradiction.
+        """
+        ids = {player.id: player for player in players}
+        parent = {id: id for id in ids}
+
+        def find(id):
+            while parent[id] != id:
+                parent[id] = parent[parent[id]]
+                id = parent[id]
+            return id
+
+        for a, b in self.together:
+            if a in ids and b in ids:
+                parent[find(a)] = find(b)
+        members = {}
+        for id, player in ids.items():
+            members.setdefault(find(id), []).append(player)
+        groups, group_of, problems = [], {}, []
+        everything = set(range(num_matches))
+        for root, group_members in members.items():
+            matches = set(everything)
+            for player in group_members:
+                matches &= self.available.get(player.id, everything)
+            group = _Group(group_members, matches)
+            for player in group_members:
+                group_of[player.id] = group
+            groups.append(group)
+            if group.size == 1:
+                continue
+            if not matches:
+                problems.append(f"{group.names()} must play together but never can")
+            if group.size > team_size:
+                problems.append(f"{group.names()} are too many for one team")
+            if self.max_igls is not None and group.igls > self.max_igls:
+                problems.append(f"{group.names()} are too many IGLs for one team")
+            spread = group.high - group.low
+            if self.max_rank_spread is not None and spread > self.max_rank_spread:
+                problems.append(f"The ranks of {group.names()} are too far apart")
+        for a, b in self.apart:
+            if a in ids and b in ids:
+                if group_of[a] is group_of[b]:
+                    problems.append(
+                        f"{ids[a].display_name} and {ids[b].display_name} "
+                        "must play together and apart"
+                    )
+                group_of[a].apart.add(group_of[b])
+                group_of[b].apart.add(group_of[a])
+        sizes = {}
+        for match in range(num_matches):
+            available = [group for group in groups if match in group.matches]
+            size = min(team_size, sum(group.size for group in available))
+            if not _reachable(group.size for group in available) >> size & 1:
+                problems.append(f"The groups available can not make team {match}")
+            sizes[match] = size
+        if problems:
+            raise ConstraintError("\n".join(problems))
+        return Plan(self, groups, sizes)
+
+
+class Plan:
+    """
+    Groups of players checked against the constraints, see Constraints.prepare
+    """
+
+    def __init__(self, constraints: Constraints, groups: list, sizes: dict):
+        self.max_igls = constraints.max_igls
+        self.max_rank_spread = constraints.max_rank_spread
+        self.groups = groups
+        self.sizes = sizes
+
+    def _fits(self, group, igls, low, high, chosen) -> bool:
+        if self.max_igls is not None and igls + group.igls > self.max_igls:
+            return False
+        spread = max(high, group.high) - min(low, group.low)
+        if self.max_rank_spread is not None and spread > self.max_rank_spread:
+            return False
+        return not any(other in group.apart for other in chosen)
+
+    def choose(self, match: int) -> list:
+        """
+        The players of a team for a match, players who have played the fewest
+        matches first and an IGL first if there is one, like _choose_players
+
+        Raises ConstraintError if no team satisfies the constraints.
+        """
+        size = self.sizes[match]
+        order = sorted(
+            (group for group in self.groups if match in group.matches),
+            key=lambda group: (group.played(), random.random()),
+        )
+        igl = next((group for group in order if group.igls), None)
+        if igl is not None:
+            order.remove(igl)
+            order.insert(0, igl)
+        budget = [SEARCH_LIMIT]
+
+        def search(start, left, igls, low, high, chosen):
+            if left == 0:
+                return list(chosen)
+            budget[0] -= 1
+            if budget[0] < 0:
+                return None
+            fitting = [
+                (i, group)
+                for i, group in enumerate(order[start:], start)
+                if group.size <= left and self._fits(group, igls, low, high, chosen)
+            ]
+            # Prune when the groups that fit can not fill the team
+            if not _reachable(group.size for _, group in fitting) >> left & 1:
+                return None
+            for i, group in fitting:
+                chosen.append(group)
+                found = search(
+                    i + 1,
+                    left - group.size,
+                    igls + group.igls,
+                    min(low, group.low),
+                    max(high, group.high),
+                    chosen,
+                )
+                chosen.pop()
+                if found is not None:
+                    return found
+            return None
+
+        found = search(0, size, 0, float("inf"), float("-inf"), [])
+        if found is None:
+            if budget[0] < 0:
+                raise ConstraintError(f"No team {match} found within the search limit")
+            raise ConstraintError(f"No team {match} satisfies the constraints")
+        return [player for group in found for player in group.members]
+
+
+### TESTS
+
+
+def test_constraints():
+    class _Player:
+        def __init__(self, id, rank, igl=False):
+            self.id = id
+            self.display_name = str(id)
+            self.rank = rank
+            self.igl = igl
+            self.matches = 0
+
+    players = [_Player(i, 1000 * i, igl=i < 3) for i in range(12)]
+    constraints = Constraints()
+    constraints.together += [(3, 4), (4, 5)]
+    constraints.apart.append((3, 6))
+    constraints.available[7] = {1}
+    constraints.max_igls = 1
+    plan = constraints.prepare(players, 2, 5)
+    for _ in range(50):
+        for match in range(2):
+            team = {player.id for player in plan.choose(match)}
+            assert len(team) == 5
+            assert {3, 4, 5} <= team or not {3, 4, 5} & team
+            assert not {3, 6} <= team
+            assert match == 1 or 7 not in team
+            assert len(team & {0, 1, 2}) <= 1
+
+    constraints.max_rank_spread = 2000
+    constraints.together.append((5, 6))
+    try:
+        constraints.prepare(players, 2, 5)
+    except ConstraintError as e:
+        assert "together and apart" in str(e) and "too far apart" in str(e)
+    else:
+        assert False, "Contradicting constraints should be reported"
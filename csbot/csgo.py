@@ -1,8 +1,10 @@
 import requests
 from cachetools import TTLCache, cached
+from metrics import timed
 
 
 @cached(cache=TTLCache(maxsize=1, ttl=86400))
+@timed("fandom.get_active_duty")
 def get_active_duty():
     """
     Uses countrestrike.fandom.com to get the current active duty map pool.
@@ -0,0 +1,187 @@
+"""
+Distances between the map preferences of players.
+
+Preferences are compared as rankings, a higher value is a more wanted map.
+Every metric takes the preference matrix of a team, one row per player and one
+column per map, and returns the sum of the distances over every ordered pair of
+players, which is what Team scores. The metrics work on whole columns of the matrix
+instead of comparing every pair of players.
+
+- footrule: sum of the differences in preference, the Spearman footrule
+- kendall: number of pairs of maps two players order differently, Kendall's tau distance
+- top_k: the footrule weighted by how high either player ranks the map, maps outside
+  both players' TOP_K most wanted maps do not count
+"""
+
+import operator
+
+# Most wanted maps counted by the top_k metric
+TOP_K = 3
+
+
+def preference_matrix(players: list, maps: list) -> list:
+    return [[player.maps[map] for map in maps] for player in players]
+
+
+def _distance_sums(column: list) -> list:
+    """
+    For every value of the column, the sum of its differences to the other values
+    """
+    n = len(column)
+    order = sorted(range(n), key=column.__getitem__)
+    total = sum(column)
+    sums = [0] * n
+    below = 0
+    for i, index in enumerate(order):
+        value = column[index]
+        sums[index] = value * i - below + (total - below - value) - value * (n - 1 - i)
+        below += value
+    return sums
+
+
+def footrule(matrix: list) -> float:
+    """
+    Sum of the footrule distances over every ordered pair of players
+    """
+    total = 0
+    for column in zip(*matrix):
+        n = len(column)
+        for i, value in enumerate(sorted(column)):
+            total += (2 * i - n + 1) * value
+    return 2 * total
+
+
+def kendall(matrix: list) -> float:
+    """
+    Sum of the Kendall tau distances over every ordered pair of players,
+    for every pair of maps the players preferring one times those preferring the other
+    """
+    if not matrix:
+        return 0
+    columns = list(zip(*matrix))
+    total = 0
+    for i, first in enumerate(columns):
+        for j in range(i + 1, len(columns)):
+            second = columns[j]
+            less = sum(1 for a, b in zip(first, second) if a < b)
+            more = sum(1 for a, b in zip(first, second) if a > b)
+            total += less * more
+    return 2 * total
+
+
+def top_weights(row: list, k: int = TOP_K) -> list:
+    """
+    Weight of every map of a preference row, 1 for the most wanted map down to
+    1/k for the k-th, 0 for the others
+    """
+    weights = [0.0] * len(row)
+    ranked = sorted(range(len(row)), key=row.__getitem__, reverse=True)
+    for position, index in enumerate(ranked[:k]):
+        weights[index] = (k - position) / k
+    return weights
+
+
+def top_k(matrix: list) -> float:
+    """
+    Sum over every ordered pair of players and map of the difference in preference
+    times the mean of the weights both players give the map
+    """
+    weights = [top_weights(row) for row in matrix]
+    total = 0.0
+    for column, column_weights in zip(zip(*matrix), zip(*weights)):
+        # Every ordered pair counts the weight of both players once
+        sums = _distance_sums(list(column))
+        total += sum(weight * sum_ for weight, sum_ in zip(column_weights, sums))
+    return total
+
+
+METRICS = {"footrule": footrule, "kendall": kendall, "top_k": top_k}
+
+
+def _orderings(row: list) -> tuple:
+    """
+    Bitsets over the pairs of maps, of the pairs the row orders up and down
+    """
+    up = down = 0
+    bit = 1
+    for i, first in enumerate(row):
+        for j in range(i + 1, len(row)):
+            second = row[j]
+            if first < second:
+                up |= bit
+            elif first > second:
+                down |= bit
+            bit <<= 1
+    return up, down
+
+
+def pair_distances(matrix: list, metric: str) -> list:
+    """
+    The distance between every two rows of the matrix, half of what the metric
+    sums for the two players since it counts both ordered pairs
+    """
+    n = len(matrix)
+    distances = [[0.0] * n for _ in range(n)]
+    if metric == "footrule":
+
+        def pair(i, j):
+            return sum(map(abs, map(operator.sub, matrix[i], matrix[j])))
+
+    elif metric == "kendall":
+        orderings = [_orderings(row) for row in matrix]
+
+        def pair(i, j):
+            (up, down), (other_up, other_down) = orderings[i], orderings[j]
+            return ((up & other_down) | (down & other_up)).bit_count()
+
+    else:
+        get_metric(metric)
+        weights = [top_weights(row) for row in matrix]
+
+        def pair(i, j):
+            return sum(
+                abs(a - b) * (wa + wb) / 2
+                for a, b, wa, wb in zip(matrix[i], matrix[j], weights[i], weights[j])
+            )
+
+    for i in range(n):
+        row = distances[i]
+        for j in range(i + 1, n):
+            row[j] = distances[j][i] = pair(i, j)
+    return distances
+
+
+def get_metric(name: str):
+    try:
+        return METRICS[name]
+    except KeyError:
+        raise ValueError(
+            f"Unknown map metric {name}, use one of {', '.join(METRICS)}"
+        ) from None
+
+
+### TESTS
+
+
+def test_metrics_match_pairwise():
+    import random
+    import itertools
+
+    random.seed(3)
+    matrix = [random.sample(range(7), 7) for _ in range(6)]
+    pairs = list(itertools.permutations(matrix, 2))
+    assert footrule(matrix) == sum(abs(x - y) for a, b in pairs for x, y in zip(a, b))
+    assert kendall(matrix) == sum(
+        (a[i] - a[j]) * (b[i] - b[j]) < 0
+        for a, b in pairs
+        for i, j in itertools.combinations(range(7), 2)
+    )
+    expected = 0
+    for a, b in pairs:
+        wa, wb = top_weights(a), top_weights(b)
+        expected += sum(abs(a[m] - b[m]) * (wa[m] + wb[m]) / 2 for m in range(7))
+    assert abs(top_k(matrix) - expected) < 1e-9
+    assert footrule([]) == kendall([]) == top_k([]) == 0
+    for metric, function in METRICS.items():
+        distances = pair_distances(matrix, metric)
+        assert abs(sum(map(sum, distances)) - function(matrix)) < 1e-9
@@ -0,0 +1,374 @@
+"""
+Offline stand-in for the parts of the discord gateway and http api the cogs use.
+Lets the cogs run without a discord server, for load tests and trace replays.
+
+Every call that would be an http request to discord awaits FakeGuild.latency,
+so the harness can simulate the round trip to discord.
+"""
+
+import json
+import asyncio
+import logging
+import itertools
+import cachetools.keys
+from pathlib import Path
+from datetime import datetime, timezone
+
+import csgo
+from bot import CSBot
+from guildstate import PlayerStore
+from scheduler import Scheduler
+
+_snowflakes = itertools.count(1 << 40)
+
+
+def snowflake() -> int:
+    return next(_snowflakes)
+
+
+def offline_map_pool(maps: list):
+    """
+    Seed the active duty cache so nothing is fetched from counterstrike.fandom.com
+    """
+    csgo.get_active_duty.cache[cachetools.keys.hashkey()] = list(maps)
+
+
+class FakePermissions:
+    def __init__(self, administrator=False, manage_roles=False):
+        self.administrator = administrator
+        self.manage_roles = manage_roles
+
+
+class FakeMember:
+    """
+    Stand-in for discord.Member
+    """
+
+    def __init__(self, guild, id: int, name: str, admin=False, manage_roles=False):
+        self.guild = guild
+        self.id = id
+        self.name = name
+        self.display_name = name
+        self.mention = f"<@{id}>"
+        self.roles = set()
+        self.dms = []
+        self.permissions = FakePermissions(admin, manage_roles)
+
+    def __repr__(self):
+        return f"<FakeMember id={self.id} name={self.name}>"
+
+    def __str__(self):
+        return self.name
+
+    async def add_roles(self, *roles, reason=None):
+        await self.guild.http()
+        self.roles.update(role.id for role in roles)
+
+    async def remove_roles(self, *roles, reason=None):
+        await self.guild.http()
+        self.roles.difference_update(role.id for role in roles)
+
+    async def send(self, content=None, **kwargs):
+        await self.guild.http()
+        self.dms.append(content)
+
+
+class FakeMessage:
+    """
+    Stand-in for discord.Message / discord.InteractionMessage
+    """
+
+    def __init__(self, channel, author, content=None, embed=None):
+        self.channel = channel
+        self.guild = channel.guild
+        self.id = snowflake()
+        self.author = author
+        self.content = content
+        self.embed = embed
+        self.reactions = {}
+        self.deleted = False
+        self.edits = 0
+
+    async def add_reaction(self, emoji):
+        await self.guild.http()
+        self.reactions.setdefault(emoji, set()).add(self.guild.bot_user.id)
+
+    async def edit(self, content=None, embed=None, **kwargs):
+        await self.guild.http()
+        if content is not None:
+            self.content = content
+        if embed is not None:
+            self.embed = embed
+        self.edits += 1
+        return self
+
+    async def delete(self):
+        await self.guild.http()
+        self.deleted = True
+        self.channel.messages.pop(self.id, None)
+
+
+class FakeChannel:
+    def __init__(self, guild, name: str):
+        self.guild = guild
+        self.id = snowflake()
+        self.name = name
+        self.messages = {}
+
+    def permissions_for(self, member) -> FakePermissions:
+        return member.permissions
+
+    async def send(self, content=None, embed=None, **kwargs) -> FakeMessage:
+        await self.guild.http()
+        message = FakeMessage(self, self.guild.bot_user, content, embed)
+        self.messages[message.id] = message
+        return message
+
+
+class FakeNamespace:
+    """
+    Stand-in for discord.app_commands.Namespace
+    """
+
+    def __init__(self, **options):
+        self.__dict__.update(options)
+
+    def __getitem__(self, key):
+        return self.__dict__[key]
+
+    def __iter__(self):
+        return iter(self.__dict__.items())
+
+
+class FakeResponse:
+    def __init__(self, interaction):
+        self.interaction = interaction
+        self.done = False
+        self.choices = None
+
+    def is_done(self) -> bool:
+        return self.done
+
+    async def send_message(self, content=None, embed=None, ephemeral=False, **kwargs):
+        if self.done:
+            raise RuntimeError("This interaction has already been responded to")
+        await self.interaction.guild.http()
+        self.done = True
+        self.interaction.message = FakeMessage(
+            self.interaction.channel, self.interaction.guild.bot_user, content, embed
+        )
+        self.interaction.message.ephemeral = ephemeral
+        if not ephemeral:
+            self.interaction.channel.messages[self.interaction.message.id] = (
+                self.interaction.message
+            )
+
+    async def defer(self, ephemeral=False, **kwargs):
+        await self.interaction.guild.http()
+        self.done = True
+
+    async def autocomplete(self, choices):
+        await self.interaction.guild.http()
+        self.done = True
+        self.choices = choices
+
+
+class FakeFollowup:
+    def __init__(self, interaction):
+        self.interaction = interaction
+        self.messages = []
+
+    async def send(self, content=None, embed=None, ephemeral=False, **kwargs):
+        await self.interaction.guild.http()
+        message = FakeMessage(
+            self.interaction.channel, self.interaction.guild.bot_user, content, embed
+        )
+        self.messages.append(message)
+        return message
+
+
+class FakeInteraction:
+    """
+    Stand-in for discord.Interaction
+    """
+
+    def __init__(self, guild, user, channel=None, **options):
+        self.id = snowflake()
+        self.guild = guild
+        self.guild_id = guild.id
+        self.user = user
+        self.channel = channel or guild.broadcast_channel
+        self.channel_id = self.channel.id
+        self.namespace = FakeNamespace(**options)
+        self.created_at = datetime.now(timezone.utc)
+        self.response = FakeResponse(self)
+        self.followup = FakeFollowup(self)
+        self.message = None
+
+    async def original_response(self) -> FakeMessage:
+        await self.guild.http()
+        return self.message
+
+
+class FakeRawReaction:
+    """
+    Stand-in for discord.RawReactionActionEvent
+    """
+
+    def __init__(self, guild, message, member, emoji="✅", event_type="REACTION_ADD"):
+        self.guild_id = guild.id
+        self.channel_id = message.channel.id
+        self.message_id = message.id
+        self.user_id = member.id
+        self.member = member if event_type == "REACTION_ADD" else None
+        self.emoji = emoji
+        self.event_type = event_type
+
+
+class FakeGuild:
+    def __init__(self, id: int = None, latency: float = 0.0):
+        self.id = id or snowflake()
+        self.latency = latency
+        self.requests = 0
+        self.members = {}
+        self.bot_user = FakeMember(self, snowflake(), "csbot", admin=True)
+        self.broadcast_channel = FakeChannel(self, "dev")
+
+    async def http(self):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        else:
+            await asyncio.sleep(0)
+
+    def get_member(self, id: int) -> FakeMember:
+        return self.members.get(id)
+
+    def add_member(self, name: str, admin=False, manage_roles=False) -> FakeMember:
+        member = FakeMember(self, snowflake(), name, admin, manage_roles)
+        self.members[member.id] = member
+        return member
+
+
+class FakeBot:
+    """
+    Stand-in for CSBot, reuses its member lookups on top of a FakeGuild
+    """
+
+    get_member = CSBot.get_member
+    is_member = CSBot.is_member
+    guild_ids = CSBot.guild_ids
+    guild_objects = CSBot.guild_objects
+    guild_config = CSBot.guild_config
+    check_map_metrics = CSBot.check_map_metrics
+
+    def __init__(self, guild: FakeGuild, config_file: str = "config.json"):
+        with open(config_file, "r") as f:
+            self.config = json.load(f)
+        self.config["server_ID"] = str(guild.id)
+        self.config.pop("guilds", None)
+        self.check_map_metrics()
+        self.guild = guild
+        self.user = guild.bot_user
+        self.players = PlayerStore()
+        self.broadcast_channels = {guild.id: guild.broadcast_channel}
+        self.scheduler = Scheduler(f"{Path.home()}/.csbot/schedule.jsonl")
+        self.log = logging.getLogger("FakeBot")
+        self.cogs = {}
+        self.listeners = {}
+
+    def get_all_members(self):
+        return iter(self.guild.members.values())
+
+    def get_guild(self, id: int) -> FakeGuild:
+        return self.guild if id == self.guild.id else None
+
+    def get_channel(self, id: int) -> FakeChannel:
+        channel = self.guild.broadcast_channel
+        return channel if id == channel.id else None
+
+    def get_cog(self, name: str):
+        return self.cogs.get(name)
+
+    async def add_cog(self, cog, /, **kwargs):
+        self.cogs[cog.qualified_name] = cog
+        for event, method_name in cog.__cog_listeners__:
+            self.listeners.setdefault(event, []).append(getattr(cog, method_name))
+
+    async def load_extension(self, module):
+        await module.setup(self)
+
+    async def dispatch(self, event: str, *args):
+        """
+        Call every cog listener for an event, like the gateway would
+        """
+        await asyncio.gather(
+            *(listener(*args) for listener in self.listeners.get(event, []))
+        )
+
+    async def close(self):
+        await self.scheduler.stop()
+
+
+def get_command(cog, name: str):
+    for command in cog.walk_app_commands():
+        if command.name == name:
+            return command
+    raise KeyError(f"{cog.qualified_name} has no command {name}")
+
+
+async def invoke(cog, name: str, interaction: FakeInteraction, **params):
+    """
+    Run an app command callback like discord.py would after parsing the options
+    """
+    command = get_command(cog, name)
+    return await command.callback(cog, interaction, **params)
+
+
+async def autocomplete(cog, name: str, option: str, interaction, current: str):
+    """
+    Run the autocomplete callback of a command option
+    """
+    param = get_command(cog, name)._params[option]
+    if getattr(param.autocomplete, "pass_command_binding", False):
+        choices = await param.autocomplete(cog, interaction, current)
+    else:
+        choices = await param.autocomplete(interaction, current)
+    await interaction.response.autocomplete(choices)
+    return choices
+
+
+### TESTS
+
+
+def test_season_signup_against_fake_discord(tmp_path, monkeypatch):
+    import os
+    import cogs.member
+    from loadtest import MAP_POOL
+
+    monkeypatch.setenv("HOME", str(tmp_path))
+    monkeypatch.setitem(csgo.get_active_duty.cache, cachetools.keys.hashkey(), MAP_POOL)
+
+    async def run():
+        guild = FakeGuild()
+        bot = FakeBot(
+            guild, f"{os.path.dirname(os.path.abspath(__file__))}/config.json"
+        )
+        await bot.load_extension(cogs.member)
+        members = bot.get_cog("MemberHandler")
+        admin = guild.add_member("admin", admin=True)
+        user = guild.add_member("user", manage_roles=True)
+        await invoke(
+            members, "start_registration_season", FakeInteraction(guild, admin)
+        )
+        message = members.get_registration_message(guild.id)
+        await bot.dispatch("on_raw_reaction_add", FakeRawReaction(guild, message, user))
+        interaction = FakeInteraction(guild, user)
+        await invoke(members, "set_rank", interaction, rank="12000")
+        await bot.close()
+        return bot, user, interaction
+
+    bot, user, interaction = asyncio.run(run())
+    assert user.id in bot.players[bot.guild.id]
+    assert interaction.response.is_done()
+    assert bot.guild.requests > 0
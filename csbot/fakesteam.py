@@ -0,0 +1,81 @@
+"""
+Local stand-in for the bulk player endpoints of the Steam Web API, for tests.
+
+    async with FakeSteam(steam_ids) as api:
+        client = SteamClient(["key"], api.url)
+"""
+
+from aiohttp import web
+
+from steam import BATCH_SIZE, SUMMARIES, BANS
+
+
+class FakeSteam:
+    """
+    Serves GetPlayerSummaries and GetPlayerBans for a fixed set of steam ids on
+    127.0.0.1, counting the requests and the largest batch asked for
+
+    :param steam_ids: The accounts that exist
+    :param keys: Valid api keys, any key is accepted when None
+    """
+
+    def __init__(self, steam_ids: list, keys: list = None):
+        self.steam_ids = set(steam_ids)
+        self.keys = keys
+        self.requests = 0
+        self.max_batch = 0
+        self.app = web.Application()
+        self.app.router.add_get(f"/{SUMMARIES}", self.summaries)
+        self.app.router.add_get(f"/{BANS}", self.bans)
+        self.runner = None
+        self.url = None
+
+    async def __aenter__(self):
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.runner.cleanup()
+
+    def _steam_ids(self, request) -> list:
+        if self.keys is not None and request.query.get("key") not in self.keys:
+            raise web.HTTPForbidden()
+        steam_ids = request.query.get("steamids", "").split(",")
+        if len(steam_ids) > BATCH_SIZE:
+            raise web.HTTPBadRequest()
+        self.requests += 1
+        self.max_batch = max(self.max_batch, len(steam_ids))
+        return [steam_id for steam_id in steam_ids if steam_id in self.steam_ids]
+
+    async def summaries(self, request):
+        players = [
+            {
+                "steamid": steam_id,
+                "personaname": f"player{steam_id}",
+                "profileurl": f"https://steamcommunity.com/profiles/{steam_id}/",
+                "avatarfull": "",
+                "communityvisibilitystate": 3,
+            }
+            for steam_id in self._steam_ids(request)
+        ]
+        return web.json_response({"response": {"players": players}})
+
+    async def bans(self, request):
+        players = [
+            {
+                "SteamId": steam_id,
+                "CommunityBanned": False,
+                "VACBanned": int(steam_id) % 7 == 0,
+                "NumberOfVACBans": int(int(steam_id) % 7 == 0),
+                "DaysSinceLastBan": 0,
+                "NumberOfGameBans": 0,
+                "EconomyBan": "none",
+            }
+            for steam_id in self._steam_ids(request)
+        ]
+        return web.json_response({"players": players})
@@ -0,0 +1,75 @@
+"""
+Per guild state for CSBot.
+Every guild gets its own directory ~/.csbot/<guild id>/ and its state is only
+loaded the first time the guild is used.
+"""
+
+import os
+import pickle
+import logging
+from pathlib import Path
+
+from metrics import timed
+
+
+def state_dir(guild_id: int) -> str:
+    """
+    Directory holding the state files of a guild
+    """
+    return f"{Path.home()}/.csbot/{guild_id}"
+
+
+def state_file(guild_id: int, name: str = "state") -> str:
+    return f"{state_dir(guild_id)}/{name}"
+
+
+class GuildStates(dict):
+    """
+    Dictionary of guild id -> state, the state is created by factory(guild_id)
+    the first time a guild is looked up
+    """
+
+    def __init__(self, factory):
+        super().__init__()
+        self.factory = factory
+
+    def __missing__(self, guild_id: int):
+        state = self[guild_id] = self.factory(guild_id)
+        return state
+
+
+class PlayerStore(GuildStates):
+    """
+    The registered players of every guild, player id -> Player
+
+    :param legacy_guild_id: Guild that owns the single guild ~/.csbot/state file
+    """
+
+    def __init__(self, legacy_guild_id: int = None):
+        super().__init__(self.load)
+        self.legacy_guild_id = legacy_guild_id
+        self.log = logging.getLogger(self.__class__.__name__)
+
+    def load(self, guild_id: int) -> dict:
+        paths = [state_file(guild_id)]
+        if guild_id == self.legacy_guild_id:
+            paths.append(f"{Path.home()}/.csbot/state")
+        for path in paths:
+            try:
+                with open(path, "rb") as f:
+                    self.log.debug("Loading players of %s from %s", guild_id, path)
+                    return pickle.load(f)
+            except FileNotFoundError:
+                continue
+        return {}
+
+    @timed("state.persist")
+    def save(self, guild_id: int):
+        """
+        Write the players of a guild to disk, replacing the old file atomically
+        """
+        os.makedirs(state_dir(guild_id), exist_ok=True)
+        path = state_file(guild_id)
+        with open(f"{path}.tmp", "wb") as f:
+            pickle.dump(self[guild_id], f)
+        os.replace(f"{path}.tmp", path)
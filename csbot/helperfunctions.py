@@ -1,10 +1,9 @@
 import os
 import math
 import csgo
-import pickle
+import logging
 import discord
 import constants
-from pathlib import Path
 
 
 class DiscordString(str):
@@ -59,32 +58,12 @@ def euclidean_distance(val1, val2):
 def log_request(function):
     async def inner(self, message):
         if isinstance(message, discord.RawReactionActionEvent):
-            self.log.info(f"{message.user_id} calling: {function.__name__}")
+            self.log.info("%s calling: %s", message.user_id, function.__name__)
         elif isinstance(message, discord.Message):
-            self.log.info(f"{message.author} calling: {function.__name__}")
-            self.log.debug(f"Message content: {message.content}")
+            self.log.info("%s calling: %s", message.author, function.__name__)
+            if self.log.isEnabledFor(logging.DEBUG):
+                self.log.debug("Message content: %s", message.content)
         await function(self, message)
         self.log.debug("OK")
 
     return inner
-
-
-def persist_state(function):
-    async def persist_state(self, *args, **kwargs):
-        await function(self, *args, **kwargs)
-        with open(f"{Path.home()}/.csbot/state", "wb") as f:
-            pickle.dump(self.players, f)
-
-    return persist_state
-
-
-def load_state(function):
-    def load_state(self, *args, **kwargs):
-        function(self, *args, **kwargs)
-        try:
-            with open(f"{Path.home()}/.csbot/state", "rb") as f:
-                self.players = pickle.load(f)
-        except FileNotFoundError:
-            self.players = {}
-
-    return load_state
@@ -0,0 +1,223 @@
+"""
+League partitioning.
+
+Splits a large signup into many teams of constants.team_size at once, for in-house
+tournaments. Players are first dealt out greedily by rank, the strongest player left
+to the team with the lowest rank sum, like the greedy seed of Karmarkar-Karp
+partitioning. Then players of different teams are swapped as long as that lowers the
+sum of the team scores. Swaps are scored from each team's rank sum and every player's
+distance to every team, so trying a swap costs the same for any number of players.
+Last, players are swapped out of the team with the worst map score, so the map
+scores of the teams do not spread out.
+"""
+
+import time
+import random
+
+import constants
+from csgo import get_active_duty
+from distances import pair_distances, preference_matrix
+from metrics import timed
+from team import Team
+
+
+@timed("partition_teams")
+def partition_teams(
+    players: dict,
+    num_teams: int = None,
+    appearances: dict = None,
+    metric: str = None,
+    time_limit: float = None,
+) -> dict:
+    """
+    Divide the players into teams of constants.team_size with the average ranks
+    as close to each other and the map preferences within each team as close
+    as the swaps find
+
+    PARAMETERS
+    ----------
+    players : dict
+        player id -> Player signed up
+    num_teams : int
+        Number of teams, as many as the players fill by default
+    appearances : dict
+        player id -> matches played this season, when there are players left over
+        the players who have played the most sit out
+    metric : str
+        Map preference distance to score teams by, constants.map_metric by default
+    time_limit : float
+        Seconds after which the swaps stop, constants.league_time_limit by default
+
+    RETURNS
+    -------
+    dict
+        team id -> Team
+    """
+    start = time.perf_counter()
+    metric = metric or constants.map_metric
+    if time_limit is None:
+        time_limit = constants.league_time_limit
+    appearances = appearances or {}
+    size = constants.team_size
+    pool = list(players.values())
+    if num_teams is None:
+        num_teams = len(pool) // size
+    if num_teams <= 0 or num_teams * size > len(pool):
+        raise ValueError(f"{len(pool)} players can not make {num_teams} teams")
+    random.shuffle(pool)
+    pool.sort(key=lambda player: appearances.get(player.id, 0))
+    pool = pool[: num_teams * size]
+
+    n = len(pool)
+    maps = get_active_duty()
+    ranks = [player.effective_rank() for player in pool]
+    average = sum(ranks) / n
+    distance = pair_distances(preference_matrix(pool, maps), metric)
+
+    # Deal the IGLs first so they are spread over the teams
+    members = [[] for _ in range(num_teams)]
+    rank_sums = [0.0] * num_teams
+    for i in sorted(range(n), key=lambda i: (not pool[i].igl, -ranks[i])):
+        team = min(
+            (team for team in range(num_teams) if len(members[team]) < size),
+            key=rank_sums.__getitem__,
+        )
+        members[team].append(i)
+        rank_sums[team] += ranks[i]
+
+    # to_team[i][team] is the sum of the distances of player i to the team
+    to_team = [[0.0] * num_teams for _ in range(n)]
+    pair_sums = [0.0] * num_teams
+    for team, team_members in enumerate(members):
+        for i in range(n):
+            to_team[i][team] = sum(distance[i][j] for j in team_members)
+        pair_sums[team] = sum(to_team[i][team] for i in team_members)
+    map_weight = 1 / (len(maps) * size)
+
+    def cost(rank_sum, pair_sum):
+        # Team.rankcompatability + Team.mapcompatability, pair_sum counts ordered pairs
+        return abs(rank_sum / size - average) + pair_sum * map_weight
+
+    # A pair of teams can only gain from a swap again once either team changed,
+    # the last quarter of the time is left for the worst team below
+    changed = set(range(num_teams))
+    while changed and time.perf_counter() - start < time_limit * 0.75:
+        dirty, changed = changed, set()
+        for a_team in range(num_teams):
+            for b_team in range(a_team + 1, num_teams):
+                if a_team not in dirty and b_team not in dirty:
+                    continue
+                before = cost(rank_sums[a_team], pair_sums[a_team]) + cost(
+                    rank_sums[b_team], pair_sums[b_team]
+                )
+                for x in range(size):
+                    for y in range(size):
+                        a, b = members[a_team][x], members[b_team][y]
+                        # Swapping IGLs only for IGLs keeps them spread
+                        if pool[a].igl != pool[b].igl:
+                            continue
+                        a_sum = rank_sums[a_team] - ranks[a] + ranks[b]
+                        b_sum = rank_sums[b_team] - ranks[b] + ranks[a]
+                        a_pairs = pair_sums[a_team] + 2 * (
+                            to_team[b][a_team] - distance[a][b] - to_team[a][a_team]
+                        )
+                        b_pairs = pair_sums[b_team] + 2 * (
+                            to_team[a][b_team] - distance[a][b] - to_team[b][b_team]
+                        )
+                        after = cost(a_sum, a_pairs) + cost(b_sum, b_pairs)
+                        if after >= before - 1e-9:
+                            continue
+                        members[a_team][x], members[b_team][y] = b, a
+                        rank_sums[a_team], rank_sums[b_team] = a_sum, b_sum
+                        pair_sums[a_team], pair_sums[b_team] = a_pairs, b_pairs
+                        for i in range(n):
+                            moved = distance[i][b] - distance[i][a]
+                            to_team[i][a_team] += moved
+                            to_team[i][b_team] -= moved
+                        before = after
+                        changed.update((a_team, b_team))
+    # The swaps above lower the sum of the team scores, which can leave a few teams
+    # with the players whose map preferences clash. Move players out of the team
+    # with the worst map score while that lowers the worst of the two teams, and
+    # no team ends up more than constants.league_rank_slack further from the
+    # average rank than the worst already is.
+    map_scores = [pair_sum * map_weight for pair_sum in pair_sums]
+    rank_limit = max(abs(rank_sum / size - average) for rank_sum in rank_sums)
+    rank_limit += constants.league_rank_slack
+    while time.perf_counter() - start < time_limit:
+        worst = max(range(num_teams), key=map_scores.__getitem__)
+        best = None
+        for other in range(num_teams):
+            if other == worst:
+                continue
+            for x in range(size):
+                for y in range(size):
+                    a, b = members[worst][x], members[other][y]
+                    if pool[a].igl != pool[b].igl:
+                        continue
+                    a_sum = rank_sums[worst] - ranks[a] + ranks[b]
+                    b_sum = rank_sums[other] - ranks[b] + ranks[a]
+                    deviations = (a_sum / size - average, b_sum / size - average)
+                    if max(map(abs, deviations)) > rank_limit:
+                        continue
+                    a_pairs = pair_sums[worst] + 2 * (
+                        to_team[b][worst] - distance[a][b] - to_team[a][worst]
+                    )
+                    b_pairs = pair_sums[other] + 2 * (
+                        to_team[a][other] - distance[a][b] - to_team[b][other]
+                    )
+                    score = max(a_pairs, b_pairs) * map_weight
+                    if score < map_scores[worst] - 1e-9 and (
+                        best is None or score < best[0]
+                    ):
+                        best = (score, other, x, y, a_sum, b_sum, a_pairs, b_pairs)
+        if best is None:
+            break
+        _, other, x, y, a_sum, b_sum, a_pairs, b_pairs = best
+        a, b = members[worst][x], members[other][y]
+        members[worst][x], members[other][y] = b, a
+        rank_sums[worst], rank_sums[other] = a_sum, b_sum
+        pair_sums[worst], pair_sums[other] = a_pairs, b_pairs
+        map_scores[worst] = a_pairs * map_weight
+        map_scores[other] = b_pairs * map_weight
+        for i in range(n):
+            moved = distance[i][b] - distance[i][a]
+            to_team[i][worst] += moved
+            to_team[i][other] -= moved
+    return {
+        team: Team(team, [pool[i] for i in team_members], pool, metric)
+        for team, team_members in enumerate(members)
+    }
+
+
+### TESTS
+
+
+def test_partition_is_balanced(monkeypatch):
+    import cachetools.keys
+    import csgo
+    from loadtest import MAP_POOL
+    from player import Player
+
+    monkeypatch.setitem(csgo.get_active_duty.cache, cachetools.keys.hashkey(), MAP_POOL)
+    random.seed(6)
+    maps = get_active_duty()
+    players = {}
+    for i in range(63):
+        player = Player(i, str(i), str(i))
+        player.rank = random.randint(1000, 30000)
+        player.igl = i % 7 == 0
+        player.update_maps(random.sample(maps, k=len(maps)))
+        players[i] = player
+    teams = partition_teams(players, 12, appearances={0: 5, 1: 5, 2: 5})
+    ids = [player.id for team in teams.values() for player in team.players]
+    assert len(ids) == len(set(ids)) == 60
+    assert not {0, 1, 2} & set(ids), "The players who played the most sit out"
+    assert all(len(team.players) == constants.team_size for team in teams.values())
+    assert all(sum(p.igl for p in team.players) <= 1 for team in teams.values())
+    averages = [
+        sum(p.rank for p in team.players) / len(team.players) for team in teams.values()
+    ]
+    assert max(averages) - min(averages) < 2000
+    map_scores = [team.mapcompatability for team in teams.values()]
+    assert max(map_scores) - min(map_scores) < 3.3
@@ -0,0 +1,282 @@
+"""
+Load test for the cogs against the offline discord stand-in in fakediscord.py
+
+Simulates a season signup, map and rank preferences, a match day signup,
+a veto and a burst of autocompletes, then reports throughput and latency percentiles.
+
+    python loadtest.py --users 300 --concurrency 50 --latency 0.05
+"""
+
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+from collections import Counter, defaultdict
+
+import fakediscord
+from fakediscord import FakeBot, FakeGuild, FakeInteraction, FakeRawReaction
+
+MAP_POOL = ["Ancient", "Anubis", "Dust_II", "Inferno", "Mirage", "Nuke", "Vertigo"]
+
+
+def percentile(samples: list, q: float) -> float:
+    """
+    Nearest rank percentile of a sorted list
+    """
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, max(0, round(q * len(samples)) - 1))]
+
+
+class LoadStats:
+    """
+    Latency samples and errors per operation, throughput per phase
+    """
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.errors = Counter()
+        self.error_types = defaultdict(Counter)
+        self.phases = {}
+
+    async def measure(self, operation: str, coro):
+        start = time.perf_counter()
+        try:
+            await coro
+        except Exception as e:
+            self.errors[operation] += 1
+            self.error_types[operation][type(e).__name__] += 1
+        finally:
+            self.samples[operation].append(time.perf_counter() - start)
+
+    async def phase(self, name: str, jobs: list, concurrency: int):
+        """
+        Run (operation, coroutine) jobs with bounded concurrency and time the phase
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def run(operation, coro):
+            async with semaphore:
+                await self.measure(operation, coro)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(run(operation, coro) for operation, coro in jobs))
+        self.phases[name] = (len(jobs), time.perf_counter() - start)
+
+    def report(self) -> str:
+        lines = [
+            f"{'phase':<24} {'ops':>7} {'seconds':>9} {'ops/s':>9}",
+        ]
+        for name, (count, seconds) in self.phases.items():
+            lines.append(
+                f"{name:<24} {count:>7} {seconds:>9.3f} {count / max(seconds, 1e-9):>9.1f}"
+            )
+        lines.append("")
+        lines.append(
+            f"{'operation':<32} {'n':>6} {'err':>5} {'p50ms':>8} {'p90ms':>8} {'p99ms':>8} {'maxms':>8}"
+        )
+        for operation, samples in self.samples.items():
+            samples = sorted(samples)
+            lines.append(
+                f"{operation:<32} {len(samples):>6} {self.errors[operation]:>5} "
+                f"{percentile(samples, 0.5) * 1000:>8.2f} {percentile(samples, 0.9) * 1000:>8.2f} "
+                f"{percentile(samples, 0.99) * 1000:>8.2f} {samples[-1] * 1000:>8.2f}"
+            )
+        for operation, errors in self.error_types.items():
+            lines.append(f"errors in {operation}: {dict(errors)}")
+        return "\n".join(lines)
+
+
+def react(bot, message, member, event="on_raw_reaction_add"):
+    event_type = "REACTION_ADD" if event == "on_raw_reaction_add" else "REACTION_REMOVE"
+    return bot.dispatch(
+        event, FakeRawReaction(bot.guild, message, member, event_type=event_type)
+    )
+
+
+async def run(args) -> LoadStats:
+    import cogs.member
+    import cogs.match
+
+    rng = random.Random(args.seed)
+    stats = LoadStats()
+    guild = FakeGuild(latency=args.latency)
+    bot = FakeBot(guild, f"{os.path.dirname(os.path.abspath(__file__))}/config.json")
+    admin = guild.add_member("admin", admin=True)
+    users = [guild.add_member(f"user{i}", manage_roles=True) for i in range(args.users)]
+
+    await bot.load_extension(cogs.member)
+    members = bot.get_cog("MemberHandler")
+
+    interaction = FakeInteraction(guild, admin)
+    await fakediscord.invoke(members, "start_registration_season", interaction)
+    message = members.get_registration_message(guild.id)
+    await stats.phase(
+        "season signup",
+        [("reaction season", react(bot, message, user)) for user in users],
+        args.concurrency,
+    )
+
+    jobs = []
+    for user in users:
+        maps = rng.sample(MAP_POOL, k=len(MAP_POOL))
+        options = {f"m{i + 1}": cs_map for i, cs_map in enumerate(maps)}
+        jobs.append(
+            (
+                "add_maps",
+                fakediscord.invoke(
+                    members, "add_maps", FakeInteraction(guild, user), **options
+                ),
+            )
+        )
+        jobs.append(
+            (
+                "set_rank",
+                fakediscord.invoke(
+                    members,
+                    "set_rank",
+                    FakeInteraction(guild, user),
+                    rank=str(rng.randint(0, 25000)),
+                ),
+            )
+        )
+    await stats.phase("preferences", jobs, args.concurrency)
+
+    await bot.load_extension(cogs.match)
+    matches = bot.get_cog("MatchHandler")
+    state = matches.state(guild.id)
+    await fakediscord.invoke(
+        matches,
+        "start_registration_match",
+        FakeInteraction(guild, admin),
+        number_of_matches=args.matches,
+    )
+    message = state.registration_message
+    await stats.phase(
+        "match signup",
+        [
+            ("reaction match", react(bot, message, user))
+            for user in rng.sample(users, k=min(len(users), args.signups))
+        ],
+        args.concurrency,
+    )
+    await stats.phase(
+        "roll teams",
+        [
+            (
+                "end_registration_match",
+                fakediscord.invoke(
+                    matches, "end_registration_match", FakeInteraction(guild, admin)
+                ),
+            )
+        ],
+        1,
+    )
+
+    async def veto_action():
+        interaction = FakeInteraction(guild, rng.choice(users))
+        if len(state.available_maps) > 1 and rng.random() < 0.6:
+            action = rng.choice(["ban", "pick"])
+            cs_map = rng.choice(state.available_maps)
+        elif state.banned_maps and rng.random() < 0.5:
+            action, cs_map = "unban", rng.choice(state.banned_maps)
+        elif state.picked_maps:
+            action, cs_map = "unpick", rng.choice(state.picked_maps)
+        else:
+            return
+        await stats.measure(
+            action, fakediscord.invoke(matches, action, interaction, map=cs_map)
+        )
+
+    await stats.phase(
+        "veto",
+        [("veto", veto_action()) for _ in range(args.veto_actions)],
+        args.veto_concurrency,
+    )
+
+    def autocomplete_job():
+        user = rng.choice(users)
+        kind = rng.randrange(4)
+        if kind == 0:
+            picked = rng.sample(MAP_POOL, k=rng.randrange(len(MAP_POOL)))
+            options = {f"m{i + 1}": cs_map for i, cs_map in enumerate(picked)}
+            current = rng.choice(MAP_POOL)[: rng.randrange(3)]
+            interaction = FakeInteraction(guild, user, **options)
+            return "autocomplete add_maps", fakediscord.autocomplete(
+                members, "add_maps", "m1", interaction, current
+            )
+        if kind == 1:
+            return "autocomplete set_rank", fakediscord.autocomplete(
+                members,
+                "set_rank",
+                "rank",
+                FakeInteraction(guild, user),
+                str(rng.randrange(20)),
+            )
+        if kind == 2:
+            return "autocomplete ban", fakediscord.autocomplete(
+                matches, "ban", "map", FakeInteraction(guild, user), ""
+            )
+        return "autocomplete set_playday", fakediscord.autocomplete(
+            matches, "set_playday", "day", FakeInteraction(guild, user), ""
+        )
+
+    await stats.phase(
+        "autocomplete",
+        [autocomplete_job() for _ in range(args.autocompletes)],
+        args.concurrency,
+    )
+    stats.requests = guild.requests
+    return stats
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--users", type=int, default=300)
+    parser.add_argument("--signups", type=int, default=40)
+    parser.add_argument("--matches", type=int, default=2)
+    parser.add_argument("--veto-actions", type=int, default=200)
+    parser.add_argument("--veto-concurrency", type=int, default=4)
+    parser.add_argument("--autocompletes", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="simulated discord round trip"
+    )
+    parser.add_argument("--seed", type=int, default=None)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    # The cogs persist state to ~/.csbot, keep the real state out of it
+    os.environ["HOME"] = tempfile.mkdtemp(prefix="csbot-loadtest-")
+    os.makedirs(f"{os.environ['HOME']}/.csbot")
+    fakediscord.offline_map_pool(MAP_POOL)
+    stats = asyncio.run(run(args))
+    print(stats.report())
+    print(f"\nrequests to fake discord: {stats.requests}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+
+### TESTS
+
+
+def test_small_load_test_runs_clean(tmp_path, monkeypatch):
+    import cachetools.keys
+    import csgo
+
+    monkeypatch.setenv("HOME", str(tmp_path))
+    monkeypatch.setitem(csgo.get_active_duty.cache, cachetools.keys.hashkey(), MAP_POOL)
+    args = parse_args(
+        ["--users", "12", "--signups", "10", "--veto-actions", "10", "--seed", "1"]
+    )
+    args.autocompletes = 50
+    stats = asyncio.run(run(args))
+    assert not stats.errors, stats.report()
+    assert stats.samples["reaction match"] and stats.samples["set_rank"]
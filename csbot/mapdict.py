@@ -1,11 +1,78 @@
 from __future__ import annotations
-import csgo
+import heapq
 import logging
 import traceback
-from copy import deepcopy
+from collections.abc import MutableMapping
 
 
-class MapDict(dict):
+class MapDict(MutableMapping):
+    """
+    Map name -> preference value.
+
+    Copies are copy-on-write, a copy shares the storage of the original until
+    either of them is changed, so copying a team's preferences costs nothing
+    unless the copy is modified.
+    """
+
+    def __new__(cls, *args, **kwargs):
+        # Set up the storage here and not in __init__, unpickling players stored
+        # while MapDict was a dict subclass only calls __new__ and then sets the items.
+        self = super().__new__(cls)
+        self._data = {}
+        self._shared = False
+        return self
+
+    def __init__(self, *args, **kwargs):
+        self._data.update(*args, **kwargs)
+
+    def _own(self):
+        if self._shared:
+            self._data = dict(self._data)
+            self._shared = False
+
+    def __getitem__(self, map):
+        return self._data[map]
+
+    def __setitem__(self, map, value):
+        self._own()
+        self._data[map] = value
+
+    def __delitem__(self, map):
+        self._own()
+        del self._data[map]
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, map):
+        return map in self._data
+
+    def __eq__(self, other):
+        if isinstance(other, MapDict):
+            return self._data == other._data
+        return self._data == other
+
+    def __repr__(self):
+        return repr(self._data)
+
+    def __reduce__(self):
+        return (self.__class__, (), None, None, iter(self._data.items()))
+
+    def get(self, map, default=None):
+        return self._data.get(map, default)
+
+    def keys(self):
+        return self._data.keys()
+
+    def values(self):
+        return self._data.values()
+
+    def items(self):
+        return self._data.items()
+
     def amplify_most_wanted(self):
         """
         Amplify the top 3 most wanted maps by a factor of 16, 8, and 4.
@@ -56,26 +123,68 @@ class MapDict(dict):
         """
         Return a list of maps sorted by their rank.
         """
-        return sorted(self, key=self.get, reverse=reverse)
+        return sorted(self._data, key=self._data.get, reverse=reverse)
 
-    def top_n_maps(self, n=len(csgo.get_active_duty())):
+    def top_n_maps(self, n=None):
         """
         Return the top n maps by ranking.
 
         PARAMETERS
         ----------
         n : int
-            The number of maps to return.
+            The number of maps to return, all maps if None.
 
         RETURNS
         -------
         list
             The top n maps by ranking.
         """
-        return sorted(self, key=self.get, reverse=True)[:n]
+        if n is None or n >= len(self._data):
+            return sorted(self._data, key=self._data.get, reverse=True)
+        return heapq.nlargest(n, self._data, key=self._data.get)
 
     def copy(self) -> MapDict:
         """
-        Return a copy of the MapDict.
+        Return a copy-on-write copy of the MapDict.
         """
-        return deepcopy(self)
+        copy = self.__class__.__new__(self.__class__)
+        copy._data = self._data
+        copy._shared = self._shared = True
+        return copy
+
+
+### TESTS
+
+
+def test_copy_on_write():
+    original = MapDict().from_list(["Ancient", "Anubis", "Inferno", "Mirage"])
+    copy = original.copy()
+    assert copy._data is original._data, "A copy should share the storage"
+    copy.remove_banned_maps(["Anubis"])
+    copy.amplify_most_wanted()
+    assert "Anubis" in original and "Anubis" not in copy
+    assert original == {"Ancient": 0, "Anubis": 1, "Inferno": 2, "Mirage": 3}
+    original.update_from_list(["Mirage", "Inferno", "Anubis", "Ancient"])
+    assert copy["Ancient"] == 0, "Changing the original should not change a copy"
+
+
+def test_pickle_as_dict_subclass():
+    """
+    Players pickled while MapDict subclassed dict should still load
+    """
+    import pickle
+
+    legacy = (
+        b"\x80\x04\x953\x00\x00\x00\x00\x00\x00\x00\x8c\x07mapdict\x94\x8c\x07MapDict"
+        b"\x94\x93\x94)R\x94(\x8c\x07Ancient\x94K\x00\x8c\x06Anubis\x94K\x01u."
+    )
+    maps = pickle.loads(legacy)
+    assert isinstance(maps, MapDict)
+    assert maps == {"Ancient": 0, "Anubis": 1}
+    assert pickle.loads(pickle.dumps(maps)) == maps
+
+
+def test_top_n_maps():
+    maps = MapDict({"Ancient": 3, "Anubis": 1, "Inferno": 3, "Mirage": 0})
+    assert maps.top_n_maps(2) == ["Ancient", "Inferno"]
+    assert maps.top_n_maps() == sorted(maps, key=maps.get, reverse=True)
@@ -0,0 +1,134 @@
+"""
+Match history of a guild.
+
+Every played match is appended as one json line to ~/.csbot/<guild id>/matches.jsonl,
+and so is the start of every season. Per player counters of appearances, last played
+date and maps played this season are kept up to date on every append, the log is only
+read once when the guild is first used.
+"""
+
+import os
+import json
+import logging
+from collections import Counter, defaultdict
+from datetime import datetime
+
+from guildstate import state_dir, state_file
+
+RESULTS = ("win", "loss", "draw")
+
+
+class MatchHistory:
+    def __init__(self, guild_id: int):
+        self.guild_id = guild_id
+        self.path = state_file(guild_id, "matches.jsonl")
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.partial_line = False
+        self._reset(None)
+        self.load()
+
+    def _reset(self, season):
+        self.season = season
+        self.matches = 0
+        self.appearances = Counter()
+        self.last_played = {}
+        self.maps_played = defaultdict(Counter)
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for number, line in enumerate(f, start=1):
+                    self.partial_line = not line.endswith("\n")
+                    try:
+                        self._count(json.loads(line))
+                    except (ValueError, KeyError):
+                        self.log.warning("Skipping line %s of %s", number, self.path)
+        except FileNotFoundError:
+            pass
+
+    def _count(self, match: dict):
+        if "season" in match:
+            self._reset(match["season"])
+            return
+        self.matches += 1
+        for player_id in match["team"]:
+            self.appearances[player_id] += 1
+            self.last_played[player_id] = max(
+                match["date"], self.last_played.get(player_id, match["date"])
+            )
+            self.maps_played[player_id].update(match["maps"])
+
+    def record(self, date: datetime, player_ids: list, maps: list, result: str):
+        """
+        Append a played match to the log and count it
+        """
+        match = {
+            "date": date.isoformat(timespec="minutes"),
+            "team": list(player_ids),
+            "maps": list(maps),
+            "result": result,
+        }
+        self._append(match)
+        return match
+
+    def start_season(self, date: datetime):
+        """
+        Append the start of a season to the log, the counters start over from it
+        """
+        self._append({"season": date.isoformat(timespec="minutes")})
+
+    def _append(self, entry: dict):
+        os.makedirs(state_dir(self.guild_id), exist_ok=True)
+        line = json.dumps(entry, separators=(",", ":")) + "\n"
+        if self.partial_line:
+            # Do not glue the match to a line cut short by a crash
+            line = "\n" + line
+            self.partial_line = False
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(line)
+        self._count(entry)
+
+    def summary(self, player_id: int) -> str:
+        appearances = self.appearances[player_id]
+        season = f" since {self.season[:10]}" if self.season else ""
+        if not appearances:
+            return f"No matches played this season{season}."
+        most_played = self.maps_played[player_id].most_common(3)
+        maps = ", ".join(f"{cs_map} ({count})" for cs_map, count in most_played)
+        return (
+            f"{appearances} of {self.matches} matches this season{season}, "
+            f"last on {self.last_played[player_id][:10]}, "
+            f"most played: {maps or 'no maps recorded'}"
+        )
+
+
+### TESTS
+
+
+def test_history_survives_reload(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    history = MatchHistory(1)
+    history.record(datetime(2024, 3, 6, 20), [10, 11], ["Nuke"], "win")
+    history.record(datetime(2024, 3, 13, 20), [10, 12], ["Nuke", "Mirage"], "loss")
+    with open(history.path, "a") as f:
+        f.write('{"date": "2024-03-20T20:00", "team": [1')  # interrupted write
+    reloaded = MatchHistory(1)
+    assert reloaded.matches == 2
+    reloaded.record(datetime(2024, 3, 27, 20), [12], ["Ancient"], "draw")
+    assert MatchHistory(1).matches == 3
+    assert reloaded.appearances[10] == 2 and reloaded.appearances[12] == 2
+    assert reloaded.last_played[10] == "2024-03-13T20:00"
+    assert reloaded.maps_played[10]["Nuke"] == 2
+
+
+def test_counters_start_over_every_season(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    history = MatchHistory(1)
+    history.record(datetime(2024, 3, 6, 20), [10, 11], ["Nuke"], "win")
+    history.start_season(datetime(2024, 8, 1, 12))
+    history.record(datetime(2024, 8, 7, 20), [11], ["Mirage"], "loss")
+    for counted in (history, MatchHistory(1)):
+        assert counted.matches == 1 and counted.season == "2024-08-01T12:00"
+        assert counted.appearances[10] == 0 and counted.appearances[11] == 1
+        assert counted.maps_played[11] == {"Mirage": 1}
+    assert history.summary(10) == "No matches played this season since 2024-08-01."
@@ -0,0 +1,365 @@
+"""
+Latency histograms and counters for CSBot.
+Exposed in prometheus text format on a local http port and summarized by /metrics.
+"""
+
+import time
+import asyncio
+import functools
+import inspect
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key: tuple, extra: dict = None) -> str:
+    items = list(key) + list((extra or {}).items())
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+
+class Counter:
+    """
+    Monotonically increasing counter, one value per label set
+    """
+
+    type = "counter"
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.values = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = _label_key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def expose(self) -> list:
+        return [
+            f"{self.name}{_format_labels(key)} {value}"
+            for key, value in self.values.items()
+        ]
+
+
+class Histogram:
+    """
+    Cumulative histogram, one set of buckets per label set
+    """
+
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self.series = {}
+
+    def observe(self, value: float, **labels):
+        key = _label_key(labels)
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = {
+                "buckets": [0] * len(self.buckets),
+                "sum": 0.0,
+                "count": 0,
+                "max": 0.0,
+            }
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series["buckets"][i] += 1
+                break
+        series["sum"] += value
+        series["count"] += 1
+        series["max"] = max(series["max"], value)
+
+    def quantile(self, q: float, **labels) -> float:
+        """
+        Estimate a quantile from the buckets, the upper bound of the bucket it falls in
+        capped at the largest observed value
+        """
+        series = self.series.get(_label_key(labels))
+        if not series or not series["count"]:
+            return 0.0
+        rank = q * series["count"]
+        seen = 0
+        for bound, count in zip(self.buckets, series["buckets"]):
+            seen += count
+            if seen >= rank:
+                return min(bound, series["max"])
+        return series["max"]
+
+    def expose(self) -> list:
+        lines = []
+        for key, series in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, series["buckets"]):
+                cumulative += count
+                lines.append(
+                    f"{self.name}_bucket{_format_labels(key, {'le': bound})} {cumulative}"
+                )
+            lines.append(
+                f"{self.name}_bucket{_format_labels(key, {'le': '+Inf'})} {series['count']}"
+            )
+            lines.append(f"{self.name}_sum{_format_labels(key)} {series['sum']}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {series['count']}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def _get(self, cls, name, help, **kwargs):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = cls(name, help, **kwargs)
+        return metric
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self._get(Counter, name, help)
+
+    def histogram(self, name: str, help: str, buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._get(Histogram, name, help, buckets=buckets)
+
+    def expose(self) -> str:
+        """
+        Render every metric in prometheus text format
+        """
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.expose())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+handler_seconds = REGISTRY.histogram(
+    "csbot_handler_seconds", "Time spent in app commands, autocompletes and listeners"
+)
+handler_errors = REGISTRY.counter(
+    "csbot_handler_errors_total", "Exceptions raised by handlers"
+)
+operation_seconds = REGISTRY.histogram(
+    "csbot_operation_seconds", "Time spent in internal operations and outbound calls"
+)
+
+
+class timed:
+    """
+    Time an operation into csbot_operation_seconds.
+    Works as a (async) context manager and as a decorator for functions and coroutines.
+
+    with timed("state.persist"):
+        ...
+
+    @timed("roll_teams")
+    def roll_teams(...):
+    """
+
+    def __init__(self, operation: str):
+        self.operation = operation
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        operation_seconds.observe(
+            time.perf_counter() - self.start, operation=self.operation
+        )
+        return False
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, *exc):
+        return self.__exit__(*exc)
+
+    def __call__(self, function):
+        if inspect.iscoroutinefunction(function):
+
+            @functools.wraps(function)
+            async def inner(*args, **kwargs):
+                with timed(self.operation):
+                    return await function(*args, **kwargs)
+
+        else:
+
+            @functools.wraps(function)
+            def inner(*args, **kwargs):
+                with timed(self.operation):
+                    return function(*args, **kwargs)
+
+        return inner
+
+
+def _instrument(function, kind: str, name: str):
+    if getattr(function, "__csbot_instrumented__", False):
+        return function
+
+    @functools.wraps(function)
+    async def inner(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await function(*args, **kwargs)
+        except Exception:
+            handler_errors.inc(kind=kind, name=name)
+            raise
+        finally:
+            handler_seconds.observe(time.perf_counter() - start, kind=kind, name=name)
+
+    inner.__csbot_instrumented__ = True
+    return inner
+
+
+def instrument_cog(cog):
+    """
+    Wrap every app command, autocomplete and listener of a cog with a timer.
+    Must be called before the cog is added to the bot.
+    """
+    for command in cog.walk_app_commands():
+        if not hasattr(command, "_params"):
+            continue
+        command._callback = _instrument(
+            command._callback, "command", command.qualified_name
+        )
+        for param in command._params.values():
+            if param.autocomplete is not None:
+                param.autocomplete = _instrument(
+                    param.autocomplete,
+                    "autocomplete",
+                    f"{command.qualified_name}.{param.name}",
+                )
+    for event, method_name in cog.__cog_listeners__:
+        setattr(
+            cog,
+            method_name,
+            _instrument(
+                getattr(cog, method_name),
+                "listener",
+                f"{cog.qualified_name}.{method_name}",
+            ),
+        )
+
+
+def instrument_http(http):
+    """
+    Time every request discord.py makes to the discord api, labeled by route
+    """
+    request = http.request
+    if getattr(request, "__csbot_instrumented__", False):
+        return
+
+    @functools.wraps(request)
+    async def inner(route, *args, **kwargs):
+        with timed(f"discord {route.method} {route.path}"):
+            return await request(route, *args, **kwargs)
+
+    inner.__csbot_instrumented__ = True
+    http.request = inner
+
+
+def summary(limit: int = 20) -> str:
+    """
+    Count, average, p95 and max of the busiest handlers and operations
+    """
+    rows = []
+    for histogram, label in (
+        (handler_seconds, "name"),
+        (operation_seconds, "operation"),
+    ):
+        for key, series in histogram.series.items():
+            labels = dict(key)
+            rows.append(
+                (
+                    series["count"],
+                    labels[label],
+                    series["sum"] / series["count"],
+                    histogram.quantile(0.95, **labels),
+                    series["max"],
+                )
+            )
+    rows.sort(reverse=True)
+    lines = [f"{'name':<40} {'count':>6} {'avg':>8} {'p95':>8} {'max':>8}"]
+    for count, name, avg, p95, max_ in rows[:limit]:
+        lines.append(f"{name[:40]:<40} {count:>6} {avg:>8.3f} {p95:>8.3f} {max_:>8.3f}")
+    return "\n".join(lines)
+
+
+async def _serve(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request = await reader.readline()
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        if request.split(b" ")[1:2] == [b"/metrics"]:
+            status, body = "200 OK", REGISTRY.expose()
+        else:
+            status, body = "404 Not Found", "not found\n"
+        payload = body.encode("utf-8")
+        header = (
+            f"HTTP/1.1 {status}\r\n"
+            "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(payload)}\r\n"
+            "Connection: close\r\n\r\n"
+        )
+        writer.write(header.encode("ascii") + payload)
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def start_http_server(
+    port: int, host: str = "127.0.0.1"
+) -> asyncio.AbstractServer:
+    """
+    Serve REGISTRY on http://host:port/metrics
+    """
+    return await asyncio.start_server(_serve, host, port)
+
+
+### TESTS
+
+
+def test_histogram_buckets():
+    """
+    Test that observations land in the right bucket and are exposed cumulatively
+    """
+    histogram = Histogram("test_seconds", "test", buckets=(0.1, 1.0))
+    histogram.observe(0.05, name="a")
+    histogram.observe(0.5, name="a")
+    histogram.observe(5, name="a")
+    exposed = histogram.expose()
+    assert 'test_seconds_bucket{name="a",le="0.1"} 1' in exposed
+    assert 'test_seconds_bucket{name="a",le="1.0"} 2' in exposed
+    assert 'test_seconds_bucket{name="a",le="+Inf"} 3' in exposed
+    assert 'test_seconds_count{name="a"} 3' in exposed
+    assert histogram.quantile(0.5, name="a") == 1.0
+    assert histogram.quantile(1.0, name="a") == 5
+
+
+def test_timed_decorator():
+    """
+    Test that timed records sync and async calls
+    """
+
+    @timed("test.sync")
+    def sync():
+        return 1
+
+    @timed("test.async")
+    async def coro():
+        return 2
+
+    assert sync() == 1
+    assert asyncio.run(coro()) == 2
+    assert (
+        operation_seconds.series[_label_key({"operation": "test.sync"})]["count"] == 1
+    )
+    assert (
+        operation_seconds.series[_label_key({"operation": "test.async"})]["count"] == 1
+    )
@@ -1,9 +1,21 @@
 import constants
 import random
+from bisect import bisect_right
 
 from csgo import get_active_duty
 from helperfunctions import euclidean_distance, DiscordString
 from mapdict import MapDict
+from steam import parse_steam_id
+from rankhistory import RankHistory
+
+
+def rank_title(rank: int) -> str:
+    """
+    The title of the highest rank threshold at or below rank
+    """
+    return constants.rank_titles[
+        max(0, bisect_right(constants.rank_thresholds, rank) - 1)
+    ]
 
 
 class Player:
@@ -18,9 +30,18 @@ class Player:
     :param matches: The number of matches the player has played
     :param maps: The map preferences of the player
     :param igl: Whether the player is the in-game leader
+    :param steam_name: The steam persona name, set by the steam sync
+    :param steam_bans: The VAC and game ban record from steam, set by the steam sync
+    :param rank_history: Every rank the player has set, see RankHistory
 
     """
 
+    # Defaults for players stored before the steam sync existed
+    steam_name = None
+    steam_profile = None
+    steam_bans = None
+    rank_history = None
+
     def __init__(self, id, name, display_name):
         self.id = id
         self.display_name = display_name
@@ -36,6 +57,27 @@ class Player:
     def set_igl(self, val: bool):
         self.igl = val
 
+    def set_steam_id(self, steam_id: str):
+        """
+        Link a steam account, from its SteamID64 or profile url
+        """
+        self.steam_id = parse_steam_id(steam_id)
+        self.steam_name = self.steam_profile = self.steam_bans = None
+
+    def update_steam(self, summary: dict, bans: dict):
+        """
+        Update the player from a steam player summary and ban record
+        """
+        if summary is not None:
+            self.steam_name = summary.get("personaname")
+            self.steam_profile = summary.get("profileurl")
+        if bans is not None:
+            self.steam_bans = {
+                "vac": bans.get("NumberOfVACBans", 0),
+                "game": bans.get("NumberOfGameBans", 0),
+                "days_since_last": bans.get("DaysSinceLastBan", 0),
+            }
+
     def set_rank(self, rank: int):
         """
         Set the rank of the player and update the title
@@ -43,13 +85,20 @@ class Player:
         if rank < 0:
             rank = 0
         self.rank = rank
-        title = None
-        for r in sorted(constants.ranks.keys(), key=int):
-            if r <= int(rank):
-                title = constants.ranks[r]
-            else:
-                break
-        self.title = title
+        self.title = rank_title(int(rank))
+        if self.rank_history is None:
+            self.rank_history = RankHistory()
+        self.rank_history.add(int(rank))
+
+    def effective_rank(self) -> float:
+        """
+        The rank used for balancing teams, the current rank blended with the
+        recent average by constants.rank_form_weight
+        """
+        weight = constants.rank_form_weight
+        if not weight or not self.rank_history:
+            return self.rank
+        return (1 - weight) * self.rank + weight * self.rank_history.recent_average()
 
     def rank_map(self, map, rank):
         if rank < 0:
@@ -0,0 +1,190 @@
+"""
+On demand cpu and memory profiling of the running bot.
+Results are written to ~/.csbot/profiles
+"""
+
+import io
+import os
+import sys
+import time
+import pstats
+import asyncio
+import cProfile
+import threading
+import tracemalloc
+from pathlib import Path
+from collections import Counter
+from datetime import datetime
+
+PROFILE_DIR = f"{Path.home()}/.csbot/profiles"
+# Longest timed profile, the reply has to be sent within the 15 minutes
+# discord keeps an interaction token valid
+MAX_PROFILE_SECONDS = 600
+
+
+class SamplingProfiler(threading.Thread):
+    """
+    Samples the stack of a thread at a fixed interval from a background thread.
+    Much cheaper than cProfile, which hooks every function call.
+    """
+
+    def __init__(self, thread_id: int, interval: float = 0.005):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.running = threading.Event()
+
+    def run(self):
+        self.running.set()
+        while self.running.is_set():
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(
+                    f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+                )
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+                self.samples += 1
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.running.clear()
+        self.join()
+
+    def dump(self, path: str):
+        """
+        Write the samples as collapsed stacks, the input format of flamegraph.pl
+        """
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+    def top(self, n: int) -> str:
+        """
+        Functions that were on top of the stack the most
+        """
+        leaves = Counter()
+        for stack, count in self.stacks.items():
+            leaves[stack.rsplit(";", 1)[-1]] += count
+        lines = [f"{self.samples} samples every {self.interval * 1000:.0f}ms"]
+        for frame, count in leaves.most_common(n):
+            lines.append(f"{count / max(self.samples, 1):>6.1%} {frame}")
+        return "\n".join(lines)
+
+
+class Profiler:
+    """
+    Holds the profiling state of the bot, only one cpu profile can run at a time
+    """
+
+    def __init__(self, directory: str = PROFILE_DIR):
+        self.directory = directory
+        self.cpu = None
+        self.mode = None
+        self.snapshot = None
+
+    def _path(self, kind: str, suffix: str) -> str:
+        os.makedirs(self.directory, exist_ok=True)
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        return f"{self.directory}/{kind}-{stamp}.{suffix}"
+
+    def start(self, mode: str = "sample"):
+        """
+        Start a cpu profile of the calling thread
+
+        PARAMETERS
+        ----------
+        mode : str
+            "sample" for the sampling profiler, "cprofile" for a deterministic profile
+        """
+        if self.cpu is not None:
+            raise RuntimeError(f"A {self.mode} profile is already running")
+        if mode == "cprofile":
+            self.cpu = cProfile.Profile()
+            self.cpu.enable()
+        elif mode == "sample":
+            self.cpu = SamplingProfiler(threading.get_ident())
+            self.cpu.start()
+        else:
+            raise ValueError(f"Unknown profile mode {mode}")
+        self.mode = mode
+
+    def stop(self, top: int = 15) -> tuple:
+        """
+        Stop the running cpu profile and write it to disk
+
+        RETURNS
+        -------
+        tuple
+            (path of the profile, summary of the top functions)
+        """
+        if self.cpu is None:
+            raise RuntimeError("No profile is running")
+        cpu, mode = self.cpu, self.mode
+        self.cpu = self.mode = None
+        if mode == "cprofile":
+            cpu.disable()
+            path = self._path("cpu", "prof")
+            cpu.dump_stats(path)
+            out = io.StringIO()
+            pstats.Stats(cpu, stream=out).sort_stats("cumulative").print_stats(top)
+            return path, out.getvalue()
+        cpu.stop()
+        path = self._path("cpu", "collapsed")
+        cpu.dump(path)
+        return path, cpu.top(top)
+
+    async def profile_for(self, seconds: int, mode: str = "sample", top: int = 15):
+        """
+        Profile the event loop for a number of seconds, at most MAX_PROFILE_SECONDS
+        """
+        if not 0 < seconds <= MAX_PROFILE_SECONDS:
+            raise ValueError(
+                f"Profile for 1 to {MAX_PROFILE_SECONDS} seconds, not {seconds}"
+            )
+        self.start(mode)
+        await asyncio.sleep(seconds)
+        return self.stop(top)
+
+    def take_snapshot(self, top: int = 15, diff: bool = False) -> tuple:
+        """
+        Take a tracemalloc snapshot, optionally diffed against the previous snapshot.
+        The first call starts tracing, so allocations made before it are not tracked.
+
+        RETURNS
+        -------
+        tuple
+            (path of the snapshot, summary of the top allocation sites)
+        """
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(25)
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            (
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            )
+        )
+        path = self._path("memory", "snapshot")
+        snapshot.dump(path)
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [f"traced {current / 1024:.1f} KiB, peak {peak / 1024:.1f} KiB"]
+        if not diff or self.snapshot is None:
+            stats = snapshot.statistics("lineno")
+        else:
+            stats = snapshot.compare_to(self.snapshot, "lineno")
+            lines[0] += " (diff against previous snapshot)"
+        lines.extend(str(stat) for stat in stats[:top])
+        self.snapshot = snapshot
+        return path, "\n".join(lines)
+
+    def stop_tracing(self):
+        """
+        Stop tracemalloc, tracing costs memory and cpu on every allocation
+        """
+        tracemalloc.stop()
+        self.snapshot = None
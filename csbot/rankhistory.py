@@ -0,0 +1,156 @@
+"""
+Rank history of a player.
+
+Every rank change is appended to two compact arrays, timestamps and ratings.
+Recent average, volatility and trend are exponentially weighted aggregates that
+are updated on every append, so reading them never scans the history.
+"""
+
+import math
+import time
+from array import array
+
+DAY = 86400
+WEEK = 7 * DAY
+
+
+class RankHistory:
+    """
+    :param half_life: Days after which a rating weighs half as much in the aggregates
+    :param max_points: Points kept before old points are downsampled
+    :param keep_days: Points younger than this are never downsampled
+    """
+
+    def __init__(self, half_life: float = 30, max_points: int = 256, keep_days=90):
+        self.half_life = half_life
+        self.max_points = max_points
+        self.keep_days = keep_days
+        self.timestamps = array("d")
+        self.ratings = array("i")
+        # Exponentially weighted sums of 1, t, x, t*t and t*x, t in days since start
+        self.start = None
+        self.sums = [0.0] * 5
+        self.mean = 0.0
+        self.variance = 0.0
+
+    def __len__(self):
+        return len(self.ratings)
+
+    def _decay(self, since: float, until: float) -> float:
+        return 0.5 ** (max(0.0, until - since) / DAY / self.half_life)
+
+    def _blend(self, mean: float, variance: float, rating: int, decay: float):
+        """
+        Weigh in a rating that was held for the time that decays the old weights by decay
+        """
+        delta = rating - mean
+        return mean + (1 - decay) * delta, decay * (
+            variance + (1 - decay) * delta * delta
+        )
+
+    def add(self, rating: int, timestamp: float = None):
+        """
+        Record a rating, unless it is the same as the last one
+        """
+        if self.ratings and self.ratings[-1] == rating:
+            return
+        timestamp = time.time() if timestamp is None else timestamp
+        if self.start is None:
+            self.start = timestamp
+            self.mean = rating
+            decay = 0.0
+        else:
+            # The average weighs every rating by how long it was held
+            decay = self._decay(self.timestamps[-1], timestamp)
+            self.mean, self.variance = self._blend(
+                self.mean, self.variance, self.ratings[-1], decay
+            )
+        t = (timestamp - self.start) / DAY
+        for i, value in enumerate((1, t, rating, t * t, t * rating)):
+            self.sums[i] = self.sums[i] * decay + value
+        self.timestamps.append(timestamp)
+        self.ratings.append(rating)
+        if len(self.ratings) > self.max_points:
+            self.downsample(timestamp - self.keep_days * DAY)
+
+    def downsample(self, before: float):
+        """
+        Keep only the last rating of every week for the points older than before
+        """
+        timestamps, ratings = array("d"), array("i")
+        weeks = [timestamp // WEEK for timestamp in self.timestamps]
+        weeks.append(None)
+        for i, (timestamp, rating) in enumerate(zip(self.timestamps, self.ratings)):
+            last_of_week = weeks[i + 1] != weeks[i]
+            if timestamp >= before or last_of_week:
+                timestamps.append(timestamp)
+                ratings.append(rating)
+        self.timestamps, self.ratings = timestamps, ratings
+
+    def _now(self, now: float = None) -> tuple:
+        if not self.ratings:
+            return 0.0, 0.0
+        now = time.time() if now is None else now
+        decay = self._decay(self.timestamps[-1], now)
+        return self._blend(self.mean, self.variance, self.ratings[-1], decay)
+
+    def recent_average(self, now: float = None) -> float:
+        """
+        Exponentially weighted average of the ratings, weighted by how long they were held
+        """
+        return self._now(now)[0]
+
+    def volatility(self, now: float = None) -> float:
+        """
+        Exponentially weighted standard deviation of the ratings
+        """
+        return math.sqrt(self._now(now)[1])
+
+    def trend(self) -> float:
+        """
+        Rating change per day, the slope of an exponentially weighted least squares fit
+        """
+        n, t, x, tt, tx = self.sums
+        denominator = n * tt - t * t
+        if len(self.ratings) < 2 or denominator <= 1e-12:
+            return 0.0
+        return (n * tx - t * x) / denominator
+
+    def sparkline(self, points: int = 20) -> str:
+        ratings = self.ratings[-points:]
+        if not ratings:
+            return ""
+        low, high = min(ratings), max(ratings)
+        bars = "▁▂▃▄▅▆▇█"
+        return "".join(
+            bars[(rating - low) * (len(bars) - 1) // max(high - low, 1)]
+            for rating in ratings
+        )
+
+
+### TESTS
+
+
+def test_aggregates():
+    history = RankHistory(half_life=30)
+    for day in range(60):
+        history.add(10000 + 50 * day, day * DAY)
+    assert abs(history.trend() - 50) < 1e-6, "A linear series has a constant trend"
+    assert 10000 + 50 * 20 < history.recent_average(60 * DAY) < 10000 + 50 * 59
+    history.add(history.ratings[-1], 61 * DAY)
+    assert len(history) == 60, "An unchanged rating should not be recorded"
+    before = history.recent_average(62 * DAY)
+    history.add(20000, 61 * DAY)
+    history.add(history.ratings[-2], 61 * DAY + 60)
+    assert (
+        abs(history.recent_average(62 * DAY) - before) < 1
+    ), "A rating held for a minute should barely count"
+
+
+def test_downsample():
+    history = RankHistory(max_points=100, keep_days=14)
+    for hour in range(0, 24 * 60, 6):
+        history.add(5000 + hour, hour * 3600.0)
+    assert len(history) <= 100
+    assert history.ratings[-1] == 5000 + 24 * 60 - 6
+    assert list(history.timestamps) == sorted(history.timestamps)
@@ -0,0 +1,55 @@
+"""
+Cached rendering of the sections of a message.
+A section is only rendered again after it was invalidated, so editing a message
+costs the sections that changed and a single join.
+"""
+
+
+class MessageSections:
+    """
+    Named sections of a message, each rendered by a function without arguments.
+    Sections start out dirty and are rendered on first use.
+    """
+
+    def __init__(self):
+        self.renderers = {}
+        self.cache = {}
+        self.dirty = set()
+
+    def section(self, name: str, render):
+        self.renderers[name] = render
+        self.dirty.add(name)
+
+    def invalidate(self, *names):
+        """
+        Mark sections to be rendered again, all sections if none are given
+        """
+        self.dirty.update(names or self.renderers)
+
+    def __getitem__(self, name: str):
+        if name in self.dirty:
+            self.cache[name] = self.renderers[name]()
+            self.dirty.discard(name)
+        return self.cache[name]
+
+    def join(self, *names) -> str:
+        return "".join(self[name] for name in names)
+
+
+### TESTS
+
+
+def test_sections_render_when_dirty():
+    renders = []
+    values = {"a": "1", "b": "2"}
+    sections = MessageSections()
+    for name in values:
+        sections.section(name, lambda name=name: renders.append(name) or values[name])
+    assert sections.join("a", "b") == "12"
+    values["a"], values["b"] = "3", "4"
+    assert sections.join("a", "b") == "12", "Clean sections should come from the cache"
+    sections.invalidate("b")
+    assert sections.join("a", "b") == "14"
+    assert renders == ["a", "b", "b"]
+    sections.invalidate()
+    assert sections.join("b", "a") == "43"
@@ -0,0 +1,136 @@
+"""
+Bulk updates of the registered players of a guild.
+
+Ranks are imported from csv rows of `player,rank`, where player is the discord id,
+name or display name of a registered player. A header row is optional.
+"""
+
+import csv
+
+# Largest csv accepted, a row per player is far below this
+MAX_IMPORT_BYTES = 1 << 20
+
+
+class ImportResult:
+    def __init__(self):
+        self.updated = 0
+        self.unknown = []
+        self.ambiguous = []
+        self.errors = []
+
+    def summary(self) -> str:
+        if self.errors:
+            lines = ["Nothing was imported:", *self.errors]
+        else:
+            lines = [f"Updated the rank of {self.updated} players."]
+        if self.unknown:
+            lines.append(f"Unknown players: {', '.join(self.unknown)}")
+        if self.ambiguous:
+            lines.append(
+                f"Names of several players, use their id: {', '.join(self.ambiguous)}"
+            )
+        return "\n".join(lines)
+
+
+def player_index(players: dict) -> dict:
+    """
+    Lookup of players by id, name and display name,
+    a name shared by several players maps to None
+    """
+    index = {}
+    for player in players.values():
+        for name in {player.display_name.lower(), player.name.lower()}:
+            if name in index and index[name] is not player:
+                index[name] = None
+            else:
+                index[name] = player
+    for player in players.values():
+        index[str(player.id)] = player
+    return index
+
+
+def import_ranks(players: dict, lines) -> ImportResult:
+    """
+    Set the ranks of players from csv lines, all or nothing.
+    The lines are parsed one at a time, no rank is changed unless every row is valid.
+
+    PARAMETERS
+    ----------
+    players : dict
+        player id -> Player of a guild
+    lines : iterable
+        Lines of csv, e.g. an open file
+
+    RETURNS
+    -------
+    ImportResult
+        Number of updated players, unknown and ambiguous players and invalid rows
+    """
+    result = ImportResult()
+    index = player_index(players)
+    updates = {}
+    for line, row in enumerate(csv.reader(lines), start=1):
+        if not row or not "".join(row).strip():
+            continue
+        if len(row) < 2:
+            result.errors.append(f"line {line}: expected player,rank")
+            continue
+        name, rank = row[0].strip(), row[1].strip()
+        try:
+            rank = int(rank)
+        except ValueError:
+            if line == 1:
+                continue  # header
+            result.errors.append(f"line {line}: rank must be a number")
+            continue
+        if rank < 0:
+            result.errors.append(f"line {line}: rank must be 0 or higher")
+            continue
+        if name.lower() not in index:
+            result.unknown.append(name)
+            continue
+        player = index[name.lower()]
+        if player is None:
+            result.ambiguous.append(name)
+            continue
+        updates[player.id] = rank
+    if result.errors:
+        return result
+    for player_id, rank in updates.items():
+        players[player_id].set_rank(rank)
+    result.updated = len(updates)
+    return result
+
+
+### TESTS
+
+
+class _Player:
+    def __init__(self, id, name):
+        self.id = id
+        self.name = self.display_name = name
+        self.rank = 0
+
+    def set_rank(self, rank):
+        self.rank = rank
+
+
+def test_import_ranks():
+    players = {1: _Player(1, "alice"), 2: _Player(2, "bob")}
+    result = import_ranks(players, ["player,rank", "Alice,12000", "2,9000", "eve,1"])
+    assert result.updated == 2 and result.unknown == ["eve"]
+    assert players[1].rank == 12000 and players[2].rank == 9000
+
+
+def test_import_ranks_is_all_or_nothing():
+    players = {1: _Player(1, "alice"), 2: _Player(2, "bob")}
+    result = import_ranks(players, ["alice,12000", "bob,many"])
+    assert result.errors == ["line 2: rank must be a number"]
+    assert players[1].rank == 0, "No rank should change when a row is invalid"
+
+
+def test_ambiguous_names_are_rejected():
+    players = {1: _Player(1, "sam"), 2: _Player(2, "Sam"), 3: _Player(3, "bob")}
+    result = import_ranks(players, ["sam,12000", "1,9000", "bob,5000"])
+    assert result.ambiguous == ["sam"] and result.updated == 2
+    assert players[1].rank == 9000 and players[2].rank == 0
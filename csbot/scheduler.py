@@ -0,0 +1,243 @@
+"""
+Persistent scheduler for CSBot.
+
+Jobs are kept in a heap ordered by due time and run by a single task, no matter how
+many are pending. Every change is appended to a journal file, which is replayed on
+start so jobs survive restarts, and compacted once it is mostly stale.
+Jobs that came due while the bot was down run as soon as it is back.
+"""
+
+import os
+import json
+import time
+import heapq
+import uuid
+import asyncio
+import logging
+from datetime import datetime
+
+# Longest sleep between checks of the heap, so changes of the system clock are noticed
+MAX_SLEEP = 60
+
+
+class Job:
+    def __init__(self, id: str, when: float, kind: str, data: dict, grace=None):
+        self.id = id
+        self.when = when
+        self.kind = kind
+        self.data = data
+        self.grace = grace
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "when": self.when,
+            "kind": self.kind,
+            "data": self.data,
+            "grace": self.grace,
+        }
+
+
+class Scheduler:
+    """
+    :param path: Journal file of the pending jobs
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.jobs = {}
+        self.heap = []
+        self.handlers = {}
+        self.journal = None
+        self.journal_lines = 0
+        self.task = None
+        self.wakeup = asyncio.Event()
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    if entry.get("op") == "add":
+                        job = Job(**entry["job"])
+                        self.jobs[job.id] = job
+                    else:
+                        self.jobs.pop(entry.get("id"), None)
+        except FileNotFoundError:
+            pass
+        self.heap = [(job.when, job.id) for job in self.jobs.values()]
+        heapq.heapify(self.heap)
+        self.compact()
+
+    def compact(self):
+        """
+        Rewrite the journal with only the pending jobs
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        if self.journal is not None:
+            self.journal.close()
+        with open(f"{self.path}.tmp", "w", encoding="utf-8") as f:
+            for job in self.jobs.values():
+                f.write(json.dumps({"op": "add", "job": job.to_dict()}) + "\n")
+        os.replace(f"{self.path}.tmp", self.path)
+        self.journal = open(self.path, "a", encoding="utf-8")
+        self.journal_lines = len(self.jobs)
+
+    def _append(self, entry: dict):
+        self.journal.write(json.dumps(entry) + "\n")
+        self.journal.flush()
+        self.journal_lines += 1
+        if self.journal_lines > 2 * len(self.jobs) + 1000:
+            self.compact()
+
+    def register(self, kind: str, handler):
+        """
+        Run handler(job) for due jobs of a kind, handlers are coroutine functions
+        """
+        self.handlers[kind] = handler
+
+    def schedule(
+        self, when, kind: str, key: str = None, grace: float = None, **data
+    ) -> str:
+        """
+        Schedule a job, replacing the pending job with the same kind and key
+
+        PARAMETERS
+        ----------
+        when : datetime or float
+            When the job is due, a datetime or unix timestamp
+        key : str
+            Identifies the job within its kind, e.g. a guild id
+        grace : float
+            Seconds after which a job that could not run on time is dropped,
+            by default it runs however late it is
+        data
+            Json serializable arguments for the handler
+
+        RETURNS
+        -------
+        str
+            The job id
+        """
+        if isinstance(when, datetime):
+            when = when.timestamp()
+        job_id = f"{kind}:{key}" if key is not None else uuid.uuid4().hex
+        job = Job(job_id, when, kind, data, grace)
+        self.jobs[job_id] = job
+        heapq.heappush(self.heap, (when, job_id))
+        self._append({"op": "add", "job": job.to_dict()})
+        self.wakeup.set()
+        return job_id
+
+    def cancel(self, job_id: str) -> bool:
+        """
+        Cancel a pending job, the heap entry is skipped when it comes up
+        """
+        if self.jobs.pop(job_id, None) is None:
+            return False
+        self._append({"op": "done", "id": job_id})
+        return True
+
+    def cancel_key(self, kind: str, key: str) -> bool:
+        return self.cancel(f"{kind}:{key}")
+
+    def pending(self, kind: str = None) -> list:
+        return sorted(
+            (job for job in self.jobs.values() if kind is None or job.kind == kind),
+            key=lambda job: job.when,
+        )
+
+    def _pop_due(self, now: float) -> list:
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            when, job_id = heapq.heappop(self.heap)
+            job = self.jobs.get(job_id)
+            # Skip cancelled jobs and entries of jobs that were scheduled again
+            if job is None or job.when != when:
+                continue
+            del self.jobs[job_id]
+            self._append({"op": "done", "id": job_id})
+            due.append(job)
+        return due
+
+    async def _run(self, job: Job, now: float):
+        if job.grace is not None and now - job.when > job.grace:
+            self.log.warning("Dropping %s, %.0fs late", job.id, now - job.when)
+            return
+        handler = self.handlers.get(job.kind)
+        if handler is None:
+            self.log.warning("No handler for %s", job.id)
+            return
+        try:
+            await handler(job)
+        except Exception:
+            self.log.exception("Job %s failed", job.id)
+
+    async def run(self):
+        while True:
+            now = time.time()
+            for job in self._pop_due(now):
+                asyncio.create_task(self._run(job, now))
+            self.wakeup.clear()
+            timeout = MAX_SLEEP
+            if self.heap:
+                timeout = min(MAX_SLEEP, max(0.0, self.heap[0][0] - time.time()))
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+
+### TESTS
+
+
+def test_jobs_survive_restart(tmp_path):
+    path = str(tmp_path / "schedule.jsonl")
+    fired = []
+
+    async def handler(job):
+        fired.append(job.data["n"])
+
+    async def run():
+        scheduler = Scheduler(path)
+        now = time.time()
+        for n in range(2000):
+            scheduler.schedule(now + 3600 + n, "test", n=n)
+        scheduler.schedule(now - 5, "test", key="late", n=-1)
+        scheduler.schedule(now - 5, "test", key="stale", grace=1, n=-2)
+        scheduler.schedule(now + 0.05, "test", key="soon", n=-3)
+        scheduler.schedule(now + 0.01, "test", key="cancelled", n=-4)
+        scheduler.cancel_key("test", "cancelled")
+        await scheduler.stop()
+
+        scheduler = Scheduler(path)
+        assert len(scheduler.pending()) == 2003
+        scheduler.register("test", handler)
+        scheduler.start()
+        await asyncio.sleep(0.2)
+        await scheduler.stop()
+        assert sorted(fired) == [-3, -1], "Due jobs should run, stale ones dropped"
+        assert len(Scheduler(path).pending()) == 2000
+
+    asyncio.run(run())
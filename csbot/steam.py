@@ -1,5 +1,273 @@
 """
 Steam API plugin for CSBot
+
+Resolves linked steam accounts through the bulk endpoints of the Steam Web API,
+100 accounts per request, with a bounded number of concurrent requests,
+a token bucket per api key and a cache of the responses.
 """
 
+import re
+import time
+import asyncio
+import logging
+
+import aiohttp
+from cachetools import TTLCache
+
+from metrics import timed
+
+STEAM_API = "https://api.steampowered.com"
+SUMMARIES = "ISteamUser/GetPlayerSummaries/v2/"
+BANS = "ISteamUser/GetPlayerBans/v1/"
+# The bulk endpoints take at most 100 steam ids per request
+BATCH_SIZE = 100
+
+_steam_id = re.compile(r"^(?:https?://steamcommunity\.com/profiles/)?(7656\d{13})/?$")
+
+
+def parse_steam_id(value: str) -> str:
+    """
+    The SteamID64 of a steam id or profile url
+
+    Raises ValueError for anything else, vanity urls are not resolved.
+    """
+    match = _steam_id.match(value.strip())
+    if not match:
+        raise ValueError(
+            f"{value} is not a steam id, use the 17 digit id or the /profiles/ url"
+        )
+    return match.group(1)
+
+
+class SteamError(Exception):
+    pass
+
+
+class TokenBucket:
+    """
+    Allows rate requests per second on average, and bursts of up to capacity
+    """
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self) -> float:
+        self._refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    async def acquire(self):
+        async with self.lock:
+            while self.wait_time() > 0:
+                await asyncio.sleep(self.wait_time())
+            self.tokens -= 1
+
+
+class SteamClient:
+    """
+    Client for the bulk player endpoints of the Steam Web API
+
+    :param keys: Steam Web API keys, requests are spread over the keys
+    :param rate: Requests per second allowed per key
+    :param burst: Requests a key may make at once before being limited
+    :param concurrency: Maximum number of requests in flight
+    :param cache_ttl: Seconds a player summary or ban record is cached
+    """
+
+    def __init__(
+        self,
+        keys: list,
+        base_url: str = STEAM_API,
+        rate: float = 1.0,
+        burst: int = 5,
+        concurrency: int = 4,
+        cache_ttl: int = 3600,
+        retries: int = 3,
+    ):
+        if not keys:
+            raise ValueError("No steam api key")
+        self.base_url = base_url.rstrip("/")
+        self.buckets = {key: TokenBucket(rate, burst) for key in keys}
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.cache = TTLCache(maxsize=100_000, ttl=cache_ttl)
+        self.retries = retries
+        self.requests = 0
+        self.session = None
+        self.log = logging.getLogger(self.__class__.__name__)
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def open(self):
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=30)
+            )
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def _key(self) -> str:
+        """
+        The key that can make a request the soonest
+        """
+        key = min(self.buckets, key=lambda key: self.buckets[key].wait_time())
+        await self.buckets[key].acquire()
+        return key
+
+    async def _get(self, endpoint: str, steam_ids: list) -> dict:
+        await self.open()
+        async with self.semaphore:
+            for attempt in range(self.retries + 1):
+                params = {"key": await self._key(), "steamids": ",".join(steam_ids)}
+                self.requests += 1
+                async with timed(f"steam.{endpoint.split('/')[1]}"):
+                    async with self.session.get(
+                        f"{self.base_url}/{endpoint}", params=params
+                    ) as response:
+                        if response.status == 200:
+                            return await response.json()
+                        retry_after = response.headers.get("Retry-After")
+                if response.status != 429 and response.status < 500:
+                    raise SteamError(f"{endpoint} returned {response.status}")
+                delay = float(retry_after) if retry_after else 2**attempt
+                self.log.warning(
+                    "%s returned %s, retrying in %ss", endpoint, response.status, delay
+                )
+                await asyncio.sleep(delay)
+        raise SteamError(f"{endpoint} returned {response.status}")
+
+    async def _bulk(self, kind: str, endpoint: str, steam_ids: list, parse) -> dict:
+        """
+        Fetch the uncached ids in batches of BATCH_SIZE, concurrently
+        """
+        result, missing = {}, []
+        for steam_id in dict.fromkeys(steam_ids):
+            if (kind, steam_id) in self.cache:
+                result[steam_id] = self.cache[kind, steam_id]
+            else:
+                missing.append(steam_id)
+        batches = []
+        for start in range(0, len(missing), BATCH_SIZE):
+            end = start + BATCH_SIZE
+            batches.append(missing[start:end])
+        responses = await asyncio.gather(
+            *(self._get(endpoint, batch) for batch in batches)
+        )
+        for response in responses:
+            for steam_id, value in parse(response):
+                self.cache[kind, steam_id] = result[steam_id] = value
+        return result
+
+    async def get_player_summaries(self, steam_ids: list) -> dict:
+        """
+        RETURNS
+        -------
+        dict
+            steam id -> player summary, ids without a public profile are left out
+        """
+        return await self._bulk(
+            "summary",
+            SUMMARIES,
+            steam_ids,
+            lambda response: (
+                (player["steamid"], player)
+                for player in response["response"]["players"]
+            ),
+        )
+
+    async def get_player_bans(self, steam_ids: list) -> dict:
+        """
+        RETURNS
+        -------
+        dict
+            steam id -> VAC, game and community ban record
+        """
+        return await self._bulk(
+            "bans",
+            BANS,
+            steam_ids,
+            lambda response: (
+                (player["SteamId"], player) for player in response["players"]
+            ),
+        )
+
+    async def sync_players(self, players: dict) -> int:
+        """
+        Update the steam profile and bans of every player with a linked account
+
+        RETURNS
+        -------
+        int
+            Number of players updated
+        """
+        linked = [player for player in players.values() if player.steam_id]
+        steam_ids = [player.steam_id for player in linked]
+        summaries, bans = await asyncio.gather(
+            self.get_player_summaries(steam_ids), self.get_player_bans(steam_ids)
+        )
+        updated = 0
+        for player in linked:
+            summary = summaries.get(player.steam_id)
+            ban = bans.get(player.steam_id)
+            if summary is None and ban is None:
+                continue
+            player.update_steam(summary, ban)
+            updated += 1
+        return updated
+
+
+### TESTS
+
+
+def test_sync_against_fake_steam():
+    import fakesteam
+
+    class _Player:
+        def __init__(self, steam_id):
+            self.steam_id = steam_id
+
+        def update_steam(self, summary, bans):
+            self.steam_name = summary["personaname"]
+            self.vac_banned = bans["VACBanned"]
+
+    async def run():
+        steam_ids = [str(76561197960265728 + i) for i in range(250)]
+        async with fakesteam.FakeSteam(steam_ids) as api:
+            players = {i: _Player(steam_id) for i, steam_id in enumerate(steam_ids)}
+            players["unlinked"] = _Player(None)
+            async with SteamClient(["k1", "k2"], api.url, rate=100) as client:
+                assert await client.sync_players(players) == 250
+                assert client.requests == 6, "3 batches of summaries and of bans"
+                assert await client.sync_players(players) == 250
+                assert client.requests == 6, "The second sync should be cached"
+            assert players[0].steam_name == f"player{steam_ids[0]}"
+            assert api.max_batch == BATCH_SIZE
+
+    asyncio.run(run())
+
 
+def test_parse_steam_id():
+    assert parse_steam_id("76561197960265728") == "76561197960265728"
+    url = "https://steamcommunity.com/profiles/76561197960265728/"
+    assert parse_steam_id(url) == "76561197960265728"
+    try:
+        parse_steam_id("gaben")
+    except ValueError:
+        pass
+    else:
+        assert False, "Vanity names are not steam ids"
@@ -0,0 +1,374 @@
+"""
+Substitutes for players who drop out of a rolled team.
+
+The registered players are kept in a k-d tree over their rank and map preferences.
+How much a substitute changes the score of a team is a sum of one convex term per
+dimension, so the best score any player inside a node of the tree can reach is known
+from the node's bounding box, and nodes that cannot beat the best candidates found so
+far are never visited.
+
+The same search fills the holes of repair_teams, which fixes up rolled teams after
+the signups changed instead of rolling them again.
+"""
+
+import heapq
+import statistics
+
+import constants
+from csgo import get_active_duty
+from metrics import timed
+from team import Team
+
+LEAF_SIZE = 8
+
+
+class PlayerIndex:
+    """
+    k-d tree over the effective rank and the map preferences of players
+
+    :param players: The players to index
+    :param maps: The maps of the preference vectors, in order
+    """
+
+    def __init__(self, players: list, maps: list):
+        self.maps = list(maps)
+        self.players = list(players)
+        self.points = [self.vector(player) for player in self.players]
+        self.order = list(range(len(self.players)))
+        # Nodes are [low corner, high corner, start, end, left child, right child]
+        self.nodes = []
+        if self.order:
+            self._build(0, len(self.order))
+
+    def vector(self, player) -> tuple:
+        return (player.effective_rank(), *(player.maps[map] for map in self.maps))
+
+    def _build(self, start: int, end: int) -> int:
+        points = [self.points[i] for i in self.order[start:end]]
+        low = tuple(map(min, zip(*points)))
+        high = tuple(map(max, zip(*points)))
+        node = len(self.nodes)
+        self.nodes.append([low, high, start, end, None, None])
+        if end - start > LEAF_SIZE:
+            axis = max(range(len(low)), key=lambda d: high[d] - low[d])
+            if high[axis] > low[axis]:
+                self.order[start:end] = sorted(
+                    self.order[start:end], key=lambda i: self.points[i][axis]
+                )
+                middle = (start + end) // 2
+                self.nodes[node][4] = self._build(start, middle)
+                self.nodes[node][5] = self._build(middle, end)
+        return node
+
+    def nearest(self, costs: list, k: int, exclude=()) -> list:
+        """
+        The k players with the lowest cost, best first
+
+        PARAMETERS
+        ----------
+        costs : list
+            (cost function, minimizer) per dimension, the cost of a player is the
+            sum of the cost functions of its coordinates, which must be convex
+        exclude : set
+            Ids of players that are not candidates
+
+        RETURNS
+        -------
+        list
+            (cost, player)
+        """
+        if not self.nodes or k <= 0:
+            return []
+
+        def bound(node) -> float:
+            low, high = node[0], node[1]
+            return sum(
+                cost(min(max(best, low[d]), high[d]))
+                for d, (cost, best) in enumerate(costs)
+            )
+
+        best = []  # max heap of (-cost, index)
+        queue = [(bound(self.nodes[0]), 0)]
+        while queue:
+            lower, node = heapq.heappop(queue)
+            if len(best) == k and lower >= -best[0][0]:
+                break
+            low, high, start, end, left, right = self.nodes[node]
+            if left is not None:
+                for child in (left, right):
+                    heapq.heappush(queue, (bound(self.nodes[child]), child))
+                continue
+            for i in self.order[start:end]:
+                if self.players[i].id in exclude:
+                    continue
+                cost = sum(
+                    function(x) for (function, _), x in zip(costs, self.points[i])
+                )
+                if len(best) < k:
+                    heapq.heappush(best, (-cost, i))
+                elif cost < -best[0][0]:
+                    heapq.heapreplace(best, (-cost, i))
+        return [(-cost, self.players[i]) for cost, i in sorted(best, reverse=True)]
+
+
+def substitute_costs(rest: list, pool: list, maps: list, average=None) -> list:
+    """
+    Per dimension costs for PlayerIndex.nearest of adding a player to rest,
+    up to rounding and a constant the overallcompatability of the team with the player
+    """
+    size = len(rest) + 1
+    if average is None:
+        average = statistics.mean(player.effective_rank() for player in pool)
+    # The rank at which the average of the team equals the average of everyone
+    target = size * average - sum(player.effective_rank() for player in rest)
+    costs = [(lambda x: abs(x - target) / size, target)]
+    weight = 2 / (len(maps) * size)
+
+    def map_cost(values):
+        return lambda x: weight * sum(abs(x - value) for value in values)
+
+    for map in maps:
+        values = [player.maps[map] for player in rest]
+        costs.append((map_cost(values), statistics.median(values) if values else 0))
+    return costs
+
+
+def find_substitutes(
+    team: Team,
+    dropped,
+    players: list,
+    index: PlayerIndex,
+    k: int = 5,
+    playing=(),
+) -> list:
+    """
+    The players who change the compatability of the team the least when they
+    replace the dropped player
+
+    PARAMETERS
+    ----------
+    players : list
+        The registered players, the average rank of the team is compared to theirs
+    index : PlayerIndex
+        Index over the registered players
+    playing : set
+        Ids of players who play in other teams, they are not candidates
+
+    RETURNS
+    -------
+    list
+        (player, team with the player, change of overallcompatability), best first
+    """
+    rest = [player for player in team.players if player.id != dropped.id]
+    pool = [player for player in players if player.id != dropped.id]
+    if not pool:
+        return []
+    exclude = {player.id for player in team.players} | set(playing)
+    if team.metric == "footrule":
+        costs = substitute_costs(rest, pool, index.maps)
+        shortlist = [player for _, player in index.nearest(costs, k, exclude)]
+    else:
+        # The bounds of the index only hold for the footrule, score everyone
+        shortlist = [player for player in pool if player.id not in exclude]
+    candidates = []
+    for player in shortlist:
+        substituted = Team(team.id, rest + [player], pool, team.metric)
+        candidates.append(
+            (
+                player,
+                substituted,
+                substituted.overallcompatability - team.overallcompatability,
+            )
+        )
+    return sorted(candidates, key=lambda candidate: candidate[2])[:k]
+
+
+def _fill(members: list, pool: list, lost_igl: bool, average: float, metric: str):
+    """
+    The player to fill a hole in a team, players who have played the fewest matches
+    come first and among them the one the team is most compatible with
+    """
+    candidates = [player for player in pool if player not in members]
+    if not candidates:
+        return None
+    fewest = min(player.matches for player in candidates)
+    candidates = [player for player in candidates if player.matches <= fewest]
+    if lost_igl:
+        candidates = [player for player in candidates if player.igl] or candidates
+    if metric != "footrule":
+        return min(
+            candidates,
+            key=lambda player: Team(
+                None, members + [player], pool, metric
+            ).overallcompatability,
+        )
+    maps = get_active_duty()
+    costs = substitute_costs(members, pool, maps, average)
+    return PlayerIndex(candidates, maps).nearest(costs, 1)[0][1]
+
+
+@timed("repair_teams")
+def repair_teams(
+    teams: dict, players: dict, appearances: dict = None, metric: str = None
+) -> tuple:
+    """
+    Repair rolled teams after players signed up or dropped out, keeping every
+    player who is still signed up in their team unless that is unfair
+
+    Dropped players leave a hole that is filled like roll_teams would choose,
+    players who played two or more matches more than someone left out are swapped out.
+
+    PARAMETERS
+    ----------
+    teams : dict
+        team id -> Team rolled before the signups changed
+    players : dict
+        player id -> Player signed up now
+    appearances : dict
+        player id -> matches played this season, see MatchHistory
+    metric : str
+        Map preference distance to score teams by, constants.map_metric by default
+
+    RETURNS
+    -------
+    tuple
+        (team id -> repaired Team, list of (team id, player out, player in)),
+        either player of a change can be None
+    """
+    appearances = appearances or {}
+    metric = metric or constants.map_metric
+    pool = list(players.values())
+    team_size = min(constants.team_size, len(pool))
+    if not pool:
+        return {id: Team(id, [], pool, metric) for id in teams}, [
+            (id, player, None) for id, team in teams.items() for player in team.players
+        ]
+    average = statistics.mean(player.effective_rank() for player in pool)
+    for player in pool:
+        player.matches = appearances.get(player.id, 0)
+    members, changes, lost_igl = {}, [], {}
+    for id, team in teams.items():
+        members[id] = [players[p.id] for p in team.players if p.id in players]
+        dropped = [p for p in team.players if p.id not in players]
+        changes.extend((id, player, None) for player in dropped)
+        lost_igl[id] = any(p.igl for p in dropped) and not any(
+            p.igl for p in members[id]
+        )
+        for player in members[id]:
+            player.matches += 1
+
+    for id, team in members.items():
+        while len(team) > team_size:
+            player = max(team, key=lambda player: player.matches)
+            team.remove(player)
+            player.matches -= 1
+            changes.append((id, player, None))
+        while len(team) < team_size:
+            player = _fill(team, pool, lost_igl[id], average, metric)
+            if player is None:
+                break
+            team.append(player)
+            player.matches += 1
+            lost_igl[id] = False
+            # Pair the new player with a player who dropped out of the team
+            hole = next(
+                (i for i, (t, _, new) in enumerate(changes) if t == id and not new),
+                None,
+            )
+            if hole is None:
+                changes.append((id, None, player))
+            else:
+                changes[hole] = (id, changes[hole][1], player)
+
+    # Swap out players who play far more than someone left out, every swap
+    # makes the matches more even so this ends
+    swapped = True
+    while swapped:
+        swapped = False
+        for id, team in members.items():
+            outside = [player for player in pool if player not in team]
+            if not outside:
+                continue
+            fewest = min(player.matches for player in outside)
+            for player in sorted(team, key=lambda player: -player.matches):
+                if player.matches < fewest + 2:
+                    break
+                sole_igl = player.igl and sum(p.igl for p in team) == 1
+                rest = [p for p in team if p is not player]
+                substitute = _fill(rest, pool, sole_igl, average, metric)
+                if sole_igl and not substitute.igl:
+                    continue
+                team[team.index(player)] = substitute
+                player.matches -= 1
+                substitute.matches += 1
+                changes.append((id, player, substitute))
+                swapped = True
+                break
+    return {id: Team(id, team, pool, metric) for id, team in members.items()}, changes
+
+
+### TESTS
+
+
+def test_substitutes_match_brute_force(monkeypatch):
+    import random
+    import cachetools.keys
+    import csgo
+    from loadtest import MAP_POOL
+    from player import Player
+
+    monkeypatch.setitem(csgo.get_active_duty.cache, cachetools.keys.hashkey(), MAP_POOL)
+    random.seed(4)
+    maps = get_active_duty()
+    players = []
+    for i in range(400):
+        player = Player(i, str(i), str(i))
+        player.rank = random.randint(1000, 30000)
+        player.update_maps(random.sample(maps, k=len(maps)))
+        players.append(player)
+    team = Team(0, players[:5], players)
+    index = PlayerIndex(players, maps)
+    found = find_substitutes(team, players[2], players, index, k=5)
+    pool = [player for player in players if player is not players[2]]
+    expected = sorted(
+        Team(0, players[:2] + players[3:5] + [player], pool).overallcompatability
+        for player in players[5:]
+    )[:5]
+    assert [candidate[1].overallcompatability for candidate in found] == expected
+    assert all(candidate[0] not in team.players for candidate in found)
+    playing = {candidate[0].id for candidate in found[:2]}
+    others = find_substitutes(team, players[2], players, index, k=5, playing=playing)
+    assert [candidate[0] for candidate in others[:3]] == [
+        candidate[0] for candidate in found[2:]
+    ]
+
+
+def test_repair_teams(monkeypatch):
+    import random
+    import cachetools.keys
+    import csgo
+    from loadtest import MAP_POOL
+    from player import Player
+    from team import roll_teams
+
+    monkeypatch.setitem(csgo.get_active_duty.cache, cachetools.keys.hashkey(), MAP_POOL)
+    random.seed(2)
+    players = {}
+    for i in range(8):
+        player = Player(i, str(i), str(i))
+        player.rank = random.randint(1000, 20000)
+        players[i] = player
+    teams = roll_teams(players, 2)
+    before = {id: {p.id for p in team.players} for id, team in teams.items()}
+    dropped = teams[0].players[1]
+    del players[dropped.id]
+    late = players[99] = Player(99, "late", "late")
+    repaired, changes = repair_teams(teams, players)
+    after = {id: {p.id for p in team.players} for id, team in repaired.items()}
+    assert dropped.id not in after[0] | after[1]
+    assert late.id in after[0] | after[1], "The late player has not played at all"
+    assert all(len(team) == constants.team_size for team in after.values())
+    kept = sum(len(before[id] & after[id]) for id in before)
+    assert kept >= 2 * constants.team_size - 3, "Only the changes should move players"
+    assert len(changes) <= 3
+    assert repair_teams(repaired, players)[1] == [], "Repairing again changes nothing"
@@ -1,19 +1,26 @@
 import math
+import heapq
+import itertools
 import statistics
 import constants
 import random
 from csgo import get_active_duty
 from player import Player
 from mapdict import MapDict
+from metrics import timed
+from distances import get_metric, preference_matrix
 
 
 class Team:
-    def __init__(self, id, players, all_players) -> None:
+    def __init__(self, id, players, all_players, metric: str = None) -> None:
         self.id = id
+        self.metric = metric or constants.map_metric
         self.overallcompatability = math.inf
         self.rankcompatability = 0
         self.mapcompatability = 0
         self.players = players
+        # Other teams rolled for the same match, best first, see Alternatives
+        self.alternatives = []
         self.map_preference = MapDict()
         self.set_map_preference()
         self.calculate_rank_score(all_players)
@@ -52,8 +59,12 @@ class Team:
         A teams ranking score is the deviation of the average rank of the team from the average rank of all players.
         """
         try:
-            avg_rank = statistics.mean([player.rank for player in all_players])
-            avg_team = statistics.mean([player.rank for player in self.players])
+            avg_rank = statistics.mean(
+                [player.effective_rank() for player in all_players]
+            )
+            avg_team = statistics.mean(
+                [player.effective_rank() for player in self.players]
+            )
         except statistics.StatisticsError:
             avg_rank = 0
             avg_team = 0
@@ -61,14 +72,12 @@ class Team:
 
     def calculate_map_score(self) -> float:
         """
-        A teams map score is the sum of the euclidean distance between each player's map preference.
+        A teams map score is the sum of the distances between each player's map preference,
+        see distances.py for the metrics.
         """
-        total_distance = 0
-        for player in self.players:
-            for other_player in self.players:
-                if other_player == player:
-                    continue
-                total_distance += player.map_compatability(other_player)
+        total_distance = get_metric(self.metric)(
+            preference_matrix(self.players, get_active_duty())
+        )
         try:
             self.mapcompatability = round(
                 (total_distance / (len(get_active_duty()) * len(self.players))), 3
@@ -83,6 +92,61 @@ class Team:
         self.overallcompatability = self.rankcompatability + self.mapcompatability
 
 
+def map_fit(teams: dict, maps: list) -> dict:
+    """
+    The average map preference of every team for every map
+
+    RETURNS
+    -------
+    dict
+        map -> {team id: average preference of the team's players}
+    """
+    fit = {}
+    for map in maps:
+        fit[map] = {}
+        for id, team in teams.items():
+            score = sum(player.maps[map] for player in team.players)
+            fit[map][id] = score / len(team.players) if team.players else score
+    return fit
+
+
+class Alternatives:
+    """
+    Bounded heap of the k best distinct teams seen for a match, every team differs
+    from each better one in at least min_changes players
+    """
+
+    def __init__(self, k: int = None, min_changes: int = None):
+        self.k = constants.alternatives if k is None else k
+        self.min_changes = (
+            constants.alternative_min_changes if min_changes is None else min_changes
+        )
+        # Max heap on the score, (-score, sequence, player ids, team)
+        self.heap = []
+        self.sequence = itertools.count()
+
+    def offer(self, team: Team):
+        score = team.overallcompatability
+        if len(self.heap) >= self.k and score >= -self.heap[0][0]:
+            return
+        ids = frozenset(player.id for player in team.players)
+        similar = [
+            entry for entry in self.heap if len(ids - entry[2]) < self.min_changes
+        ]
+        if any(-entry[0] <= score for entry in similar):
+            return
+        if similar:
+            # The team replaces the worse teams it is too similar to
+            self.heap = [entry for entry in self.heap if entry not in similar]
+            heapq.heapify(self.heap)
+        heapq.heappush(self.heap, (-score, next(self.sequence), ids, team))
+        if len(self.heap) > self.k:
+            heapq.heappop(self.heap)
+
+    def teams(self) -> list:
+        return [entry[3] for entry in sorted(self.heap, key=lambda e: (-e[0], e[1]))]
+
+
 def _choose_players(players, team_size) -> list:
     chosen = []
 
@@ -98,39 +162,105 @@ def _choose_players(players, team_size) -> list:
                 igl = random.choice(applicableIgls)
                 chosen.append(igl)
                 continue
-        applicable = [
-            player
-            for player in players
-            if player.matches <= min(player.matches for player in players)
-            and player not in chosen
-        ]
-        if not applicable:
-            applicable = [player for player in players if player not in chosen]
+        applicable = [player for player in players if player not in chosen]
+        fewest = min(player.matches for player in applicable)
+        applicable = [player for player in applicable if player.matches <= fewest]
         player = random.choice(applicable)
         chosen.append(player)
     return chosen
 
 
-def roll_teams(players: dict, num_matches: int):
+@timed("roll_teams")
+def roll_teams(
+    players: dict,
+    num_matches: int,
+    appearances: dict = None,
+    constraints=None,
+    metric: str = None,
+):
+    """
+    Roll one team per match from the players, players who have played the
+    fewest matches are chosen first
+
+    PARAMETERS
+    ----------
+    players : dict
+        player id -> Player signed up
+    num_matches : int
+        Number of teams to roll
+    appearances : dict
+        player id -> matches played this season, see MatchHistory.
+        Without it only the matches rolled now count.
+    constraints : Constraints
+        Constraints every team must satisfy, raises ConstraintError if they can not be
+    metric : str
+        Map preference distance to score teams by, constants.map_metric by default
+
+    Every rolled team keeps the best other teams rolled for its match in
+    Team.alternatives, they were rolled with the same players counted as played.
+    """
+    appearances = appearances or {}
     player_pool = [player for player in players.values()]
     for player in player_pool:
         player.chosen = 0
-        player.matches = 0
+        player.matches = appearances.get(player.id, 0)
 
     best_teams = {}
     team_size = (
         constants.team_size if len(players) >= constants.team_size else len(players)
     )
+    plan = None
+    if constraints is not None and not constraints.is_empty():
+        plan = constraints.prepare(player_pool, num_matches, team_size)
     for i in range(num_matches):
         best_score = math.inf
         best_team = None
+        alternatives = Alternatives()
         for _ in range(constants.team_roll_limit):
-            team = Team(i, _choose_players(player_pool.copy(), team_size), player_pool)
+            if plan is not None:
+                chosen = plan.choose(i)
+            else:
+                chosen = _choose_players(player_pool.copy(), team_size)
+            team = Team(i, chosen, player_pool, metric)
+            alternatives.offer(team)
             if team.overallcompatability < best_score:
                 best_score = team.overallcompatability
                 best_team = team
+        best_team.alternatives = [
+            team for team in alternatives.teams() if team is not best_team
+        ]
 
         for player in best_team.players:
             player.matches += 1
         best_teams[i] = best_team
     return best_teams
+
+
+### TESTS
+
+
+def test_alternatives_are_best_and_diverse():
+    import random
+    from types import SimpleNamespace
+
+    random.seed(1)
+    players = [SimpleNamespace(id=i) for i in range(12)]
+    offered = []
+    alternatives = Alternatives(k=4, min_changes=2)
+    for _ in range(300):
+        team = SimpleNamespace(
+            players=random.sample(players, 5),
+            overallcompatability=random.random(),
+        )
+        offered.append(team)
+        alternatives.offer(team)
+    kept = alternatives.teams()
+    assert len(kept) == 4
+    assert kept[0] is min(offered, key=lambda team: team.overallcompatability)
+    scores = [team.overallcompatability for team in kept]
+    assert scores == sorted(scores)
+    for i, team in enumerate(kept):
+        for other in kept[:i]:
+            assert (
+                len({p.id for p in team.players} - {p.id for p in other.players}) >= 2
+            )
@@ -0,0 +1,390 @@
+"""
+Record production interactions and reactions to a compact trace and replay them
+offline against the cogs, see fakediscord.py.
+
+Recording is opt-in, set "trace_file" in config.json.
+Replay a trace and compare it against the results of an earlier replay:
+
+    python tracing.py trace.jsonl --speed 10 --out new.json --baseline old.json
+"""
+
+import os
+import sys
+import gzip
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+from collections import Counter, defaultdict
+
+INTERACTION_KINDS = {2: "cmd", 4: "ac"}
+
+
+def _flatten_options(options: list) -> tuple:
+    """
+    Return (command path, {option: value}, focused option) of interaction options
+    """
+    path, values, focused = [], {}, None
+    for option in options or []:
+        if "options" in option and "value" not in option:
+            path.append(option["name"])
+            sub_path, values, focused = _flatten_options(option["options"])
+            path.extend(sub_path)
+            break
+        values[option["name"]] = option.get("value")
+        if option.get("focused"):
+            focused = option["name"]
+    return path, values, focused
+
+
+class TraceRecorder:
+    """
+    Appends one json object per event to a jsonl file. Every line is flushed as it
+    is written, so the trace holds everything up to a crash or a killed container.
+    Keys are kept short, t: seconds since start, k: kind, u: user, n: command name,
+    o: options, f: focused option, c: cog owning the reacted message, p: permissions
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.start = time.monotonic()
+        self.seen = set()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.file = open(path, "a", encoding="utf-8", buffering=1)
+        self._write({"v": 1, "started": time.time()})
+
+    def _write(self, event: dict):
+        self.file.write(json.dumps(event, separators=(",", ":")) + "\n")
+
+    def _elapsed(self) -> float:
+        return round(time.monotonic() - self.start, 4)
+
+    def _user(self, event: dict, user_id: int, permissions=None):
+        event["u"] = user_id
+        if permissions is not None and user_id not in self.seen:
+            self.seen.add(user_id)
+            event["p"] = [permissions.administrator, permissions.manage_roles]
+
+    def record_interaction(self, interaction):
+        kind = INTERACTION_KINDS.get(getattr(interaction.type, "value", None))
+        if kind is None or not interaction.data:
+            return
+        path, options, focused = _flatten_options(interaction.data.get("options"))
+        event = {
+            "t": self._elapsed(),
+            "k": kind,
+            "n": " ".join([interaction.data["name"], *path]),
+            "o": options,
+        }
+        if focused:
+            event["f"] = focused
+        self._user(event, interaction.user.id, interaction.permissions)
+        self._write(event)
+
+    def record_reaction(self, kind: str, payload, cogs):
+        owner = None
+        for cog in cogs:
+            if not hasattr(cog, "get_registration_message"):
+                continue
+            message = cog.get_registration_message(payload.guild_id)
+            if message is not None and message.id == payload.message_id:
+                owner = cog.qualified_name
+        if owner is None:
+            return
+        event = {"t": self._elapsed(), "k": kind, "c": owner}
+        self._user(event, payload.user_id)
+        self._write(event)
+
+    def close(self):
+        self.file.close()
+
+
+def read_trace(path: str) -> list:
+    """
+    Events of a trace, gzip traces are read too. A last line cut off by a crash
+    is skipped, like the end of a truncated gzip stream.
+    """
+    with open(path, "rb") as f:
+        compressed = f.read(2) == b"\x1f\x8b"
+    lines = []
+    with (gzip.open if compressed else open)(path, "rt", encoding="utf-8") as f:
+        try:
+            for line in f:
+                lines.append(line)
+        except (EOFError, gzip.BadGzipFile):
+            pass
+    events = []
+    for number, line in enumerate(lines):
+        try:
+            events.append(json.loads(line))
+        except json.JSONDecodeError:
+            if number < len(lines) - 1:
+                raise
+    return [event for event in events if "k" in event]
+
+
+class ReplayResult:
+    def __init__(self):
+        self.latency = defaultdict(list)
+        self.cpu = defaultdict(float)
+        self.errors = defaultdict(int)
+        self.error_types = defaultdict(Counter)
+        self.skipped = defaultdict(int)
+
+    def summary(self) -> dict:
+        summary = {}
+        for name, samples in self.latency.items():
+            samples = sorted(samples)
+            summary[name] = {
+                "n": len(samples),
+                "errors": self.errors[name],
+                "mean": sum(samples) / len(samples),
+                "p50": samples[len(samples) // 2],
+                "p99": samples[min(len(samples) - 1, int(len(samples) * 0.99))],
+                "cpu": self.cpu[name] / len(samples),
+            }
+        return summary
+
+
+async def replay(events: list, speed: float = 1.0, latency: float = 0.0):
+    """
+    Replay trace events against MemberHandler and MatchHandler
+
+    PARAMETERS
+    ----------
+    events : list
+        Events from read_trace
+    speed : float
+        1 replays at the recorded pace, 10 ten times faster,
+        0 runs the events one after another as fast as possible
+    latency : float
+        Simulated discord round trip per request
+
+    RETURNS
+    -------
+    ReplayResult
+        Wall clock latency and cpu time per command, cpu time is only exact
+        for speed 0 since concurrent events share the cpu
+    """
+    import fakediscord
+    import cogs.member
+    import cogs.match
+    from discord import AppCommandOptionType
+    from fakediscord import FakeBot, FakeGuild, FakeInteraction, FakeRawReaction
+
+    result = ReplayResult()
+    guild = FakeGuild(latency=latency)
+    bot = FakeBot(guild, f"{os.path.dirname(os.path.abspath(__file__))}/config.json")
+    await bot.load_extension(cogs.member)
+    await bot.load_extension(cogs.match)
+    members = {}
+
+    def member(user_id):
+        user_id = int(user_id)
+        if user_id not in members:
+            members[user_id] = guild.add_member(f"user{user_id}")
+        return members[user_id]
+
+    for event in events:
+        if "p" in event:
+            member(event["u"]).permissions = fakediscord.FakePermissions(*event["p"])
+
+    commands = {}
+    for cog in bot.cogs.values():
+        for command in cog.walk_app_commands():
+            commands[command.qualified_name] = (cog, command)
+    user_types = (AppCommandOptionType.user, AppCommandOptionType.mentionable)
+
+    def resolve(command, options: dict) -> dict:
+        """
+        Member options are recorded as user ids, pass the members like discord.py
+        """
+        options = dict(options)
+        for parameter in command.parameters:
+            if parameter.type in user_types and options.get(parameter.name):
+                options[parameter.name] = member(options[parameter.name])
+        return options
+
+    async def run(event):
+        user = member(event["u"])
+        if event["k"] in ("ra", "rr"):
+            name = f"reaction {event['c']}"
+            message = bot.get_cog(event["c"]).get_registration_message(guild.id)
+            if message is None:
+                result.skipped[name] += 1
+                return
+            listener = (
+                "on_raw_reaction_add"
+                if event["k"] == "ra"
+                else "on_raw_reaction_remove"
+            )
+            event_type = "REACTION_ADD" if event["k"] == "ra" else "REACTION_REMOVE"
+            coro = bot.dispatch(
+                listener, FakeRawReaction(guild, message, user, event_type=event_type)
+            )
+        else:
+            name = event["n"] if event["k"] == "cmd" else f"autocomplete {event['n']}"
+            if event["n"] not in commands:
+                result.skipped[name] += 1
+                return
+            cog, command = commands[event["n"]]
+            options = resolve(command, event["o"])
+            interaction = FakeInteraction(guild, user, **options)
+            if event["k"] == "cmd":
+                coro = fakediscord.invoke(cog, command.name, interaction, **options)
+            else:
+                coro = fakediscord.autocomplete(
+                    cog, command.name, event["f"], interaction, event["o"][event["f"]]
+                )
+        start, cpu = time.perf_counter(), time.thread_time()
+        try:
+            await coro
+        except Exception as e:
+            result.errors[name] += 1
+            result.error_types[name][type(e).__name__] += 1
+        finally:
+            result.latency[name].append(time.perf_counter() - start)
+            result.cpu[name] += time.thread_time() - cpu
+
+    if speed <= 0:
+        for event in events:
+            await run(event)
+        return result
+    start = time.monotonic()
+    tasks = []
+    for event in events:
+        delay = event["t"] / speed - (time.monotonic() - start)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.ensure_future(run(event)))
+    await asyncio.gather(*tasks)
+    return result
+
+
+def compare(baseline: dict, current: dict) -> str:
+    """
+    Per command errors, and change in mean latency, p99 and cpu time against
+    a baseline summary. Latencies of commands that raised are not comparable.
+    """
+    lines = [
+        f"{'command':<32} {'errors':>9} {'mean ms':>9} {'Δ':>8} {'p99 ms':>9} {'Δ':>8} {'cpu ms':>8} {'Δ':>8}"
+    ]
+
+    def delta(new, old):
+        return f"{(new - old) / old:+.1%}" if old else "n/a"
+
+    failed = 0
+    for name, now in sorted(current.items()):
+        errors = f"{now['errors']}/{now['n']}"
+        failed += now["errors"]
+        before = baseline.get(name)
+        if before is None:
+            lines.append(
+                f"{name:<32} {errors:>9} {now['mean'] * 1000:>9.2f} {'new':>8}"
+            )
+            continue
+        lines.append(
+            f"{name:<32} {errors:>9} {now['mean'] * 1000:>9.2f} {delta(now['mean'], before['mean']):>8} "
+            f"{now['p99'] * 1000:>9.2f} {delta(now['p99'], before['p99']):>8} "
+            f"{now['cpu'] * 1000:>8.2f} {delta(now['cpu'], before['cpu']):>8}"
+        )
+    if failed:
+        lines.append(f"{failed} events raised, the replay is not clean")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    import fakediscord
+    from loadtest import MAP_POOL
+
+    parser = argparse.ArgumentParser(description="Replay an interaction trace offline")
+    parser.add_argument("trace")
+    parser.add_argument("--speed", type=float, default=1.0)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--out", help="write the results summary to this file")
+    parser.add_argument("--baseline", help="results summary of an earlier replay")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    random.seed(args.seed)
+    os.environ["HOME"] = tempfile.mkdtemp(prefix="csbot-replay-")
+    os.makedirs(f"{os.environ['HOME']}/.csbot")
+    fakediscord.offline_map_pool(MAP_POOL)
+    result = asyncio.run(replay(read_trace(args.trace), args.speed, args.latency))
+    summary = result.summary()
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(summary, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            print(compare(json.load(f), summary))
+    else:
+        print(compare({}, summary))
+    for name, errors in result.error_types.items():
+        print(f"errors in {name}: {dict(errors)}")
+    for name, count in result.skipped.items():
+        print(f"skipped {count} {name}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+
+### TESTS
+
+
+def test_record_read_replay(tmp_path, monkeypatch):
+    from types import SimpleNamespace
+    import cachetools.keys
+    import csgo
+    import fakediscord
+    from loadtest import MAP_POOL
+
+    monkeypatch.setenv("HOME", str(tmp_path))
+    monkeypatch.setitem(csgo.get_active_duty.cache, cachetools.keys.hashkey(), MAP_POOL)
+    admin, user = SimpleNamespace(id=1), SimpleNamespace(id=2)
+
+    def command(by, name, permissions=(False, False), **options):
+        return SimpleNamespace(
+            type=SimpleNamespace(value=2),
+            data={
+                "name": name,
+                "options": [{"name": k, "value": v} for k, v in options.items()],
+            },
+            user=by,
+            permissions=SimpleNamespace(
+                administrator=permissions[0], manage_roles=permissions[1]
+            ),
+        )
+
+    path = str(tmp_path / "trace.jsonl")
+    recorder = TraceRecorder(path)
+    recorder.record_interaction(
+        command(admin, "start_registration_season", permissions=(True, True))
+    )
+    message = SimpleNamespace(id=10)
+    cog = SimpleNamespace(
+        qualified_name="MemberHandler", get_registration_message=lambda guild: message
+    )
+    payload = SimpleNamespace(guild_id=0, message_id=10, user_id=user.id)
+    recorder.record_reaction("ra", payload, [cog])
+    recorder.record_interaction(command(user, "set_rank", rank="12000"))
+    # Member options arrive as user ids
+    recorder.record_interaction(command(admin, "rank_history", member=str(user.id)))
+    # Flushed per line, readable before the recorder is closed
+    assert len(read_trace(path)) == 4
+    recorder.close()
+    with open(path, "a") as f:
+        f.write('{"t":9.1,"k":"cm')
+
+    events = read_trace(path)
+    assert [event["k"] for event in events] == ["cmd", "ra", "cmd", "cmd"]
+    result = asyncio.run(replay(events, speed=0))
+    summary = result.summary()
+    assert not result.error_types, dict(result.error_types)
+    assert summary["rank_history"]["n"] == 1
+    assert "0/1" in compare({}, summary)
+    result.errors["rank_history"] += 1
+    assert "not clean" in compare({}, result.summary())
@@ -0,0 +1,188 @@
+"""
+Incremental shared banorder for a veto.
+
+The shared banorder is the sum over all teams of their map preference, where every
+team's three most wanted remaining maps are amplified by 16, 8 and 4 times the number
+of remaining maps, see MapDict.amplify_most_wanted.
+Instead of copying and re-summing every team's preference on each ban or pick,
+VetoState keeps the per team ranking of the remaining maps and the shared sums,
+and applies a ban, pick, unban or unpick as a delta of O(teams) sums.
+"""
+
+from bisect import bisect_left, insort
+
+AMPLIFY = (16, 8, 4)
+
+
+class VetoState:
+    """
+    Shared banorder of the remaining maps of a veto
+
+    :param preferences: team id -> {map: preference} of the rolled teams
+    :param maps: The maps still available, in the order they became available
+    """
+
+    def __init__(self, preferences: dict, maps: list):
+        self.preferences = {
+            team_id: dict(preference) for team_id, preference in preferences.items()
+        }
+        self.available = {}
+        self._sequence = 0
+        for cs_map in maps:
+            self._make_available(cs_map)
+        # Maps without a preference from a team count as 0, like a missing key would
+        for preference in self.preferences.values():
+            for cs_map in maps:
+                preference.setdefault(cs_map, 0)
+        self.index = {
+            team_id: {cs_map: i for i, cs_map in enumerate(preference)}
+            for team_id, preference in self.preferences.items()
+        }
+        self.ranked = {
+            team_id: sorted(self._rank_key(team_id, cs_map) for cs_map in maps)
+            for team_id in self.preferences
+        }
+        self.base = {
+            cs_map: sum(preference[cs_map] for preference in self.preferences.values())
+            for cs_map in maps
+        }
+        self.shared = dict(self.base)
+        self._add_bonuses(self.shared, 1)
+        self.order = sorted(self._order_key(cs_map) for cs_map in maps)
+
+    def _make_available(self, cs_map: str):
+        self.available[cs_map] = self._sequence
+        self._sequence += 1
+
+    def _rank_key(self, team_id, cs_map: str) -> tuple:
+        """
+        Most wanted first, ties keep the order of the team preference
+        """
+        return (
+            -self.preferences[team_id][cs_map],
+            self.index[team_id][cs_map],
+            cs_map,
+        )
+
+    def _order_key(self, cs_map: str) -> tuple:
+        """
+        Lowest shared preference first, ties keep the order the maps became available
+        """
+        return (self.shared[cs_map], self.available[cs_map], cs_map)
+
+    def _add_bonuses(self, shared: dict, sign: int):
+        """
+        Add (sign=1) or remove (sign=-1) the amplification of every team's top maps
+        """
+        factor = len(self.available)
+        for team_id, ranked in self.ranked.items():
+            for weight, (_, _, cs_map) in zip(AMPLIFY, ranked):
+                value = self.preferences[team_id][cs_map]
+                shared[cs_map] = shared.get(cs_map, 0) + sign * value * (
+                    weight * factor - 1
+                )
+
+    def _update(self, cs_map: str, add: bool):
+        before = {}
+        self._add_bonuses(before, -1)
+        if add:
+            self._make_available(cs_map)
+            for team_id, ranked in self.ranked.items():
+                insort(ranked, self._rank_key(team_id, cs_map))
+        else:
+            for team_id, ranked in self.ranked.items():
+                key = self._rank_key(team_id, cs_map)
+                del ranked[bisect_left(ranked, key)]
+            del self.order[bisect_left(self.order, self._order_key(cs_map))]
+            del self.available[cs_map]
+            del self.shared[cs_map]
+        after = {}
+        self._add_bonuses(after, 1)
+
+        for changed in before.keys() | after.keys():
+            delta = before.get(changed, 0) + after.get(changed, 0)
+            if changed not in self.available or (delta == 0 and changed != cs_map):
+                continue
+            if changed == cs_map and add:
+                self.shared[cs_map] = self.base[cs_map] + delta
+                continue
+            del self.order[bisect_left(self.order, self._order_key(changed))]
+            self.shared[changed] += delta
+            insort(self.order, self._order_key(changed))
+        if add:
+            self.shared.setdefault(cs_map, self.base[cs_map])
+            insort(self.order, self._order_key(cs_map))
+
+    def remove(self, cs_map: str):
+        """
+        A map was banned or picked
+        """
+        if cs_map not in self.available:
+            raise ValueError(f"{cs_map} is not available")
+        self._update(cs_map, add=False)
+
+    def restore(self, cs_map: str):
+        """
+        A map was unbanned or unpicked
+        """
+        if cs_map in self.available:
+            raise ValueError(f"{cs_map} is already available")
+        if cs_map not in self.base:
+            raise ValueError(f"{cs_map} is not in the veto")
+        self._update(cs_map, add=True)
+
+    def banorder(self) -> list:
+        """
+        The remaining maps, the first one should be banned first
+        """
+        return [cs_map for _, _, cs_map in self.order]
+
+
+### TESTS
+
+
+def _reference_banorder(preferences: dict, available: list) -> list:
+    """
+    The shared banorder computed from scratch, like MatchState did before VetoState
+    """
+    from mapdict import MapDict
+
+    shared = MapDict()
+    private = {}
+    for team_id, preference in preferences.items():
+        private[team_id] = MapDict(preference).copy()
+        private[team_id].remove_banned_maps(
+            [cs_map for cs_map in preference if cs_map not in available]
+        )
+        private[team_id].amplify_most_wanted()
+    for cs_map in available:
+        shared[cs_map] = sum(preference[cs_map] for preference in private.values())
+    return shared.to_list_sorted()
+
+
+def test_veto_state_matches_reference():
+    import random
+
+    rng = random.Random(1)
+    maps = ["Ancient", "Anubis", "Dust_II", "Inferno", "Mirage", "Nuke", "Vertigo"]
+    for _ in range(50):
+        preferences = {
+            team_id: {cs_map: rng.randint(0, 12) for cs_map in maps}
+            for team_id in range(rng.randint(1, 6))
+        }
+        available = list(maps)
+        removed = []
+        veto = VetoState(preferences, available)
+        assert veto.banorder() == _reference_banorder(preferences, available)
+        for _ in range(20):
+            if removed and (len(available) <= 1 or rng.random() < 0.4):
+                cs_map = rng.choice(removed)
+                removed.remove(cs_map)
+                available.append(cs_map)
+                veto.restore(cs_map)
+            else:
+                cs_map = rng.choice(available)
+                available.remove(cs_map)
+                removed.append(cs_map)
+                veto.remove(cs_map)
+            assert veto.banorder() == _reference_banorder(preferences, available)
@@ -0,0 +1,187 @@
+"""
+Predict which map a veto ends on.
+
+The remaining veto is modelled as alternating bans until one map is left.
+On our turn we ban the first map of the shared banorder of the remaining maps,
+see veto.VetoState. The opponent bans according to one of the MODELS.
+Small map pools are solved exactly with a memoized search over the remaining map
+subsets, larger ones are estimated by Monte Carlo sampling within a time budget.
+"""
+
+import time
+import random
+
+from veto import VetoState
+
+MODELS = ("uniform", "weighted", "adversarial")
+
+
+class VetoPredictor:
+    """
+    :param preferences: team id -> {map: preference} of the rolled teams
+    :param maps: The maps still available, in the order they became available
+    :param model: How the opponent bans, one of MODELS
+        uniform: any remaining map with equal probability
+        weighted: maps we want more are banned more often
+        adversarial: always the map we want the most
+    """
+
+    def __init__(self, preferences: dict, maps: list, model: str = "uniform"):
+        if model not in MODELS:
+            raise ValueError(f"Unknown opponent model {model}, use one of {MODELS}")
+        if not maps:
+            raise ValueError("No maps left in the veto.")
+        self.preferences = preferences
+        self.maps = list(maps)
+        self.model = model
+        self.banorders = {}
+        self.outcomes = {}
+
+    def banorder(self, remaining: frozenset) -> list:
+        if remaining not in self.banorders:
+            maps = [cs_map for cs_map in self.maps if cs_map in remaining]
+            self.banorders[remaining] = VetoState(self.preferences, maps).banorder()
+        return self.banorders[remaining]
+
+    def bans(self, remaining: frozenset, our_turn: bool) -> list:
+        """
+        The possible next bans as (map, probability)
+        """
+        banorder = self.banorder(remaining)
+        if our_turn:
+            return [(banorder[0], 1.0)]
+        match self.model:
+            case "uniform":
+                return [(cs_map, 1 / len(banorder)) for cs_map in banorder]
+            case "weighted":
+                total = len(banorder) * (len(banorder) + 1) / 2
+                return [(cs_map, (i + 1) / total) for i, cs_map in enumerate(banorder)]
+            case "adversarial":
+                return [(banorder[-1], 1.0)]
+
+    def exact(self, remaining: frozenset, our_turn: bool) -> dict:
+        """
+        Probability of every remaining map being the last one
+        """
+        if len(remaining) == 1:
+            return {next(iter(remaining)): 1.0}
+        key = (remaining, our_turn)
+        if key in self.outcomes:
+            return self.outcomes[key]
+        outcome = {}
+        for banned, probability in self.bans(remaining, our_turn):
+            for cs_map, p in self.exact(remaining - {banned}, not our_turn).items():
+                outcome[cs_map] = outcome.get(cs_map, 0) + probability * p
+        self.outcomes[key] = outcome
+        return outcome
+
+    def sample(self, rng: random.Random, our_turn: bool) -> str:
+        """
+        Play out one veto
+        """
+        remaining = frozenset(self.maps)
+        while len(remaining) > 1:
+            bans = self.bans(remaining, our_turn)
+            if len(bans) == 1:
+                banned = bans[0][0]
+            else:
+                banned = rng.choices(
+                    [cs_map for cs_map, _ in bans], [p for _, p in bans]
+                )[0]
+            remaining = remaining - {banned}
+            our_turn = not our_turn
+        return next(iter(remaining))
+
+    def monte_carlo(
+        self, our_turn: bool, samples: int, timeout: float, seed: int = None
+    ) -> tuple:
+        """
+        RETURNS
+        -------
+        tuple
+            (probability of every map, number of vetoes played)
+        """
+        rng = random.Random(seed)
+        deadline = time.monotonic() + timeout
+        counts = dict.fromkeys(self.maps, 0)
+        played = 0
+        while played < samples and time.monotonic() < deadline:
+            counts[self.sample(rng, our_turn)] += 1
+            played += 1
+        return {
+            cs_map: count / max(played, 1) for cs_map, count in counts.items()
+        }, played
+
+
+def predict(
+    preferences: dict,
+    maps: list,
+    our_turn: bool,
+    model: str = "uniform",
+    max_exact: int = 12,
+    samples: int = 20000,
+    timeout: float = 1.5,
+) -> tuple:
+    """
+    Predict the last map of the veto
+
+    PARAMETERS
+    ----------
+    preferences : dict
+        team id -> {map: preference} of the rolled teams
+    maps : list
+        The maps still available
+    our_turn : bool
+        Whether we ban next
+    max_exact : int
+        Largest number of remaining maps that is solved exactly
+    samples, timeout : int, float
+        Budget of the Monte Carlo estimate used for more maps
+
+    RETURNS
+    -------
+    tuple
+        ({map: probability}, description of how it was computed)
+    """
+    predictor = VetoPredictor(preferences, maps, model)
+    if len(maps) <= max_exact:
+        outcome = predictor.exact(frozenset(maps), our_turn)
+        return {cs_map: outcome.get(cs_map, 0.0) for cs_map in maps}, "exact"
+    outcome, played = predictor.monte_carlo(our_turn, samples, timeout)
+    return outcome, f"{played} simulated vetoes"
+
+
+### TESTS
+
+MAPS = ["Ancient", "Anubis", "Dust_II", "Inferno", "Mirage", "Nuke", "Vertigo"]
+PREFERENCES = {
+    0: {cs_map: i for i, cs_map in enumerate(MAPS)},
+    1: {cs_map: (i * 3) % 7 for i, cs_map in enumerate(MAPS)},
+}
+
+
+def test_adversarial_is_deterministic():
+    outcome, method = predict(PREFERENCES, MAPS, True, "adversarial")
+    assert method == "exact"
+    assert sorted(outcome.values()) == [0.0] * 6 + [1.0]
+
+
+def test_empty_pool_is_rejected():
+    for model in MODELS:
+        try:
+            predict(PREFERENCES, [], False, model)
+        except ValueError:
+            continue
+        assert False, f"{model} predicted a veto without maps"
+
+
+def test_monte_carlo_close_to_exact():
+    for model in MODELS:
+        exact, _ = predict(PREFERENCES, MAPS, False, model)
+        assert abs(sum(exact.values()) - 1) < 1e-9
+        estimate, played = VetoPredictor(PREFERENCES, MAPS, model).monte_carlo(
+            False, 4000, 10, seed=1
+        )
+        assert played == 4000
+        for cs_map in MAPS:
+            assert abs(exact[cs_map] - estimate[cs_map]) < 0.05, model